@@ -0,0 +1,65 @@
+"""
+Throughput of the DB layer on each storage backend: payments added one by one,
+then the queries behind /whopays, /ranking and /log. The measured group shares the database
+with CREMAET_BENCH_GROUPS other groups (50 by default) of the same size, its queries should not notice them.
+
+    python -m benchmarks.bench_db [n_events] [backend ...]
+
+The backends are memory and sqlite by default, mariadb needs the CREMAET_DB_* variables.
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable
+
+from db_manager import DBManager, Singleton
+
+PARTICIPANTS = ['Andrea', 'Vicent', 'Ro', 'Iago', 'Santi', 'Carlos']
+
+
+def measure(label: str, n_calls: int, call: Callable[[int], object]) -> None:
+    started = time.perf_counter()
+    for it in range(n_calls):
+        call(it)
+    elapsed = time.perf_counter() - started
+    print(f'  {label:<12} {n_calls / elapsed:10.0f} calls/s')
+
+
+def run(backend: str, n_events: int) -> None:
+    os.environ['CREMAET_DB_BACKEND'] = backend
+    Singleton._instances.pop(DBManager, None)
+    db = DBManager()
+    db.clean_tables()
+    first_day = datetime(2000, 1, 7)
+    n_groups = int(os.environ.get('CREMAET_BENCH_GROUPS', 50))
+    for chat_id in range(1, n_groups + 1):
+        group_id = db.get_group_id(-chat_id)
+        ids = db.get_participant_ids(group_id, PARTICIPANTS, datetime(2022, 11, 18))
+        db.upsert_events([{'group_id': group_id, 'participant': ids[PARTICIPANTS[it % len(PARTICIPANTS)]],
+                           'date': first_day + timedelta(days=7 * it), 'not_available': False}
+                          for it in range(n_events)])
+    db.check_turn_state()
+    print(f'{backend}, {n_groups} other groups')
+    group_id = db.get_group_id(0)
+    participants = [db.add_participant(group_id, name, datetime(2022, 11, 18)) for name in PARTICIPANTS]
+    measure('add_event', n_events,
+            lambda it: db.add_event(group_id, participants[it % len(participants)], first_day + timedelta(days=7 * it)))
+    measure('turn order', 1000, lambda it: db.get_turn_order(group_id))
+    measure('ranking', 1000, lambda it: db.get_ranking(group_id))
+    measure('log page', 1000, lambda it: db.get_event_log(group_id, 10))
+    db.clean_tables()
+
+
+def main() -> None:
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    backends = sys.argv[2:] or ['memory', 'sqlite']
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.setdefault('CREMAET_SQLITE_PATH', os.path.join(tmp, 'bench.sqlite'))
+        for backend in backends:
+            run(backend, n_events)
+
+
+if __name__ == '__main__':
+    main()
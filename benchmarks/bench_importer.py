@@ -0,0 +1,40 @@
+"""
+Imports a synthetic history of one million payments into an in-memory sqlite database, twice.
+The second import only finds duplicates, it measures the cost of a re-import.
+
+    python -m benchmarks.bench_importer [n_rows]
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from importer import import_events
+from tests.db_fixtures import CHAT_ID, new_memory_db
+
+PARTICIPANTS = ['Andrea', 'Vicent', 'Ro', 'Iago', 'Santi', 'Carlos']
+
+
+def write_history(path: str, n_rows: int) -> None:
+    # one payment per day, the dates are unique
+    first_day = datetime(1000, 1, 1)
+    with open(path, 'w') as history:
+        history.write('participant;date\n')
+        for it in range(n_rows):
+            day = first_day + timedelta(days=it)
+            history.write(f'{PARTICIPANTS[it % len(PARTICIPANTS)]};{day.day:02d}/{day.month:02d}/{day.year:04d}\n')
+
+
+def main(n_rows: int) -> None:
+    db = new_memory_db()
+    group_id = db.get_group_id(CHAT_ID)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'history.csv')
+        write_history(path, n_rows)
+        for label in ('first import', 're-import'):
+            stats = import_events(path, group_id, db=db)
+            print(f'{label}: {stats.rows} rows in {stats.seconds:.2f}s, {stats.rows_per_second:.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000)
@@ -0,0 +1,201 @@
+"""
+End to end throughput of the bot. The bot runs as a subprocess against a local fake telegram,
+over a sqlite copy of backup.csv, and replays a generated stream of updates: every chat sends /start
+and then a random mix of commands, buttons and edited messages, one at a time (it waits for the reply).
+The latency of an update goes from the moment it is queued in the fake getUpdates to its last reply.
+
+    python -m benchmarks.bench_replay [--chats 20] [--updates 10] [--json]
+
+The real telegram rate limits would dominate the latencies, they are raised unless --telegram-limits.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# kind -> (weight, update builder)
+MIX = {
+    '/log': (3, lambda chat, text_id: _message(chat, text_id, '/log')),
+    '/ranking': (3, lambda chat, text_id: _message(chat, text_id, '/ranking')),
+    '/whopays': (3, lambda chat, text_id: _message(chat, text_id, '/whopays 4')),
+    '/event': (1, lambda chat, text_id: _message(chat, text_id, '/event')),
+    'callback_query': (4, lambda chat, text_id: _callback(chat, text_id,
+                                                          random.choice(['/log', '/ranking', '/whopays']))),
+    'edited_message': (1, lambda chat, text_id: _message(chat, text_id, '/ranking', edited=True)),
+}
+# the guided /event only asks who paid, the other commands end with the main menu
+EVENT_PROMPT = '¿Quién pagó'
+
+
+def _message(chat: int, message_id: int, text: str, edited: bool = False) -> dict:
+    key = 'edited_message' if edited else 'message'
+    return {key: {'message_id': message_id, 'text': text,
+                  'chat': {'id': chat, 'first_name': f'Bench{chat}', 'last_name': 'Replay'}}}
+
+
+def _callback(chat: int, message_id: int, data: str) -> dict:
+    return {'callback_query': {'data': data, 'from': {'id': chat, 'first_name': f'Bench{chat}'},
+                               'message': {'message_id': message_id, 'chat': {'id': chat}}}}
+
+
+def generate_stream(n_chats: int, n_updates: int, seed: int) -> Dict[int, List[Tuple[str, dict]]]:
+    # chat -> [(kind, update)], the first update of every chat registers the user
+    rng = random.Random(seed)
+    kinds = list(MIX)
+    weights = [MIX[kind][0] for kind in kinds]
+    stream = dict()
+    for chat in range(1000, 1000 + n_chats):
+        updates = [('/start', _message(chat, 1, '/start'))]
+        for it in range(2, n_updates + 1):
+            kind = rng.choices(kinds, weights)[0]
+            updates.append((kind, MIX[kind][1](chat, it)))
+        stream[chat] = updates
+    return stream
+
+
+def is_last_reply(method: str, payload: dict) -> bool:
+    if method != 'sendMessage':
+        return False
+    markup = payload.get('reply_markup')
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    if markup and any(button.get('callback_data') == '/whopays'
+                      for row in markup.get('inline_keyboard', []) for button in row):
+        return True
+    return str(payload.get('text', '')).startswith(EVENT_PROMPT)
+
+
+class Replay:
+
+    def __init__(self, stream: Dict[int, List[Tuple[str, dict]]]):
+        self.stream = stream
+        self.position = {chat: 0 for chat in stream}
+        self.started: Dict[int, float] = dict()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.pending = len(stream)
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.telegram = FakeTelegram(on_send=self.on_send)
+
+    def push_next(self, chat: int) -> None:
+        kind, update = self.stream[chat][self.position[chat]]
+        self.started[chat] = time.perf_counter()
+        self.telegram.push(update)
+
+    def on_send(self, method: str, payload: dict, sent_at: float) -> None:
+        if not is_last_reply(method, payload):
+            return
+        chat = int(payload['chat_id'])
+        with self.lock:
+            if chat not in self.started:
+                return
+            kind = self.stream[chat][self.position[chat]][0]
+            self.latencies[kind].append(sent_at - self.started.pop(chat))
+            self.position[chat] += 1
+            if self.position[chat] < len(self.stream[chat]):
+                self.push_next(chat)
+                return
+            self.pending -= 1
+            if self.pending == 0:
+                self.done.set()
+
+    def run(self, env: dict, timeout: float) -> float:
+        self.telegram.start()
+        bot = subprocess.Popen([sys.executable, 'main.py'], cwd=ROOT, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, env=dict(env, CREMAET_TELEGRAM_API=self.telegram.url))
+        try:
+            if not self.telegram.first_get_updates.wait(timeout=60):
+                raise RuntimeError('The bot did not start polling in 60 seconds')
+            started = time.perf_counter()
+            with self.lock:
+                for chat in self.stream:
+                    self.push_next(chat)
+            if not self.done.wait(timeout=timeout):
+                raise RuntimeError(f'The replay did not finish in {timeout} seconds, {self.pending} chats waiting')
+            return time.perf_counter() - started
+        finally:
+            bot.kill()
+            bot.wait()
+            self.telegram.stop()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def report(latencies: Dict[str, List[float]], elapsed: float) -> dict:
+    total = sum(len(values) for values in latencies.values())
+    result = {'updates': total, 'seconds': elapsed, 'updates_per_second': total / elapsed, 'handlers': dict()}
+    for kind, values in sorted(latencies.items()):
+        result['handlers'][kind] = {'count': len(values), 'p50_ms': percentile(values, 0.5) * 1000,
+                                    'p90_ms': percentile(values, 0.9) * 1000,
+                                    'p99_ms': percentile(values, 0.99) * 1000,
+                                    'mean_ms': statistics.mean(values) * 1000}
+    return result
+
+
+def print_report(result: dict) -> None:
+    print(f"{result['updates']} updates in {result['seconds']:.2f}s, {result['updates_per_second']:.1f} updates/s")
+    print(f"{'handler':<16}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for kind, stats in result['handlers'].items():
+        print(f"{kind:<16}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['mean_ms']:>10.1f}")
+
+
+def bot_environment(db_path: str, telegram_limits: bool) -> dict:
+    env = dict(os.environ, CREMAET_DB_BACKEND='sqlite', CREMAET_SQLITE_PATH=db_path,
+               CREAMET_TELEGRAM_TOKEN='bench', CREMAET_POLL_TIMEOUT='1')
+    if not telegram_limits:
+        env.update(CREMAET_GLOBAL_RATE='100000', CREMAET_CHAT_RATE='100000', CREMAET_CHAT_BURST='100000',
+                   CREMAET_GROUP_RATE_PER_MIN='6000000')
+    return env
+
+
+def seed_database(db_path: str, chats: List[int]) -> None:
+    # the history of backup.csv in the group of every chat, imported before the bot starts
+    seed = (f'import os; os.environ.update(CREMAET_DB_BACKEND="sqlite", CREMAET_SQLITE_PATH={db_path!r}); '
+            f'from db_manager import DBManager; from importer import import_events; '
+            f'[import_events("backup.csv", DBManager().get_group_id(chat)) for chat in {chats!r}]')
+    subprocess.run([sys.executable, '-c', seed], cwd=ROOT, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def main(argv: Optional[List[str]] = None) -> dict:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chats', type=int, default=20)
+    parser.add_argument('--updates', type=int, default=10, help='updates per chat')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--telegram-limits', action='store_true')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'replay.sqlite')
+        stream = generate_stream(args.chats, args.updates, args.seed)
+        seed_database(db_path, list(stream))
+        replay = Replay(stream)
+        elapsed = replay.run(bot_environment(db_path, args.telegram_limits), args.timeout)
+    result = report(replay.latencies, elapsed)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+    return result
+
+
+if __name__ == '__main__':
+    main()
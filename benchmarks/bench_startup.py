@@ -0,0 +1,64 @@
+"""
+Cold start of the bot: time to import main.py and time from the start of the process
+to its first getUpdates, answered by a local fake telegram server.
+The bot runs over the in-memory sqlite backend, so no MariaDB is needed.
+
+    python -m benchmarks.bench_startup [--runs N] [--max-seconds S]
+
+With --max-seconds the exit code is 1 when the median time to the first getUpdates is slower.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.fake_telegram import FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_MAIN = 'import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)'
+
+
+def import_time() -> float:
+    output = subprocess.run([sys.executable, '-c', IMPORT_MAIN], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def first_get_updates_time() -> float:
+    telegram = FakeTelegram().start()
+    env = dict(os.environ, CREMAET_TELEGRAM_API=telegram.url,
+               CREAMET_TELEGRAM_TOKEN='bench', CREMAET_POLL_TIMEOUT='0', CREMAET_DB_BACKEND='memory')
+    started = time.perf_counter()
+    bot = subprocess.Popen([sys.executable, 'main.py'], cwd=ROOT, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not telegram.first_get_updates.wait(timeout=60):
+            raise RuntimeError('The bot did not call getUpdates in 60 seconds')
+        return time.perf_counter() - started
+    finally:
+        bot.kill()
+        bot.wait()
+        telegram.stop()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=None)
+    args = parser.parse_args()
+
+    imports = [import_time() for _ in range(args.runs)]
+    first_polls = [first_get_updates_time() for _ in range(args.runs)]
+    print(f'import main: median {statistics.median(imports) * 1000:.0f} ms, max {max(imports) * 1000:.0f} ms')
+    print(f'first getUpdates: median {statistics.median(first_polls) * 1000:.0f} ms, '
+          f'max {max(first_polls) * 1000:.0f} ms')
+    if args.max_seconds is not None and statistics.median(first_polls) > args.max_seconds:
+        print(f'Slower than {args.max_seconds} s')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
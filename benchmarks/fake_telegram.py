@@ -0,0 +1,124 @@
+"""
+Local stand-in for the telegram bot API, enough for the bot to run against it:
+getUpdates serves the updates pushed by the benchmark, sendMessage and sendPhoto are recorded.
+"""
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, List, Optional
+
+
+class FakeTelegram:
+
+    def __init__(self, on_send: Optional[Callable[[str, dict, float], None]] = None):
+        # on_send(method, payload, time) is called for every sendMessage and sendPhoto
+        self.on_send = on_send
+        self.updates: Deque[dict] = deque()
+        self.condition = threading.Condition()
+        self.next_update_id = 1
+        self.get_updates_calls = 0
+        self.first_get_updates = threading.Event()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self) -> 'FakeTelegram':
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        with self.condition:
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push(self, update: dict) -> int:
+        # Queues an update for the next getUpdates, returns its update_id
+        with self.condition:
+            update = dict(update, update_id=self.next_update_id)
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.condition.notify_all()
+        return update['update_id']
+
+    def _get_updates(self, payload: dict) -> List[dict]:
+        self.get_updates_calls += 1
+        self.first_get_updates.set()
+        deadline = time.monotonic() + float(payload.get('timeout') or 0)
+        with self.condition:
+            while not self.updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self.condition.wait(timeout=remaining)
+            batch = []
+            while self.updates and len(batch) < 100:
+                batch.append(self.updates.popleft())
+            return batch
+
+    def _send(self, method: str, payload: dict) -> dict:
+        if self.on_send is not None:
+            self.on_send(method, payload, time.perf_counter())
+        result = {'message_id': 1, 'chat': {'id': payload.get('chat_id')}}
+        if method == 'sendPhoto':
+            result['photo'] = [{'file_id': 'fake-photo-file-id'}]
+        return result
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle(self):
+                try:
+                    super().handle()
+                except ConnectionResetError:
+                    # keep-alive connection closed by a killed bot
+                    pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                payload = _parse_payload(self.headers.get('Content-Type', ''), body)
+                if method == 'getUpdates':
+                    result = fake._get_updates(payload)
+                else:
+                    result = fake._send(method, payload)
+                response = json.dumps({'ok': True, 'result': result}).encode()
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(response)))
+                    self.end_headers()
+                    self.wfile.write(response)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the bot was stopped in the middle of the call
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def _parse_payload(content_type: str, body: bytes) -> dict:
+    if content_type.startswith('application/json'):
+        return json.loads(body or b'{}')
+    if content_type.startswith('multipart/form-data'):
+        # uploads, only the text fields are kept
+        boundary = content_type.split('boundary=')[-1].encode()
+        payload = dict()
+        for part in body.split(b'--' + boundary):
+            head, _, value = part.partition(b'\r\n\r\n')
+            if b'name="' not in head or b'filename=' in head:
+                continue
+            name = head.split(b'name="')[1].split(b'"')[0].decode()
+            payload[name] = value.rstrip(b'\r\n').decode(errors='replace')
+        return payload
+    return dict()
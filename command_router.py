@@ -0,0 +1,107 @@
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+
+def parse_date(token: str) -> datetime:
+    # dd/mm/yyyy, the same dates strptime('%d/%m/%Y') accepts without its format parsing
+    day, month, year = token.split('/')
+    if not (day.isdigit() and month.isdigit() and year.isdigit()) or len(year) != 4 \
+            or len(day) > 2 or len(month) > 2:
+        raise ValueError(f'{token} is not a dd/mm/yyyy date')
+    return datetime(int(year), int(month), int(day))
+
+
+def parse_timestamp(token: str) -> datetime:
+    # yyyymmddHHMMSS, compact enough for a callback_data
+    if len(token) != 14 or not token.isdigit():
+        raise ValueError(f'{token} is not a yyyymmddHHMMSS timestamp')
+    return datetime(int(token[:4]), int(token[4:6]), int(token[6:8]),
+                    int(token[8:10]), int(token[10:12]), int(token[12:]))
+
+
+def parse_amount(token: str) -> int:
+    # 12, 12.5 or 12,50 euros, in cents. Decimal comma or point, at most two decimals
+    units, _, decimals = token.replace(',', '.').partition('.')
+    if not units.isdigit() or (decimals and not decimals.isdigit()) or len(decimals) > 2:
+        raise ValueError(f'{token} is not an amount')
+    return int(units) * 100 + int(decimals.ljust(2, '0'))
+
+
+def parse_int(token: str) -> int:
+    if not token.isdigit():
+        raise ValueError(f'{token} is not a positive number')
+    return int(token)
+
+
+class Arg(NamedTuple):
+    """
+    Positional argument of a command. parse raises ValueError for a wrong token, then the command
+    answers with the error dialog if there is one, otherwise the default is used
+    """
+    name: str
+    parse: Callable[[str], Any] = str
+    default: Any = None
+    error: Optional[str] = None
+
+
+class Command(NamedTuple):
+    name: str
+    handler: Callable[..., None]
+    args: Tuple[Arg, ...]
+
+
+class BadArgument(ValueError):
+
+    def __init__(self, command: Command, arg: Arg, token: str):
+        super().__init__(f'{command.name}: wrong {arg.name} {token}')
+        self.command = command
+        self.arg = arg
+
+
+class CommandRouter:
+    """
+    Commands by their first token, a dict lookup per update whatever the number of commands.
+    A command can also be registered with two tokens ('/log older'), those are looked up first.
+    The texts and the callback_data go through the same path
+    """
+
+    def __init__(self):
+        self.commands: Dict[str, Command] = dict()
+
+    def register(self, name: str, handler: Callable[..., None], *args: Arg) -> None:
+        self.commands[name] = Command(name, handler, args)
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        tokens = text.split()
+        # in groups telegram appends the bot name: /log@cremaet_bot
+        if tokens and tokens[0].startswith('/'):
+            tokens[0] = tokens[0].split('@', 1)[0]
+        return tokens
+
+    def resolve(self, text: str) -> Tuple[Optional[Command], List[str]]:
+        # The command of a text and its argument tokens, None if it is not a command
+        tokens = self.tokenize(text)
+        if not tokens:
+            return None, tokens
+        if len(tokens) > 1:
+            command = self.commands.get(f'{tokens[0]} {tokens[1]}')
+            if command is not None:
+                return command, tokens[2:]
+        return self.commands.get(tokens[0]), tokens[1:]
+
+    @staticmethod
+    def parse_args(command: Command, tokens: List[str]) -> Dict[str, Any]:
+        # Raises BadArgument for a wrong token of an argument with an error dialog, extra tokens are ignored
+        values = dict()
+        for index, arg in enumerate(command.args):
+            if index >= len(tokens):
+                values[arg.name] = arg.default
+                continue
+            try:
+                values[arg.name] = arg.parse(tokens[index])
+            except ValueError:
+                if arg.error is not None:
+                    raise BadArgument(command, arg, tokens[index])
+                values[arg.name] = arg.default
+        return values
@@ -3,13 +3,61 @@
 export CREMAET_DATABASE=cremaet
 export CREMAET_DEBUG=true
 export CREMAET_TEST_DATABASE=cremaet_test
+export CREMAET_DB_BACKEND=mariadb
+export CREMAET_DB_DRIVER=pymysql
+export CREMAET_SQLITE_PATH=cremaet.sqlite
 export CREMAET_DB_USER=burned_master
 export CREMAET_DB_PASSWORD="not a real password lol"
 export CREMAET_DB_HOST=localhost
 export CREMAET_DB_PORT=3306
+export CREMAET_DB_POOL_SIZE=8
+export CREMAET_DB_MAX_OVERFLOW=4
+export CREMAET_DB_POOL_TIMEOUT=10
+export CREMAET_DB_POOL_RECYCLE=3600
 export CREMAET_API_ERROR_SLEEP=0.8
-export CREMAET_NO_MESSAGE_TIME=0.8
+export CREMAET_BACKOFF_CAP=30
+export CREMAET_RETRY_BUDGET_RATIO=0.2
+export CREMAET_TELEGRAM_MAX_ATTEMPTS=5
+export CREMAET_BREAKER_FAILURES=5
+export CREMAET_BREAKER_RESET=1
+export CREMAET_UPDATE_MODE=polling
+export CREMAET_POLL_TIMEOUT=30
+export CREMAET_REPOLL_INTERVAL=0.2
+export CREMAET_DEDUP_WINDOW_HOURS=24
+export CREMAET_WORKER_PROCESSES=1
+export CREMAET_WORKER_START_TIMEOUT=60
+export CREMAET_WORKER_RESTARTS=5
+export CREMAET_WEBHOOK_URL=''
+export CREMAET_WEBHOOK_SECRET=''
+export CREMAET_WEBHOOK_PATH=/telegram
+export CREMAET_WEBHOOK_HOST=0.0.0.0
+export CREMAET_WEBHOOK_PORT=8443
+export CREMAET_WORKER_THREADS=8
+export CREMAET_HTTP_POOL_SIZE=10
+export CREMAET_HTTP_CONNECT_TIMEOUT=5
+export CREMAET_HTTP_READ_TIMEOUT=10
+export CREMAET_GLOBAL_RATE=30
+export CREMAET_CHAT_RATE=1
+export CREMAET_GROUP_RATE_PER_MIN=20
+export CREMAET_CHAT_BURST=3
+export CREMAET_SENDER_THREADS=4
+export CREMAET_LOG_LEVEL=INFO
+export CREMAET_LOG_DIR=''
+export CREMAET_LOG_QUEUE_SIZE=10000
+export CREMAET_LOG_MAX_PAGE_SIZE=50
+export CREMAET_EVENT_WEEKDAYS=4
+export CREMAET_EVENT_EVERY_N_WEEKS=1
+export CREMAET_MAX_FORECAST=52
+export CREMAET_IMPORT_CHUNK_SIZE=5000
+export CREMAET_USER_CACHE_SIZE=1024
+export CREMAET_USER_CACHE_TTL=300
+export CREMAET_RESPONSE_CACHE_SIZE=256
+# chat id of the group the rows of a schema 1 database belong to
+export CREMAET_LEGACY_CHAT_ID=''
+export CREMAET_METRICS_PORT=
+export CREMAET_METRICS_HOST=127.0.0.1
 export CREMAET_ADMIN_PASSWORD='not by any chance'
+export CREMAET_TELEGRAM_API=https://api.telegram.org
 export CREAMET_TELEGRAM_TOKEN=''
 
 
@@ -0,0 +1,79 @@
+import itertools
+import os
+import sqlite3
+from typing import Optional
+
+import sqlalchemy
+
+BACKENDS = ('mariadb', 'sqlite', 'memory')
+# every memory engine gets its own database
+_memory_databases = itertools.count()
+
+
+def create_engine(backend: Optional[str] = None) -> sqlalchemy.engine.Engine:
+    """
+    Engine of the configured storage backend (CREMAET_DB_BACKEND):
+    mariadb, the production database; sqlite, a local file in WAL mode;
+    memory, an in-memory sqlite database that lives as long as its engine, for tests and load testing
+    """
+    backend = (backend or os.environ.get('CREMAET_DB_BACKEND', 'mariadb')).lower()
+    if backend == 'mariadb':
+        return _mariadb_engine()
+    if backend == 'sqlite':
+        return _sqlite_engine(os.environ.get('CREMAET_SQLITE_PATH', 'cremaet.sqlite'))
+    if backend == 'memory':
+        return _sqlite_engine(None)
+    raise ValueError(f'Unknown database backend {backend}, choose one of {", ".join(BACKENDS)}')
+
+
+def _mariadb_engine() -> sqlalchemy.engine.Engine:
+    db_name = os.environ.get('CREMAET_DATABASE')
+    if os.environ.get('CREMAET_DEBUG', 'true').lower() == 'true':
+        db_name = os.environ['CREMAET_TEST_DATABASE']
+    # pymysql by default, mysqldb or mariadbconnector can be compared with CREMAET_DB_DRIVER
+    driver = os.environ.get('CREMAET_DB_DRIVER', 'pymysql')
+    dialect = 'mariadb' if driver == 'mariadbconnector' else 'mysql'
+    connection_str = (f"{dialect}+{driver}://{os.environ['CREMAET_DB_USER']}:"
+                      f"{os.environ['CREMAET_DB_PASSWORD']}@{os.environ['CREMAET_DB_HOST']}:"
+                      f"{os.environ['CREMAET_DB_PORT']}/{db_name}")
+    # The pool is shared by the handler and sender threads, the connections are checked before use
+    # and renewed before the server closes them for being idle
+    return sqlalchemy.create_engine(connection_str,
+                                    pool_size=int(os.environ.get('CREMAET_DB_POOL_SIZE', 8)),
+                                    max_overflow=int(os.environ.get('CREMAET_DB_MAX_OVERFLOW', 4)),
+                                    pool_timeout=float(os.environ.get('CREMAET_DB_POOL_TIMEOUT', 10)),
+                                    pool_recycle=int(os.environ.get('CREMAET_DB_POOL_RECYCLE', 3600)),
+                                    pool_pre_ping=True)
+
+
+def _sqlite_engine(path: Optional[str]) -> sqlalchemy.engine.Engine:
+    # the connections are used by several threads, one at a time. A writer waits for the lock
+    # instead of failing right away
+    connect_args = {'check_same_thread': False, 'timeout': float(os.environ.get('CREMAET_DB_POOL_TIMEOUT', 10))}
+    keeper = None
+    if path is None:
+        # Every thread gets its own connection to a named in-memory database (memdb, sqlite >= 3.36), so each
+        # unit of work is its own transaction. The database is dropped with its last connection, the keeper
+        # holds it while the engine exists. Unlike a file in WAL mode, the readers wait for an open writer
+        url = f'file:/cremaet-{os.getpid()}-{next(_memory_databases)}?vfs=memdb'
+        keeper = sqlite3.connect(url, uri=True, check_same_thread=False)
+        url = f'{url}&uri=true'
+    else:
+        url = path
+    engine = sqlalchemy.create_engine(f'sqlite:///{url}', connect_args=connect_args,
+                                      pool_size=int(os.environ.get('CREMAET_DB_POOL_SIZE', 8)),
+                                      max_overflow=int(os.environ.get('CREMAET_DB_MAX_OVERFLOW', 4)))
+
+    # the listener lives as long as the engine, so does the keeper of a memory database
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def _configure_connection(dbapi_connection, connection_record, keeper=keeper):
+        cursor = dbapi_connection.cursor()
+        # the foreign keys are checked like in mariadb
+        cursor.execute('PRAGMA foreign_keys=ON')
+        if path is not None:
+            # readers do not block the writer
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+    return engine
@@ -1,25 +1,46 @@
-from datetime import datetime
-from typing import Optional, Type, List
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from threading import Lock, local
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple, Type, List
+
+import os
 
 import sqlalchemy
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DisconnectionError, IntegrityError, OperationalError
 from sqlalchemy.orm import Query
-from sqlalchemy_utils import database_exists, drop_database
 
-from db_tables import Base, Participant
-from db_tables import User, Participant, Event, StatusEnum
+from db_tables import Base, Participant, SchemaVersion, SCHEMA_VERSION
+from db_tables import User, ChatGroup, Participant, Event, LastPayment, MediaFile, StatusEnum
+from db_tables import Balance, ProcessedUpdate, UpdateOffset
+import metrics
+from resilience import CircuitBreaker, CircuitOpenError
+from user_cache import CachedUser, UserCache
 from utils import create_logger, create_database_session
 
 
 class Singleton(type):
     _instances = {}
+    # the first call can come from several handler threads at once, in a worker process
+    _lock = Lock()
 
     def __call__(cls, *args, **kwargs):
         if cls not in cls._instances:
-            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+            with cls._lock:
+                if cls not in cls._instances:
+                    cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
 
+class EventLogRow(NamedTuple):
+    # Plain row of the event log, display_name is None for holidays
+    event_id: int
+    date: datetime
+    display_name: Optional[str]
+    not_available: bool
+
+
 class DBManager(metaclass=Singleton):
 
     def __init__(self):
@@ -27,176 +48,802 @@ class DBManager(metaclass=Singleton):
         self.session = session
         self.engine = engine
         self.logger = create_logger(__file__)
-
+        self._local = local()
+        # a user can write in chats handled by different worker processes, the changes made by the others
+        # would not be seen, so the users are not cached
+        self.users = UserCache(0 if int(os.environ.get('CREMAET_WORKER_PROCESSES', 1)) > 1 else None)
+        # telegram chat id -> group_id, the groups are never deleted
+        self._group_ids: Dict[int, int] = dict()
+        # Data version of every group, bumped by every change of its events or participants: the answers
+        # cached for an older version are stale. The versions come from one clock, a reconnect moves
+        # the floor of all of them
+        self._data_clock = 0
+        self._data_floor = 0
+        self._data_versions: Dict[int, int] = dict()
+        self._data_version_lock = Lock()
+        # hours telegram can send an update again, the processed updates are remembered that long
+        self.dedup_window = timedelta(hours=float(os.environ.get('CREMAET_DEDUP_WINDOW_HOURS', 24)))
+        self._processed_pruned_at: Optional[datetime] = None
+        # fed by the errors of every method, refuses the units of work while the database is down
+        self.breaker = CircuitBreaker('database')
+        metrics.instrument_engine(self.engine)
+
+        # One query on a normal start, the database and the tables are only created when the version differs
+        if self.get_schema_version() != SCHEMA_VERSION:
+            self.bootstrap()
+
+    def get_schema_version(self) -> Optional[int]:
+        try:
+            version = self.session.query(sqlalchemy.func.max(SchemaVersion.version)).scalar()
+        except Exception:
+            # no database or no version table yet
+            self.session.rollback()
+            version = None
+        if version is None:
+            try:
+                # the tables of the first schema had no version table
+                return 1 if sqlalchemy.inspect(self.engine).has_table(Participant.__tablename__) else None
+            except Exception:
+                return None
+        return version
+
+    def bootstrap(self) -> None:
+        self.logger.warning(f'Bootstrapping the database schema version {SCHEMA_VERSION}')
+        # only needed the first time, it is slow to import
+        from sqlalchemy_utils import database_exists, create_database
+        # sqlite creates its database when connecting
+        if self.engine.dialect.name != 'sqlite' and not database_exists(self.engine.url):
+            create_database(self.engine.url)
+        version = self.get_schema_version()
         Base.metadata.create_all(self.engine)
+        if version == 1:
+            self._migrate_to_groups()
+        event_columns = {column['name'] for column in sqlalchemy.inspect(self.engine).get_columns(Event.__tablename__)}
+        if 'amount_cents' not in event_columns:
+            # create_all does not add columns, the balances are built by check_turn_state
+            self.session.execute(sqlalchemy.text('ALTER TABLE Event ADD COLUMN amount_cents INTEGER NULL'))
+        self.session.merge(SchemaVersion(version=SCHEMA_VERSION))
+        self._commit()
+
+    def _migrate_to_groups(self) -> None:
+        # Schema 1 had a single rotation, its participants and events go to the group of CREMAET_LEGACY_CHAT_ID
+        dialect = self.engine.dialect.name
+        if dialect not in ('mysql', 'mariadb', 'sqlite'):
+            raise NotImplementedError(f'The migration from the schema version 1 is not implemented for {dialect}')
+        chat_id = os.environ.get('CREMAET_LEGACY_CHAT_ID')
+        if not chat_id:
+            raise RuntimeError('Set CREMAET_LEGACY_CHAT_ID to the telegram chat of the existing rotation')
+        self.logger.warning(f'Moving the existing rotation to the group of the chat {chat_id}')
+        if dialect == 'sqlite':
+            self._rebuild_sqlite_tables(int(chat_id))
+            return
+        group = ChatGroup(telegram_chat_id=int(chat_id))
+        self.session.add(group)
+        self.session.flush()
+        # the unique columns of the version 1 have an index named after them
+        for table, unique_column, unique_name, extra in (
+                ('Participant', 'display_name', 'uq_participant_group_name', ''),
+                ('Event', 'date', 'uq_event_group_date', ', ADD INDEX ix_event_participant_date (participant, date)')):
+            self.session.execute(sqlalchemy.text(f'ALTER TABLE `{table}` ADD COLUMN group_id INTEGER NULL'))
+            self.session.execute(sqlalchemy.text(f'UPDATE `{table}` SET group_id = :group_id'),
+                                 {'group_id': group.group_id})
+            self.session.execute(sqlalchemy.text(
+                f'ALTER TABLE `{table}` MODIFY group_id INTEGER NOT NULL, DROP INDEX {unique_column}, '
+                f'ADD CONSTRAINT {unique_name} UNIQUE (group_id, {unique_column}), '
+                f'ADD FOREIGN KEY (group_id) REFERENCES ChatGroup (group_id){extra}'))
+
+    def _rebuild_sqlite_tables(self, chat_id: int) -> None:
+        # sqlite can not change the constraints of a table: Participant and Event are created again with the group
+        # and their rows copied, with the foreign keys off meanwhile (https://www.sqlite.org/lang_altertable.html)
+        from sqlalchemy.schema import CreateIndex, CreateTable
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+            connection.commit()
+            try:
+                group_id = connection.execute(sqlalchemy.insert(ChatGroup).values(telegram_chat_id=chat_id)) \
+                    .inserted_primary_key[0]
+                for table, columns in ((Participant.__table__, 'participant_id, display_name, join_date'),
+                                       (Event.__table__, 'event_id, participant, date, not_available')):
+                    create = str(CreateTable(table).compile(self.engine))
+                    connection.exec_driver_sql(create.replace(f'"{table.name}"', f'"{table.name}_new"', 1))
+                    connection.execute(sqlalchemy.text(f'INSERT INTO "{table.name}_new" (group_id, {columns}) '
+                                                       f'SELECT :group_id, {columns} FROM "{table.name}"'),
+                                       {'group_id': group_id})
+                    connection.exec_driver_sql(f'DROP TABLE "{table.name}"')
+                    connection.exec_driver_sql(f'ALTER TABLE "{table.name}_new" RENAME TO "{table.name}"')
+                    for index in table.indexes:
+                        connection.execute(CreateIndex(index))
+                connection.commit()
+            finally:
+                connection.rollback()
+                connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+                connection.commit()
 
     def clean_tables(self) -> None:
         self.session.query(User).delete()
+        self.session.query(LastPayment).delete()
+        self.session.query(Balance).delete()
         self.session.query(Event).delete()
         self.session.query(Participant).delete()
-        self.session.commit()
+        self.session.query(ChatGroup).delete()
+        self._commit()
+        self.users = UserCache(self.users.max_size)
+        self._group_ids.clear()
+        self._bump_data_version()
 
     def __delete_database(self) -> None:
+        from sqlalchemy_utils import database_exists, drop_database
         if database_exists(self.engine.url):
             drop_database(self.engine.url)
 
-    def reconnect(self):
+    def reconnect(self, error: Optional[Exception] = None):
         # This method exectutes when there is a fatal error with the database
-        # is the same steps as __init__
-        # TODO - find the best way to perform this without warnings
-        session, engine = create_database_session()
-        self.session = session
-        self.engine = engine
+        # The session of the thread is discarded and its connection goes back to the pool,
+        # the pool checks the connections before using them again.
+        # Inside a unit of work the whole unit is rolled back and the session discarded at its end
+        metrics.RECONNECTS.inc('error')
+        unavailable = self._is_unavailable(error)
+        if unavailable:
+            self.breaker.record_failure()
+        # the answers computed while the database failed are not trusted
+        self._bump_data_version()
+        if getattr(self._local, 'in_unit_of_work', False):
+            self._local.failed = True
+            self._local.unavailable = self._local.unavailable or unavailable
+            return
+        self.session.remove()
+
+    @staticmethod
+    def _is_unavailable(error: Optional[Exception]) -> bool:
+        # Only the lost connections and the operational errors count against the breaker, not a wrong query or input
+        return error is None or isinstance(error, (OperationalError, DisconnectionError)) \
+            or getattr(error, 'connection_invalidated', False)
+
+    def _rollback(self) -> None:
+        # A failed method discards its changes, inside a unit of work the changes of the whole unit:
+        # rolling back the shared session would also discard the earlier methods, and the later ones would commit
+        if getattr(self._local, 'in_unit_of_work', False):
+            self._local.failed = True
+        else:
+            self.session.rollback()
+
+    @contextmanager
+    def unit_of_work(self):
+        """
+        Groups every database change of the thread in one transaction, committed at the end of the block
+        or rolled back if it raises or if any method failed on the way. The session is released afterwards
+        so its connection returns to the pool.
+        Raises CircuitOpenError without touching the database while it is down
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(self.breaker)
+        self._local.in_unit_of_work = True
+        self._local.after_commit = []
+        self._local.on_rollback = []
+        self._local.failed = False
+        self._local.unavailable = False
+        try:
+            yield self
+            if self._local.failed:
+                # the objects added after the failure are discarded with the rest
+                self.session.expunge_all()
+                self.session.rollback()
+            else:
+                self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            self._discard_unit_of_work()
+            if self._is_unavailable(e) and not self._local.unavailable:
+                self.breaker.record_failure()
+            elif not self._local.unavailable:
+                self.breaker.record_success()
+            raise
+        else:
+            # the errors of the methods were already counted by reconnect
+            if not self._local.unavailable:
+                self.breaker.record_success()
+            if self._local.failed:
+                self.logger.warning('A database change failed, the whole unit of work was rolled back')
+                self._discard_unit_of_work()
+            else:
+                for callback in self._local.after_commit:
+                    callback()
+        finally:
+            self._local.in_unit_of_work = False
+            self._local.after_commit = []
+            self._local.on_rollback = []
+            self.session.remove()
+
+    def _discard_unit_of_work(self) -> None:
+        for callback in self._local.on_rollback:
+            callback()
+        self._local.on_rollback = []
+
+    def _commit(self) -> None:
+        # Inside a unit of work the changes are only flushed, the commit happens at its end
+        if getattr(self._local, 'in_unit_of_work', False):
+            self.session.flush()
+        else:
+            self.session.commit()
+
+    def data_version(self, group_id: int) -> int:
+        with self._data_version_lock:
+            return max(self._data_floor, self._data_versions.get(group_id, 0))
+
+    def _bump_data_version(self, group_id: Optional[int] = None) -> None:
+        # Only the group changed, or all of them without a group
+        with self._data_version_lock:
+            self._data_clock += 1
+            if group_id is None:
+                self._data_floor = self._data_clock
+            else:
+                self._data_versions[group_id] = self._data_clock
+
+    def _data_changed(self, group_id: Optional[int]) -> None:
+        # Bumped right away for this thread, after the commit for the others and also if it rolls back,
+        # an answer computed from the uncommitted changes must not outlive them
+        bump = lambda: self._bump_data_version(group_id)
+        self._after_commit(bump)
+        if getattr(self._local, 'in_unit_of_work', False):
+            self._local.on_rollback.append(bump)
+
+    def on_commit(self, callback: Callable[[], None]) -> None:
+        # Runs the callback once the unit of work of the thread committed, right away outside of one.
+        # It is dropped if the unit of work rolls back
+        if getattr(self._local, 'in_unit_of_work', False):
+            self._local.after_commit.append(callback)
+        else:
+            callback()
+
+    def _after_commit(self, callback: Callable[[], None]) -> None:
+        # Runs the callback once the changes are visible to the other threads
+        callback()
+        if getattr(self._local, 'in_unit_of_work', False):
+            self._local.after_commit.append(callback)
 
     ########
     #
     # USER METHODS
     #
     ########
-    def add_user(self, telegram_id, first_name, last_name=None, is_admin=False) -> Optional[User]:
+    def add_user(self, telegram_id, first_name, last_name=None, is_admin=False) -> Optional[CachedUser]:
         try:
             new_user = User(telegram_id=telegram_id, first_name=first_name,
-                            last_name=last_name, is_admin=is_admin)
+                            last_name=last_name, is_admin=is_admin, status=StatusEnum.MAIN_MENU)
             self.session.add(new_user)
-            self.session.commit()
-            return new_user
+            self._commit()
+            cached_user = CachedUser.from_user(new_user)
+            self._write_user(cached_user)
+            return cached_user
         except IntegrityError as ie:
-            self.reconnect()
+            self._rollback()
             self.logger.error(ie)
             return None
         except Exception as e:
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return None
 
-    def get_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
+    def get_user_by_telegram_id(self, telegram_id: int) -> Optional[CachedUser]:
+        cached_user = self.users.get(telegram_id)
+        if cached_user is not None:
+            return cached_user
         try:
             user = self.session.query(User).filter_by(telegram_id=telegram_id).one_or_none()
-            return user
+            if user is None:
+                return None
+            cached_user = CachedUser.from_user(user)
+            self.users.put(cached_user)
+            return cached_user
         except Exception as e:
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return None
 
     def get_all_users(self):
         return self.session.query(User).all()
 
-    def change_user_status(self, user: User, status: StatusEnum) -> bool:
+    def change_user_status(self, user: CachedUser, status: StatusEnum) -> bool:
+        # the cache is written through, so an unchanged status needs no query
+        if user.status == status and self.users.get(user.telegram_id) == user:
+            return True
         try:
             self.session.query(User).filter_by(user_id=user.user_id).update({'status': status})
-            self.session.commit()
+            self._commit()
+            self._write_user(user._replace(status=status))
             return True
         except Exception as e:
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return False
 
-    def promote_to_admin(self, user: User):
+    def promote_to_admin(self, user: CachedUser):
         try:
-            user.is_admin = True
-            self.session.commit()
+            self.session.query(User).filter_by(user_id=user.user_id).update({'is_admin': True})
+            self._commit()
+            self._write_user(user._replace(is_admin=True))
+            return True
         except Exception as e:
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return False
 
-    def add_participant(self, display_name: str, join_date: datetime.date) -> Optional[Participant]:
+    def _write_user(self, user: CachedUser) -> None:
+        self.users.put(user)
+        # a unit of work that does not commit must not leave its changes in the cache
+        if getattr(self._local, 'in_unit_of_work', False):
+            self._local.on_rollback.append(lambda: self.users.invalidate(user.telegram_id))
+
+    ########
+    #
+    # GROUP METHODS
+    #
+    ########
+    def get_group_id(self, telegram_chat_id: int, title: Optional[str] = None) -> Optional[int]:
+        # group_id of a telegram chat, the group is created the first time the chat talks to the bot
+        group_id = self._group_ids.get(telegram_chat_id)
+        if group_id is not None:
+            return group_id
         try:
-            new_participant = Participant(display_name=display_name, join_date=join_date)
+            group_id = self.session.query(ChatGroup.group_id).filter_by(telegram_chat_id=telegram_chat_id).scalar()
+            if group_id is None:
+                group = ChatGroup(telegram_chat_id=telegram_chat_id, title=title)
+                self.session.add(group)
+                self._commit()
+                group_id = group.group_id
+            if getattr(self._local, 'in_unit_of_work', False):
+                # the group could have been created by this unit of work, a rolled back group must not stay in memory
+                self._local.after_commit.append(lambda: self._group_ids.__setitem__(telegram_chat_id, group_id))
+                self._local.on_rollback.append(lambda: self._group_ids.pop(telegram_chat_id, None))
+            else:
+                self._group_ids[telegram_chat_id] = group_id
+            return group_id
+        except IntegrityError as ie:
+            # created by another worker meanwhile, a unit of work is rolled back and the next update finds it
+            self._rollback()
+            self.logger.error(ie)
+            if getattr(self._local, 'in_unit_of_work', False):
+                return None
+            return self.session.query(ChatGroup.group_id).filter_by(telegram_chat_id=telegram_chat_id).scalar()
+        except Exception as e:
+            self.logger.error(e)
+            self.reconnect(e)
+            return None
+
+    ########
+    #
+    # PARTICIPANT METHODS
+    #
+    ########
+    def add_participant(self, group_id: int, display_name: str, join_date: datetime.date) -> Optional[Participant]:
+        try:
+            new_participant = Participant(group_id=group_id, display_name=display_name, join_date=join_date)
             self.session.add(new_participant)
-            self.session.commit()
+            self._commit()
+            self._data_changed(group_id)
             return new_participant
         except IntegrityError as ie:
+            self._rollback()
             self.logger.error(ie)
             return None
         except Exception as e:
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return None
 
     def delete_participant_by_id(self, participant: Participant) -> bool:
         try:
-            self.session.query(Participant).filter_by(participant=participant.participant_id).one().delete()
-            return True
-        # Important - since the id is the pk, no multiple results can be found therefore
-        # sqlalchemy.orm.exc.MultipleResultsFound is impossible to trigger
-        except sqlalchemy.exc.NoResultFound as nrfe:
-            self.logger.error(nrfe)
+            self.session.query(LastPayment).filter_by(participant_id=participant.participant_id).delete()
+            self.session.query(Balance).filter_by(participant_id=participant.participant_id).delete()
+            deleted = self.session.query(Participant).filter_by(participant_id=participant.participant_id).delete()
+            self._commit()
+            self._data_changed(participant.group_id)
+            return deleted > 0
+        except IntegrityError as ie:
+            # the participant has events
+            self._rollback()
+            self.logger.error(ie)
             return False
         except Exception as e:
+            self._rollback()
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return False
 
-    def get_participant_by_id(self, participant_id: int) -> Optional[Participant]:
+    def get_participant_by_id(self, group_id: int, participant_id: int) -> Optional[Participant]:
         try:
-            participant = self.session.query(Participant).filter_by(participant_id=participant_id).one_or_none()
+            participant = self.session.query(Participant) \
+                .filter_by(group_id=group_id, participant_id=participant_id).one_or_none()
             return participant
         except Exception as e:
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return None
 
-    def get_participant_by_display_name(self, display_name) -> Optional[Participant]:
+    def get_participant_ids(self, group_id: int, display_names: Iterable[str],
+                            join_date: datetime.date) -> Optional[Dict[str, int]]:
+        # display_name -> participant_id in the group, the names not registered yet are created
+        # in the same transaction, in the given order
+        display_names = list(dict.fromkeys(display_names))
         try:
-            participant = self.session.query(Participant).filter_by(display_name=display_name).one_or_none()
+            ids = dict(self.session.query(Participant.display_name, Participant.participant_id)
+                       .filter(Participant.group_id == group_id, Participant.display_name.in_(display_names)).all())
+            new_participants = [Participant(group_id=group_id, display_name=name, join_date=join_date)
+                                for name in display_names if name not in ids]
+            if new_participants:
+                self.session.add_all(new_participants)
+                self._commit()
+                self._data_changed(group_id)
+                ids.update({p.display_name: p.participant_id for p in new_participants})
+            return ids
+        except Exception as e:
+            self._rollback()
+            self.logger.error(e)
+            self.reconnect(e)
+            return None
+
+    def get_participant_by_display_name(self, group_id: int, display_name: str) -> Optional[Participant]:
+        try:
+            participant = self.session.query(Participant) \
+                .filter_by(group_id=group_id, display_name=display_name).one_or_none()
             return participant
         except Exception as e:
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return None
 
-    def get_all_participants(self):
-        return self.session.query(Participant).all()
+    def get_all_participants(self, group_id: int):
+        return self.session.query(Participant).filter_by(group_id=group_id).all()
 
-    def add_event(self, participant: Optional[Participant], date: datetime.date, not_available: bool = False) -> Optional[Event]:
+    ########
+    #
+    # EVENT METHODS
+    #
+    ########
+    def add_event(self, group_id: int, participant: Optional[Participant], date: datetime.date,
+                  not_available: bool = False, amount_cents: Optional[int] = None) -> Optional[Event]:
         try:
             participant_id = participant.participant_id if participant else None
-            event = Event(participant=participant_id, date=date, not_available=not_available)
+            event = Event(group_id=group_id, participant=participant_id, date=date, not_available=not_available,
+                          amount_cents=amount_cents)
             self.session.add(event)
-            self.session.commit()
+            # the turn order and the balance are updated in the same transaction as the event
+            if participant_id is not None and not not_available:
+                last_payment = self.session.get(LastPayment, participant_id)
+                if last_payment is None:
+                    self.session.add(LastPayment(participant_id=participant_id, last_payment_date=date))
+                elif last_payment.last_payment_date < date:
+                    last_payment.last_payment_date = date
+                self._add_to_balance(participant_id, amount_cents or 0, 1)
+            self._commit()
+            self._data_changed(group_id)
             return event
         except IntegrityError as ie:
             self.logger.error(ie)
-            self.session.rollback()
-            self.reconnect()
+            self._rollback()
             return None
         except Exception as e:
-            self.session.rollback()
+            self._rollback()
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return None
 
+    def upsert_events(self, events: List[dict]) -> bool:
+        """
+        Bulk insert of events given as dicts with group_id, participant, date, not_available and amount_cents,
+        in one transaction. An event whose date already exists in its group replaces the old one, so importing
+        the same rows twice changes nothing.
+        The turn state and the balances are not updated, call check_turn_state after the import
+        """
+        if not events:
+            return True
+        dialect = self.engine.dialect.name
+        if dialect in ('mysql', 'mariadb'):
+            stmt = mysql_insert(Event)
+            # mysql does not write the row when the values are the same
+            stmt = stmt.on_duplicate_key_update(participant=stmt.inserted.participant,
+                                                not_available=stmt.inserted.not_available,
+                                                amount_cents=stmt.inserted.amount_cents)
+        elif dialect == 'sqlite':
+            stmt = sqlite_insert(Event)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Event.group_id, Event.date],
+                set_={'participant': stmt.excluded.participant, 'not_available': stmt.excluded.not_available,
+                      'amount_cents': stmt.excluded.amount_cents},
+                where=sqlalchemy.or_(Event.participant.is_distinct_from(stmt.excluded.participant),
+                                     Event.not_available.is_distinct_from(stmt.excluded.not_available),
+                                     Event.amount_cents.is_distinct_from(stmt.excluded.amount_cents)))
+        else:
+            raise NotImplementedError(f'Upserts are not implemented for {dialect}')
+        try:
+            self.session.execute(stmt, events)
+            self._commit()
+            for group_id in {event['group_id'] for event in events}:
+                self._data_changed(group_id)
+            return True
+        except Exception as e:
+            self._rollback()
+            self.logger.error(e)
+            self.reconnect(e)
+            return False
+
     def delete_event(self, event: Event) -> bool:
         try:
             self.session.query(Event).filter_by(event_id=event.event_id).delete()
+            if event.participant is not None and not event.not_available:
+                last_payment = self.session.get(LastPayment, event.participant)
+                # only the deletion of the last payment changes the turn order
+                if last_payment is not None and last_payment.last_payment_date == event.date:
+                    self._refresh_last_payment(event.participant)
+                self._add_to_balance(event.participant, -(event.amount_cents or 0), -1)
+            self._commit()
+            self._data_changed(event.group_id)
             return True
         except IntegrityError as ie:
+            self._rollback()
             self.logger.error(ie)
             return False
         except Exception as e:
+            self._rollback()
             self.logger.error(e)
-            self.reconnect()
+            self.reconnect(e)
             return False
 
-    def get_all_events(self):
-        return self.session.query(Event).order_by(Event.date.desc()).all()
+    def _refresh_last_payment(self, participant_id: int) -> None:
+        # Recomputes the last payment of one participant from the event table, does not commit
+        last_date = self.session.query(sqlalchemy.func.max(Event.date)) \
+            .filter(Event.participant == participant_id, Event.not_available.isnot(True)).scalar()
+        last_payment = self.session.get(LastPayment, participant_id)
+        if last_date is None:
+            if last_payment is not None:
+                self.session.delete(last_payment)
+        elif last_payment is None:
+            self.session.add(LastPayment(participant_id=participant_id, last_payment_date=last_date))
+        else:
+            last_payment.last_payment_date = last_date
+
+    def _add_to_balance(self, participant_id: int, amount_cents: int, payments: int) -> None:
+        # Adds to the balance of one participant in the database, two payments at once do not overwrite each other.
+        # Does not commit
+        updated = self.session.query(Balance).filter_by(participant_id=participant_id) \
+            .update({Balance.paid_cents: Balance.paid_cents + amount_cents,
+                     Balance.payments: Balance.payments + payments}, synchronize_session=False)
+        if not updated:
+            self.session.add(Balance(participant_id=participant_id, paid_cents=amount_cents, payments=payments))
+        elif payments < 0:
+            self.session.query(Balance).filter_by(participant_id=participant_id, payments=0).delete()
+
+    def _refresh_balance(self, participant_id: int) -> None:
+        # Recomputes the balance of one participant from the event table, does not commit
+        paid_cents, payments = self.session.query(sqlalchemy.func.coalesce(sqlalchemy.func.sum(Event.amount_cents), 0),
+                                                  sqlalchemy.func.count(Event.event_id)) \
+            .filter(Event.participant == participant_id, Event.not_available.isnot(True)).one()
+        balance = self.session.get(Balance, participant_id, populate_existing=True)
+        if not payments:
+            if balance is not None:
+                self.session.delete(balance)
+        elif balance is None:
+            self.session.add(Balance(participant_id=participant_id, paid_cents=paid_cents, payments=payments))
+        else:
+            balance.paid_cents, balance.payments = paid_cents, payments
+
+    def check_turn_state(self, repair: bool = True, group_id: Optional[int] = None) -> List[int]:
+        """
+        Compares the stored last payments and balances with the event table, returns the ids of the participants
+        whose state is wrong. With repair, the state is rebuilt from the events.
+        Every group is checked, or only the given one
+        """
+        expected_query = self.session.query(Event.participant, sqlalchemy.func.max(Event.date),
+                                            sqlalchemy.func.coalesce(sqlalchemy.func.sum(Event.amount_cents), 0),
+                                            sqlalchemy.func.count(Event.event_id)) \
+            .filter(Event.participant.isnot(None), Event.not_available.isnot(True))
+        stored_query = self.session.query(Participant.participant_id, LastPayment.last_payment_date,
+                                          Balance.paid_cents, Balance.payments) \
+            .outerjoin(LastPayment, LastPayment.participant_id == Participant.participant_id) \
+            .outerjoin(Balance, Balance.participant_id == Participant.participant_id) \
+            .filter(sqlalchemy.or_(LastPayment.participant_id.isnot(None), Balance.participant_id.isnot(None)))
+        if group_id is not None:
+            expected_query = expected_query.filter(Event.group_id == group_id)
+            stored_query = stored_query.filter(Participant.group_id == group_id)
+        expected: Dict[int, tuple] = {row[0]: tuple(row[1:]) for row in expected_query.group_by(Event.participant)}
+        stored: Dict[int, tuple] = {row[0]: tuple(row[1:]) for row in stored_query.all()}
+        wrong = sorted(participant_id for participant_id in set(expected) | set(stored)
+                       if expected.get(participant_id) != stored.get(participant_id))
+        if wrong and repair:
+            self.logger.warning(f'Rebuilding the turn state of the participants {wrong}')
+            try:
+                for participant_id in wrong:
+                    self._refresh_last_payment(participant_id)
+                    self._refresh_balance(participant_id)
+                self._commit()
+                self._data_changed(group_id)
+            except Exception as e:
+                self._rollback()
+                self.logger.error(e)
+                self.reconnect(e)
+        return wrong
+
+    def get_ranking(self, group_id: int, starting: Optional[datetime.date] = None,
+                    ending: Optional[datetime.date] = None) -> List[Tuple[str, int, Optional[datetime]]]:
+        """
+        (display_name, payment_count, last_payment_date) of every participant of the group in one query,
+        the ones that paid less first. Holidays are not payments. The dates limit the events counted
+        """
+        join_condition = [Event.participant == Participant.participant_id, Event.not_available.isnot(True)]
+        if starting is not None:
+            join_condition.append(Event.date >= starting)
+        if ending is not None:
+            join_condition.append(Event.date <= ending)
+        payment_count = sqlalchemy.func.count(Event.event_id)
+        try:
+            rows = self.session.query(Participant.display_name, payment_count, sqlalchemy.func.max(Event.date)) \
+                .filter(Participant.group_id == group_id) \
+                .outerjoin(Event, sqlalchemy.and_(*join_condition)) \
+                .group_by(Participant.participant_id, Participant.display_name) \
+                .order_by(payment_count.asc(), Participant.participant_id.asc()).all()
+            return [tuple(row) for row in rows]
+        except Exception as e:
+            self.logger.error(e)
+            self.reconnect(e)
+            return []
+
+    def get_balances(self, group_id: int) -> List[Tuple[str, int, int]]:
+        """
+        (display_name, paid_cents, payments) of every participant of the group, the ones that paid less money first.
+        Read from the balance table, the events are not summed
+        """
+        paid_cents = sqlalchemy.func.coalesce(Balance.paid_cents, 0)
+        payments = sqlalchemy.func.coalesce(Balance.payments, 0)
+        try:
+            rows = self.session.query(Participant.display_name, paid_cents, payments) \
+                .filter(Participant.group_id == group_id) \
+                .outerjoin(Balance, Balance.participant_id == Participant.participant_id) \
+                .order_by(paid_cents.asc(), payments.asc(), Participant.participant_id.asc()).all()
+            return [tuple(row) for row in rows]
+        except Exception as e:
+            self.logger.error(e)
+            self.reconnect(e)
+            return []
+
+    def get_last_payment_date(self, group_id: int) -> Optional[datetime]:
+        return self.session.query(sqlalchemy.func.max(LastPayment.last_payment_date)) \
+            .join(Participant, Participant.participant_id == LastPayment.participant_id) \
+            .filter(Participant.group_id == group_id).scalar()
+
+    def get_holidays(self, group_id: int, after: Optional[datetime.date] = None) -> List[datetime]:
+        # Dates of the not_available events of the group, only the ones after the given date if any
+        query = self.session.query(Event.date).filter(Event.group_id == group_id, Event.not_available.is_(True))
+        if after is not None:
+            query = query.filter(Event.date > after)
+        return [row.date for row in query.order_by(Event.date.asc()).all()]
+
+    def get_turn_order(self, group_id: int) -> List[str]:
+        # Display names in paying order: first the participants that never paid, newest first,
+        # then the rest from the oldest payment to the most recent one
+        rows = self.session.query(Participant.display_name) \
+            .filter(Participant.group_id == group_id) \
+            .outerjoin(LastPayment, LastPayment.participant_id == Participant.participant_id) \
+            .order_by(LastPayment.last_payment_date.is_(None).desc(), LastPayment.last_payment_date.asc(),
+                      Participant.participant_id.desc()).all()
+        return [row.display_name for row in rows]
+
+    def get_all_events(self, group_id: int):
+        return self.session.query(Event).filter_by(group_id=group_id).order_by(Event.date.desc()).all()
 
     def get_events_by_participant(self, participant: Participant):
-        return self.session.query(Event).filter_by(participant=participant.participant_id).all()
-
-    def get_events_between_dates(self, starting: datetime.date, ending: datetime.date):
-        return self.session.query(Event).filter(Event.date.between(starting, ending)).all()
-
-    def get_last_n_events(self, limit_rows: int) :
-        return self.session.query(Event).order_by(Event.date.desc()).limit(limit_rows).all()
-
-
-
-
+        return self.session.query(Event).filter_by(group_id=participant.group_id,
+                                                   participant=participant.participant_id).all()
+
+    def get_events_between_dates(self, group_id: int, starting: datetime.date, ending: datetime.date):
+        return self.session.query(Event) \
+            .filter(Event.group_id == group_id, Event.date.between(starting, ending)).all()
+
+    def get_last_n_events(self, group_id: int, limit_rows: int):
+        return self.session.query(Event).filter_by(group_id=group_id) \
+            .order_by(Event.date.desc()).limit(limit_rows).all()
+
+    def get_event_log(self, group_id: int, limit_rows: int, cursor: Optional[Tuple[datetime, int]] = None,
+                      newer: bool = False) -> List[EventLogRow]:
+        """
+        Events of the group with the name of the participant, newest first, in one query
+        and without building ORM objects.
+        The cursor is the (date, event_id) of a row already shown: only the events older than it are returned,
+        or the ones newer than it with newer. Keyset pagination, the cost does not grow with the depth of the page
+        """
+        query = self.session.query(Event.event_id, Event.date, Participant.display_name, Event.not_available) \
+            .outerjoin(Participant, Participant.participant_id == Event.participant) \
+            .filter(Event.group_id == group_id)
+        if cursor is not None:
+            cursor_date, cursor_id = cursor
+            if newer:
+                query = query.filter(sqlalchemy.or_(
+                    Event.date > cursor_date, sqlalchemy.and_(Event.date == cursor_date, Event.event_id > cursor_id)))
+            else:
+                query = query.filter(sqlalchemy.or_(
+                    Event.date < cursor_date, sqlalchemy.and_(Event.date == cursor_date, Event.event_id < cursor_id)))
+        if newer:
+            query = query.order_by(Event.date.asc(), Event.event_id.asc())
+        else:
+            query = query.order_by(Event.date.desc(), Event.event_id.desc())
+        try:
+            rows = [EventLogRow(*row) for row in query.limit(limit_rows).all()]
+        except Exception as e:
+            self.logger.error(e)
+            self.reconnect(e)
+            return []
+        # the newer events are read from the cursor upwards, they are returned newest first too
+        return rows[::-1] if newer else rows
 
+    ########
+    #
+    # UPDATE METHODS
+    #
+    ########
+    def is_update_processed(self, update_id: int) -> bool:
+        try:
+            return self.session.get(ProcessedUpdate, update_id) is not None
+        except Exception as e:
+            self.logger.error(e)
+            self.reconnect(e)
+            return False
 
+    def mark_update_processed(self, update_id: int) -> bool:
+        # Inside the unit of work of the update the mark commits with its changes, or none of them does
+        try:
+            self.session.add(ProcessedUpdate(update_id=update_id))
+            now = datetime.now()
+            if self._processed_pruned_at is None or now - self._processed_pruned_at > self.dedup_window / 24:
+                self._processed_pruned_at = now
+                self.session.query(ProcessedUpdate).filter(ProcessedUpdate.processed < now - self.dedup_window) \
+                    .delete(synchronize_session=False)
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            self.logger.error(e)
+            self.reconnect(e)
+            return False
 
+    def get_update_offset(self) -> Optional[int]:
+        try:
+            checkpoint = self.session.get(UpdateOffset, 1)
+            return checkpoint.next_update_id if checkpoint is not None else None
+        except Exception as e:
+            self.logger.error(e)
+            self.reconnect(e)
+            return None
 
+    def save_update_offset(self, offset: int) -> bool:
+        try:
+            self.session.merge(UpdateOffset(offset_id=1, next_update_id=offset))
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            self.logger.error(e)
+            self.reconnect(e)
+            return False
 
+    ########
+    #
+    # MEDIA METHODS
+    #
+    ########
+    def get_media_file(self, path: str) -> Optional[MediaFile]:
+        try:
+            return self.session.query(MediaFile).filter_by(path=path).one_or_none()
+        except Exception as e:
+            self.logger.error(e)
+            self.reconnect(e)
+            return None
 
+    def save_media_file(self, path: str, content_hash: str, file_id: str) -> bool:
+        try:
+            self.session.merge(MediaFile(path=path, content_hash=content_hash, file_id=file_id))
+            self._commit()
+            return True
+        except Exception as e:
+            self._rollback()
+            self.logger.error(e)
+            self.reconnect(e)
+            return False
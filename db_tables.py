@@ -1,5 +1,7 @@
+from datetime import datetime
+
 import sqlalchemy
-from sqlalchemy import ForeignKey, Column
+from sqlalchemy import ForeignKey, Column, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from sqlalchemy import Enum as SqlEnum
@@ -8,6 +10,9 @@ from enum import Enum
 
 Base = declarative_base()
 
+# Increase it with every change of the tables, the database is only bootstrapped when it does not match
+SCHEMA_VERSION = 4
+
 
 class StatusEnum(Enum):
     MAIN_MENU = 0
@@ -26,17 +31,80 @@ class User(Base):
     status = Column(SqlEnum(StatusEnum), default=StatusEnum.MAIN_MENU)
 
 
+class ChatGroup(Base):
+    # Every telegram chat has its own rotation, the participants and the events belong to one group
+    __tablename__ = 'ChatGroup'
+    group_id = Column(sqlalchemy.Integer, autoincrement=True, primary_key=True)
+    telegram_chat_id = Column(sqlalchemy.BigInteger, unique=True, nullable=False)
+    title = Column(sqlalchemy.String(length=128))
+    created = Column(sqlalchemy.DateTime, server_default=func.now())
+
+
 class Participant(Base):
     __tablename__ = 'Participant'
+    # the indexes lead with the group, a query of one group does not grow with the number of groups
+    __table_args__ = (UniqueConstraint('group_id', 'display_name', name='uq_participant_group_name'),)
     participant_id = Column(sqlalchemy.Integer, autoincrement=True, primary_key=True)
-    display_name = Column(sqlalchemy.String(length=64), unique=True)
+    group_id = Column(sqlalchemy.Integer, ForeignKey(ChatGroup.group_id), nullable=False)
+    display_name = Column(sqlalchemy.String(length=64))
     join_date = Column(sqlalchemy.DateTime, server_default=func.now())
 
 
 class Event(Base):
     __tablename__ = 'Event'
+    __table_args__ = (UniqueConstraint('group_id', 'date', name='uq_event_group_date'),
+                      # ranking, last payments and turn state go through the events of each participant
+                      Index('ix_event_participant_date', 'participant', 'date'))
     event_id = Column(sqlalchemy.Integer, autoincrement=True, primary_key=True)
+    group_id = Column(sqlalchemy.Integer, ForeignKey(ChatGroup.group_id), nullable=False)
     participant = Column(sqlalchemy.Integer, ForeignKey(Participant.participant_id))
-    date = Column(sqlalchemy.DateTime, server_default=func.now(), unique=True)
+    date = Column(sqlalchemy.DateTime, server_default=func.now())
     # Holidays and stuff
     not_available = Column(sqlalchemy.Boolean, default=False)
+    # what the round cost, None when it was not given
+    amount_cents = Column(sqlalchemy.Integer, nullable=True)
+
+
+class MediaFile(Base):
+    # Telegram file_id of every uploaded image, the hash tells if the file changed since the upload
+    __tablename__ = 'MediaFile'
+    path = Column(sqlalchemy.String(length=255), primary_key=True)
+    content_hash = Column(sqlalchemy.String(length=64))
+    file_id = Column(sqlalchemy.String(length=255))
+
+
+class LastPayment(Base):
+    # Date of the last payment of every participant, kept up to date by DBManager.add_event/delete_event
+    # so the turn order does not need to walk the whole event history
+    __tablename__ = 'LastPayment'
+    participant_id = Column(sqlalchemy.Integer, ForeignKey(Participant.participant_id), primary_key=True)
+    last_payment_date = Column(sqlalchemy.DateTime, nullable=False)
+
+
+class ProcessedUpdate(Base):
+    # Telegram updates already handled, written in the transaction of their changes: a repeated update is skipped
+    __tablename__ = 'ProcessedUpdate'
+    update_id = Column(sqlalchemy.BigInteger, primary_key=True, autoincrement=False)
+    # set here, the rows older than the dedup window are deleted comparing with the clock of the bot
+    processed = Column(sqlalchemy.DateTime, default=datetime.now, nullable=False, index=True)
+
+
+class UpdateOffset(Base):
+    # Single row, the polling resumes from it after a restart. Every update before it was handled
+    __tablename__ = 'UpdateOffset'
+    offset_id = Column(sqlalchemy.Integer, primary_key=True, autoincrement=False)
+    next_update_id = Column(sqlalchemy.BigInteger, nullable=False)
+
+
+class Balance(Base):
+    # Money paid and number of payments of every participant, kept up to date by DBManager.add_event/delete_event
+    # so /balance and the fair turns never sum the event history
+    __tablename__ = 'Balance'
+    participant_id = Column(sqlalchemy.Integer, ForeignKey(Participant.participant_id), primary_key=True)
+    paid_cents = Column(sqlalchemy.BigInteger, nullable=False, default=0)
+    payments = Column(sqlalchemy.Integer, nullable=False, default=0)
+
+
+class SchemaVersion(Base):
+    __tablename__ = 'SchemaVersion'
+    version = Column(sqlalchemy.Integer, primary_key=True)
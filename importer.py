@@ -0,0 +1,66 @@
+import csv
+import time
+from itertools import islice
+from os import environ
+from typing import Dict, NamedTuple, Optional
+
+from command_router import parse_amount, parse_date
+from db_manager import DBManager
+from utils import create_logger
+
+logger = create_logger(__file__)
+
+
+class ImportStats(NamedTuple):
+    rows: int
+    seconds: float
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else float('inf')
+
+
+def import_events(path: str, group_id: int, chunk_size: Optional[int] = None,
+                  db: Optional[DBManager] = None) -> Optional[ImportStats]:
+    """
+    Loads a history file (participant;date rows, dd/mm/yyyy dates, an optional amount column) into the rotation
+    of a group.
+    The file is read in chunks, every chunk is inserted in one transaction and the rows whose date
+    is already in the database are upserted, so importing the same file again changes nothing.
+    Returns None if a chunk could not be saved, the previous chunks stay in the database.
+    It must run outside a unit of work, inside one the whole file would be a single transaction
+    """
+    chunk_size = chunk_size or int(environ.get('CREMAET_IMPORT_CHUNK_SIZE', 5000))
+    db = db or DBManager()
+    started = time.perf_counter()
+    participant_ids: Dict[str, int] = dict()
+    # The participants join the date of the first payment, as the original backup loader did
+    join_date = None
+    n_rows = 0
+    with open(path, newline='') as history:
+        reader = csv.DictReader(history, delimiter=';')
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                break
+            rows = [(row['participant'].strip(), parse_date(row['date'].strip()),
+                     parse_amount(row['amount'].strip()) if (row.get('amount') or '').strip() else None)
+                    for row in chunk]
+            join_date = join_date or rows[0][1]
+            new_names = [name for name, _, _ in rows if name not in participant_ids]
+            if new_names:
+                new_ids = db.get_participant_ids(group_id, new_names, join_date)
+                if new_ids is None:
+                    return None
+                participant_ids.update(new_ids)
+            events = [{'group_id': group_id, 'participant': participant_ids[name], 'date': date, 'not_available': False,
+                       'amount_cents': amount} for name, date, amount in rows]
+            if not db.upsert_events(events):
+                logger.error(f'Import of {path} stopped after {n_rows} rows')
+                return None
+            n_rows += len(rows)
+    # the bulk insert skips the incremental turn state and balances
+    db.check_turn_state(group_id=group_id)
+    stats = ImportStats(n_rows, time.perf_counter() - started)
+    logger.info(f'Imported {stats.rows} rows from {path} in {stats.seconds:.2f}s ({stats.rows_per_second:.0f} rows/s)')
+    return stats
@@ -1,71 +1,76 @@
+import asyncio
+import heapq
 import json
-import requests
-from typing import Optional, Union
+import secrets
+from typing import List, Optional, Union
 from utils import create_logger, load_dialogs
-import time
 from os import environ
 from db_manager import DBManager
-from db_tables import User, StatusEnum
-from urllib.parse import quote_plus
+from db_tables import StatusEnum
+from user_cache import CachedUser
+from update_engine import UpdateEngine
+from webhook import WebhookServer
+from sharding import ShardedIngestion
+from telegram_client import TelegramClient
+from send_queue import SendQueue
+from media_cache import MediaCache
+from response_cache import ResponseCache
+import metrics
+from schedule import EventSchedule
+from importer import import_events
+from command_router import Arg, BadArgument, CommandRouter, parse_amount, parse_date, parse_int, parse_timestamp
 from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from icecream import ic
-import pandas as pd
-from copy import copy
 
 logger = create_logger(__file__)
-URL = f"https://api.telegram.org/bot{environ.get('CREAMET_TELEGRAM_TOKEN')}"
+URL = f"{environ.get('CREMAET_TELEGRAM_API', 'https://api.telegram.org')}/bot{environ.get('CREAMET_TELEGRAM_TOKEN')}"
+telegram = TelegramClient(URL)
+outbox = SendQueue(telegram)
+media_cache = MediaCache()
+schedule = EventSchedule()
 dialogs = load_dialogs()
+# the imports run one at a time, outside the handler threads and their units of work
+imports = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cremaet-import')
+# the data version is kept by each process, with several worker processes the changes made by the others
+# would not be seen, so the answers are not cached
+responses = ResponseCache(0 if int(environ.get('CREMAET_WORKER_PROCESSES', 1)) > 1 else None)
 
 
-def get_request(url: str) -> Optional[str]:
-    try:
-        response = requests.get(url)
-        return response.content.decode("utf8")
-    except (requests.exceptions.RequestException, ValueError) as e:
-        logger.error(e)
-        return None
-
-
-def post_request(url: str, files, data) -> Optional[str]:
-    try:
-        response = requests.post(url=url, files=files, data=data)
-        return response.content.decode("utf8")
-    except (requests.exceptions.RequestException, ValueError) as e:
-        logger.error(e)
-        return None
-
-
-def json_from_get_request(url: str) -> dict:
-    response = get_request(url)
-    while response is None:
-        time.sleep(float(environ.get('CREMAET_API_ERROR_SLEEP', 2)))
-        response = get_request(url)
-    return json.loads(response)
-
-
-def get_updates(offset: Optional[int] = None) -> dict:
+def get_updates(offset: Optional[int] = None, timeout: int = 0) -> dict:
     """
     Ask the telegram server for the most recent updates, offset parameter tells the server
-    what is the last message that the bot download in order to ignore the previous ones
+    what is the last message that the bot download in order to ignore the previous ones.
+    With a timeout the server holds the request (long polling) until an update arrives
     """
-    # TODO - incorporate mechanism to deal with possible telegram issues
-    url = URL + "/getUpdates"
-    if offset:
-        url = f'{url}?offset={offset}'
-    return json_from_get_request(url)
+    return telegram.get_updates(offset=offset, timeout=timeout)
+
+
+def get_sender(update_json: dict) -> dict:
+    # The person behind the update, in a group chat it is not the chat. Only the channel posts come without one
+    for kind in ('callback_query', 'edited_message', 'message'):
+        if kind in update_json:
+            return update_json[kind].get('from') or update_json[kind].get('chat') or {}
+    return {}
 
 
 def get_user_field_data(update_json: dict, field: str) -> Optional[Union[str, int]]:
-    # A generic version of the filter method to obtain the chat id, but it allows to pick any field
-    if 'edited_message' in update_json and 'text' in update_json['edited_message']:
-        return update_json.get('edited_message').get('chat').get(field)
+    # A field of the sender of the update, the user the bot registers
+    return get_sender(update_json).get(field)
 
-    elif 'callback_query' in update_json:
-        return update_json.get('callback_query').get('from').get(field)
 
-    else:
-        return update_json.get("message").get("chat").get(field)
+def get_chat(update_json: dict) -> dict:
+    # The chat where the update happened, the buttons belong to the chat of their message
+    if 'callback_query' in update_json:
+        return update_json['callback_query']['message']['chat']
+    if 'edited_message' in update_json:
+        return update_json['edited_message']['chat']
+    return update_json['message']['chat']
+
+
+def chat_key(update_json: dict) -> int:
+    # The updates of a chat are handled in order, different chats concurrently
+    return get_chat(update_json)['id']
 
 
 def filter_update(update_json: dict):
@@ -88,111 +93,113 @@ def filter_update(update_json: dict):
             return None, update_json['message']['message_id']
 
 
-def send_image(img_path: str, user_chat_id: int, caption: Optional[str] = None) -> Optional[requests.Response]:
-    url = URL + "/sendPhoto"
-    # TODO - load the img as bytes from the folder
+def send_image(img_path: str, user_chat_id: int, caption: Optional[str] = None) -> Future:
+    # Images already uploaded are sent by their telegram file_id
+    file_id = media_cache.get_file_id(img_path)
+    if file_id:
+        future = outbox.send_photo(user_chat_id, file_id, caption)
+        future.add_done_callback(lambda sent: _reupload_rejected_image(sent, img_path, user_chat_id, caption))
+        return future
+    return _upload_image(img_path, user_chat_id, caption)
+
+
+def _upload_image(img_path: str, user_chat_id: int, caption: Optional[str] = None) -> Future:
     with open(img_path, 'rb') as img_reader:
         img = img_reader.read()
-    files = {'photo': img}
-    data = {'chat_id': user_chat_id}
-    if caption:
-        data['caption'] = caption
-    response = None
-    while response is None:
-        time.sleep(float(environ.get('CREMAET_API_ERROR_SLEEP', 2)))
-        response = post_request(url, files, data)
-    return response
-
-
-def send_message(text2send: str, telegram_recipient: int, reply_markup=None):
-    text2send = quote_plus(text2send)
-    url = URL + f"/sendMessage?text={text2send}&chat_id={telegram_recipient}&parse_mode=Markdown"
-    # reply_markup is for a special keyboard
-    if reply_markup:
-        url += f"&reply_markup={reply_markup}"
-    return json_from_get_request(url)
-
-
-def generate_main_keyboard(admin: bool):
-    if not admin:
-        keyboard = {'inline_keyboard': [
-            [{'text': 'Registro', 'callback_data': '/log'},
-             {'text': 'Ranking', 'callback_data': '/ranking'}],
-            [{'text': 'A qui li toca pagar??', 'callback_data': '/whopays'},
-             {'text': 'Sa rallao el bot', 'callback_data': '/start'}]
-        ]}
-    else:
-        keyboard = {'inline_keyboard': [
-            [{'text': 'Registro', 'callback_data': '/log'},
-             {'text': 'Ranking', 'callback_data': '/ranking'}],
-            [{'text': '¡Pagado!', 'callback_data': '/event'},
-             {'text': 'Nuevo miembro', 'callback_data': '/member'}],
-            [{'text': 'A qui li toca pagar??', 'callback_data': '/whopays'},
-             {'text': 'Añadir dia libre', 'callback_data': '/holiday'}]
-        ]}
-    return keyboard
-
-
-def main_menu(user: User):
-    # Macro to send a Telegram user to the main menu
+    future = outbox.send_photo(user_chat_id, img, caption)
+    future.add_done_callback(lambda sent: media_cache.store(img_path, img, sent.result()))
+    return future
+
+
+def _file_id_rejected(response: dict) -> bool:
+    # Only this error is fixed by uploading again: a blocked bot, a missing chat or telegram being down are not
+    description = (response.get('description') or '').lower()
+    return response.get('error_code') == 400 and any(reason in description for reason in
+                                                      ('file identifier', 'file reference', 'file_reference'))
+
+
+def _reupload_rejected_image(sent: Future, img_path: str, user_chat_id: int, caption: Optional[str]) -> None:
+    if not _file_id_rejected(sent.result()):
+        return
+    # telegram does not know the file_id anymore, upload it again
+    media_cache.invalidate(img_path)
+    _upload_image(img_path, user_chat_id, caption)
+
+
+def send_message(text2send: str, telegram_recipient: int, reply_markup: Optional[Union[dict, str]] = None) -> Future:
+    # Messages are queued, they are sent as fast as the telegram rate limits allow
+    return outbox.send_message(telegram_recipient, text2send, reply_markup)
+
+
+def edit_message(text2send: str, telegram_recipient: int, message_id: int,
+                 reply_markup: Optional[Union[dict, str]] = None) -> Future:
+    return outbox.edit_message(telegram_recipient, message_id, text2send, reply_markup)
+
+
+def callback_message_id(update_json: dict) -> Optional[int]:
+    # The message whose button was pressed, None for the commands typed by hand
+    if 'callback_query' in update_json:
+        return update_json['callback_query']['message']['message_id']
+    return None
+
+
+def generate_main_keyboard(admin: bool) -> str:
+    # The two keyboards never change, they are serialised once
+    return MAIN_KEYBOARDS[admin]
+
+
+MAIN_KEYBOARDS = {
+    False: json.dumps({'inline_keyboard': [
+        [{'text': 'Registro', 'callback_data': '/log'},
+         {'text': 'Ranking', 'callback_data': '/ranking'}],
+        [{'text': 'A qui li toca pagar??', 'callback_data': '/whopays'},
+         {'text': 'Sa rallao el bot', 'callback_data': '/start'}]
+    ]}),
+    True: json.dumps({'inline_keyboard': [
+        [{'text': 'Registro', 'callback_data': '/log'},
+         {'text': 'Ranking', 'callback_data': '/ranking'}],
+        [{'text': '¡Pagado!', 'callback_data': '/event'},
+         {'text': 'Nuevo miembro', 'callback_data': '/member'}],
+        [{'text': 'A qui li toca pagar??', 'callback_data': '/whopays'},
+         {'text': 'Añadir dia libre', 'callback_data': '/holiday'}]
+    ]}),
+}
+
+
+def main_menu(user: CachedUser, chat_id: int):
+    # Macro to send a Telegram user to the main menu, in the chat they wrote from
     db = DBManager()
+    # the user could have changed during this update (promoted to admin), the cache has the last version
+    user = db.get_user_by_telegram_id(user.telegram_id) or user
     db.change_user_status(user, StatusEnum.MAIN_MENU)
     # Generate the keyboard option
     keyboard = generate_main_keyboard(user.is_admin)
-    ic(send_image('images/cremaetin.jpg', user.telegram_id))
-    send_message(dialogs['main_menu'], user.telegram_id, json.dumps(keyboard))
-
-
-def rotatory_algorithm() -> deque:
-    # Use a stack to determine the turn
-    # Apply the algorithm!
-    stack = deque()
-    # first, get all the participants. This dict is also a way to keep track
-    participants_dict = {p.participant_id: p.display_name for p in dbmanager.get_all_participants()}
-    # Pick all events
-    for event in dbmanager.get_all_events():
-        # All participants are already included
-        if not participants_dict:
-            break
-        # It is a holiday or whatever, skip this iteration
-        if event.not_available:
-            continue
-        participant_id = event.participant
-        if participant_id in participants_dict:
-            # Add the name to the stack
-            stack.appendleft(participants_dict.get(participant_id))
-            # Also, remove this from the dict
-            participants_dict.pop(participant_id)
-    # Now, check if there is some left in the dict
-    # They have no registries yet - Add in any order
-    if participants_dict:
-        for name in participants_dict.values():
-            stack.appendleft(name)
-    return stack
-
-
-def next_event_day() -> str:
-    # This is a specific function of the cremaet bot
-    # returns the date of the next friday as a str
+    send_image('images/cremaetin.jpg', chat_id)
+    send_message(dialogs['main_menu'], chat_id, keyboard)
+
+
+def rotatory_algorithm(group_id: int) -> deque:
+    # The turn is the participant whose last payment is the oldest one, the ones without payments go first.
+    # The last payment of every participant is kept by the database, so the history is not walked here
     db = DBManager()
-    last_event = db.get_last_n_events(1)[0]
-    return_date: datetime = copy(last_event.date)
-    if is_friday(return_date):
-        return_date += timedelta(days=7)
-    else:
-        return_date += timedelta(days=1)
-        while not is_friday(return_date):
-            return_date += timedelta(days=1)
-    return return_date.strftime('%d/%m/%Y')
+    return deque(db.get_turn_order(group_id))
+
+
+def next_event_days(group_id: int, n_days: int = 1) -> List[str]:
+    # Dates of the next events of the group as str, the holidays already registered are skipped
+    db = DBManager()
+    last_payment = db.get_last_payment_date(group_id)
+    # without payments the next event can be today
+    after = last_payment.date() if last_payment else datetime.today().date() - timedelta(days=1)
+    holidays = [holiday.date() for holiday in db.get_holidays(group_id, after)]
+    return [day.strftime('%d/%m/%Y') for day in schedule.next_dates(after, n_days, holidays, anchor=after)]
 
 
-def is_friday(date: datetime):
-    # Checkme - changing the name of the func and the number
-    # This function could be used in other settings!
-    return date.weekday() == 4
+def next_event_day(group_id: int) -> str:
+    return next_event_days(group_id, 1)[0]
 
 
-def not_command_response(user: User):
+def not_command_response(user: CachedUser):
     pass
 
 
@@ -200,229 +207,405 @@ def get_last_update_id(server_updates: dict) -> int:
     return max([int(el.get('update_id')) for el in server_updates.get('result')])
 
 
-def populate_database_from_file():
-    df = pd.read_csv('backup.csv', sep=';')
-    common_init_date = None
-    participant_set = set()
-    db = DBManager()
-    for row in df.itertuples():
-        participant_display = row.participant.strip()
-        payment_date = datetime.strptime(row.date, '%d/%m/%Y')
-
-        # This is just for the first time
-        if common_init_date is None:
-            common_init_date = payment_date
+def encode_log_cursor(row) -> str:
+    # date and id of an event, short enough for the 64 bytes of a callback_data
+    return f"{row.date.strftime('%Y%m%d%H%M%S')}.{row.event_id}"
 
-        if participant_display not in participant_set:
-            db.add_participant(participant_display, common_init_date)
-            participant_set.add(participant_display)
 
-        participant_object = db.get_participant_by_display_name(participant_display)
-        db.add_event(participant_object, payment_date)
+def decode_log_cursor(token: str) -> Optional[tuple]:
+    try:
+        date_str, event_id = token.split('.')
+        return parse_timestamp(date_str), int(event_id)
+    except ValueError:
+        return None
 
 
-def display_log(user: User, tokens_command: list, n_registries: int = 5) -> None:
-    db = DBManager()
-    # check for manual params
-    if len(tokens_command) > 1:
-        if tokens_command[1].isnumeric():
-            n_registries = int(tokens_command[1])
-    # sanity check - only positive values
+def display_log(user: CachedUser, chat_id: int, group_id: int, n_registries: int = 5,
+                cursor: Optional[tuple] = None, newer: bool = False, message_id: Optional[int] = None) -> None:
+    """
+    Sends one page of the event log with buttons to the older and newer pages.
+    /log [size] shows the first page, the buttons send /log older|newer <cursor> <size>
+    and the page replaces the one of the message_id whose button was pressed
+    """
+    max_page_size = int(environ.get('CREMAET_LOG_MAX_PAGE_SIZE', 50))
+    # a wrong cursor shows the first page
+    newer = newer and cursor is not None
+    # sanity check - only positive values, the pages have a fixed maximum size
     if n_registries <= 0:
         n_registries = 5
-    last_events = db.get_last_n_events(n_registries)
+    n_registries = min(n_registries, max_page_size)
+    message_to_user, keyboard = responses.get_or_compute(
+        ('/log', group_id, n_registries, cursor, newer), DBManager().data_version(group_id),
+        lambda: log_page(group_id, n_registries, cursor, newer))
+    if message_id is not None:
+        # scrolling the log does not send new messages, the main menu is still below
+        edit_message(message_to_user, chat_id, message_id, keyboard)
+        return
+    send_message(message_to_user, chat_id, keyboard)
+    main_menu(user, chat_id)
+
+
+def log_page(group_id: int, n_registries: int, cursor: Optional[tuple], newer: bool) -> tuple:
+    # text and serialised keyboard of a page of the log
+    db = DBManager()
+    # one extra row tells if there is another page in the same direction
+    page = db.get_event_log(group_id, n_registries + 1, cursor, newer)
+    more = len(page) > n_registries
+    if newer and not more:
+        # back at the top, show a full first page
+        cursor, newer = None, False
+        page = db.get_event_log(group_id, n_registries + 1)
+        more = len(page) > n_registries
+    if more:
+        page = page[1:] if newer else page[:-1]
     # checkme - table type message
-    message_to_user = ''
-    for registry in last_events:
-        participant_name = db.get_participant_by_id(registry.participant)
+    lines = []
+    for registry in page:
+        participant_name = registry.display_name
         if participant_name is None:
             participant_name = dialogs.get('log_holiday_display')
-        else:
-            participant_name = participant_name.display_name
         # TODO el formato es terrible
-        message_to_user += f'{registry.event_id} \t {participant_name} \t\t\t {registry.date.date()} \n'
+        lines.append(f'{registry.event_id} \t {participant_name} \t\t\t {registry.date.date()} \n')
+    message_to_user = ''.join(lines)
     if not message_to_user:
         message_to_user = dialogs.get('no_log')
-    send_message(message_to_user, user.telegram_id)
-    main_menu(user)
-
-
-def display_ranking(user: User) -> None:
+    buttons = []
+    if page:
+        has_newer = more if newer else cursor is not None
+        has_older = cursor is not None if newer else more
+        if has_newer:
+            buttons.append({'text': dialogs.get('log_newer'),
+                            'callback_data': f'/log newer {encode_log_cursor(page[0])} {n_registries}'})
+        if has_older:
+            buttons.append({'text': dialogs.get('log_older'),
+                            'callback_data': f'/log older {encode_log_cursor(page[-1])} {n_registries}'})
+    keyboard = json.dumps({'inline_keyboard': [buttons]}) if buttons else None
+    return message_to_user, keyboard
+
+
+def display_ranking(user: CachedUser, chat_id: int, group_id: int, year: Optional[int] = None) -> None:
+    # the same answer for everybody in the group until one of its events or participants changes
+    message_to_user = responses.get_or_compute(('/ranking', group_id, year), DBManager().data_version(group_id),
+                                               lambda: ranking_text(group_id, year))
+    send_message(message_to_user, chat_id)
+    main_menu(user, chat_id)
+
+
+def ranking_text(group_id: int, year: Optional[int] = None) -> str:
     db = DBManager()
-    # Pick the different participants
-    participants = db.get_all_participants()
-    ranking = dict()
-    for participant_ in participants:
-        ranking[participant_.display_name] = len(db.get_events_by_participant(participant_))
+    # Counted by the database in a single query, optionally only the payments of one year
+    starting, ending = None, None
+    if year is not None:
+        starting, ending = datetime(year, 1, 1), datetime(year + 1, 1, 1) - timedelta(microseconds=1)
     # checkme - table type message
     # prepare the message
     message_to_user = ''
-    for k, v in sorted(ranking.items(), key=lambda item: item[1]):
-        message_to_user += f'{k} \t {v} \n'
+    for display_name, payment_count, last_payment_date in db.get_ranking(group_id, starting, ending):
+        last_payment = last_payment_date.strftime('%d/%m/%Y') if last_payment_date else '-'
+        message_to_user += f'{display_name} \t {payment_count} \t {last_payment} \n'
     # Sanity check
     if not message_to_user:
         message_to_user = dialogs.get('no_ranking')
-    send_message(message_to_user, user.telegram_id)
-    main_menu(user)
+    return message_to_user
 
 
-def display_who_pays(user: User, n_events: int = 1) -> None:
-    turns = rotatory_algorithm()
-    next_date = next_event_day()
+def display_who_pays(user: CachedUser, chat_id: int, group_id: int, n_events: int = 1, fair: bool = False) -> None:
     # sanity check to avoid injection of negative values
     if n_events < 1:
         n_events = 1
+    n_events = min(n_events, int(environ.get('CREMAET_MAX_FORECAST', 52)))
+    # without payments the forecast starts today, the day is part of the key
+    message_to_user = responses.get_or_compute(('/whopays', group_id, n_events, fair, datetime.today().date()),
+                                               DBManager().data_version(group_id),
+                                               lambda: who_pays_text(group_id, n_events, fair))
+    send_message(message_to_user, chat_id)
+    main_menu(user, chat_id)
+
+
+def fair_turns(group_id: int, n_events: int) -> List[str]:
+    # The participant that paid less money goes next, every forecast round costs the average payment of the group.
+    # Without amounts it is the one with less payments. Only the balances are read
+    balances = DBManager().get_balances(group_id)
+    paid_cents = sum(paid for _, paid, _ in balances)
+    payments = sum(count for _, _, count in balances)
+    round_cents = paid_cents / payments if payments else 0
+    # the order of the balances breaks the ties
+    heap = [(paid, count, index, name) for index, (name, paid, count) in enumerate(balances)]
+    heapq.heapify(heap)
+    turns = []
+    for _ in range(n_events if heap else 0):
+        paid, count, index, name = heapq.heappop(heap)
+        turns.append(name)
+        heapq.heappush(heap, (paid + round_cents, count + 1, index, name))
+    return turns
+
+
+def who_pays_text(group_id: int, n_events: int, fair: bool = False) -> str:
+    if fair:
+        turns = fair_turns(group_id, n_events)
+    else:
+        turns = rotatory_algorithm(group_id)
+    if not turns:
+        return dialogs.get('no_participants')
+    # the turns repeat once everybody has paid
+    forecast = [(turns[it % len(turns)], day) for it, day in enumerate(next_event_days(group_id, n_events))]
 
-    message_to_user = f'Li toca pagar a: {turns[0]} - {next_date}'
+    message_to_user = f'Li toca pagar a: {forecast[0][0]} - {forecast[0][1]}'
     if n_events > 1:
         message_to_user += '\n Después li tocaría a:\n'
-        n_iters = max(n_events, len(turns))
-        for it in range(1, n_iters):
-            message_to_user += f'{turns[it]}\n'
+        message_to_user += ''.join(f'{name} - {day}\n' for name, day in forecast[1:])
+    return message_to_user
+
 
-    send_message(message_to_user, user.telegram_id)
-    main_menu(user)
+def format_amount(cents: float, sign: bool = False) -> str:
+    # 1250 -> 12,50 €
+    text = f'{cents / 100:{"+" if sign else ""}.2f}'.replace('.', ',')
+    return f'{text} €'
 
 
-def add_event(user: User, tokens_command: list) -> None:
-    # TODO - Add the option to add an ammount at the end of the command
+def display_balance(user: CachedUser, chat_id: int, group_id: int) -> None:
+    message_to_user = responses.get_or_compute(('/balance', group_id), DBManager().data_version(group_id),
+                                               lambda: balance_text(group_id))
+    send_message(message_to_user, chat_id)
+    main_menu(user, chat_id)
+
+
+def balance_text(group_id: int) -> str:
+    # What everybody paid, in how many payments, and how far it is from the average of the group
+    balances = DBManager().get_balances(group_id)
+    if not balances:
+        return dialogs.get('no_participants')
+    average = sum(paid for _, paid, _ in balances) / len(balances)
+    return ''.join(f'{display_name} \t {format_amount(paid)} \t {payments} \t {format_amount(paid - average, True)} \n'
+                   for display_name, paid, payments in balances)
+
+
+def add_event(user: CachedUser, chat_id: int, group_id: int, participant_str: Optional[str] = None,
+              date_event: Optional[datetime] = None, amount_cents: Optional[int] = None) -> None:
+    dbmanager = DBManager()
     # Advanced use of the bot
-    if len(tokens_command) >= 3:
-        # second token is the participant
-        participant_str = tokens_command[1]
-        participant = dbmanager.get_participant_by_display_name(participant_str)
+    if participant_str is not None and date_event is not None:
+        participant = dbmanager.get_participant_by_display_name(group_id, participant_str)
         if participant is None:
-            send_message(dialogs.get('participant_not_found'), user.telegram_id)
-            return
-        # check the validity of the date
-        try:
-            date_event = datetime.strptime(tokens_command[2], '%d/%m/%Y')
-        except ValueError:
-            send_message(dialogs.get('date_bad_format'), user.telegram_id)
+            send_message(dialogs.get('participant_not_found'), chat_id)
             return
         # TODO - maybe check if it's friday??
         # If the method has not reached any continue here, we have a correct date and participant
-        res = dbmanager.add_event(participant, date_event)
+        res = dbmanager.add_event(group_id, participant, date_event, amount_cents=amount_cents)
         message_to_user = dialogs.get('event_added_ok') if res else dialogs.get('event_added_error')
-        send_message(message_to_user, user.telegram_id)
-        main_menu(user)
+        send_message(message_to_user, chat_id)
+        main_menu(user, chat_id)
 
     # Bot guided use
     else:
         dbmanager.change_user_status(user, StatusEnum.ADDING_EVENT)
         # calculate the next friday and just ask for the participant name
-        next_day = next_event_day()
+        next_day = next_event_day(group_id)
         message_to_user = dialogs.get('add_event').replace('%$%', next_day)
-        send_message(message_to_user, user.telegram_id)
+        send_message(message_to_user, chat_id)
 
 
-def add_holidays(user: User, tokens_command: list):
+def add_holidays(user: CachedUser, chat_id: int, group_id: int, date_holiday: Optional[datetime] = None):
+    dbmanager = DBManager()
     # advanced mode
-    if len(tokens_command) == 2:
-        try:
-            date_holiday = datetime.strptime(tokens_command[1], '%d/%m/%Y')
-        except ValueError:
-            send_message(dialogs.get('date_bad_format'), user.telegram_id)
-            return
-        event = dbmanager.add_event(None, date_holiday, True)
+    if date_holiday is not None:
+        event = dbmanager.add_event(group_id, None, date_holiday, True)
         message = dialogs.get('holiday_added_ok') if event else dialogs.get('holiday_added_error')
-        ic(message)
-        send_message(message, user.telegram_id)
-        main_menu(user)
+        send_message(message, chat_id)
+        main_menu(user, chat_id)
     else:
-        send_message(dialogs.get('add_holiday'), user.telegram_id)
+        send_message(dialogs.get('add_holiday'), chat_id)
         return
 
 
+def add_participant(user: CachedUser, chat_id: int, group_id: int, display_name: Optional[str] = None,
+                    date_join: Optional[datetime] = None):
+    # Advanced participant creation
+    if display_name is not None:
+        DBManager().add_participant(group_id, display_name, date_join or datetime.today())
+        # TODO - send okay message
+        main_menu(user, chat_id)
+    # TODO - Manual way
+
+
+def load_backup(user: CachedUser, chat_id: int, group_id: int, path: str = 'backup.csv') -> None:
+    # Only the admins import, once this update committed: every chunk of the file commits on its own
+    if not user.is_admin:
+        send_message(dialogs.get('admin_only'), chat_id)
+        return
+    DBManager().on_commit(lambda: imports.submit(run_import, path, chat_id, group_id))
+
+
+def run_import(path: str, chat_id: int, group_id: int) -> None:
+    try:
+        stats = import_events(path, group_id)
+    except Exception as e:
+        logger.error(f'Import of {path} failed: {e}')
+        stats = None
+    finally:
+        # the session of the import thread is not kept between imports
+        DBManager().session.remove()
+    if stats is None:
+        send_message(dialogs.get('import_error'), chat_id)
+        return
+    send_message(dialogs.get('import_ok').replace('%rows%', str(stats.rows))
+                 .replace('%speed%', f'{stats.rows_per_second:.0f}'), chat_id)
+
+
+def parse_year(token: str) -> int:
+    year = parse_int(token)
+    if not 1 <= year < 9999:
+        raise ValueError(f'{token} is not a year')
+    return year
+
+
+def register_user(update: dict, user: Optional[CachedUser], chat_id: int, group_id: int) -> None:
+    # Register the user if they are not in the database
+    if user is None:
+        # Checkme - is this the appropiate function?
+        user = DBManager().add_user(get_user_field_data(update, 'id'), get_user_field_data(update, 'first_name'),
+                                    get_user_field_data(update, 'last_name'))
+    main_menu(user, chat_id)
+
+
+# The handlers get the update, the user, the chat the answers go to, the group of the chat and the parsed
+# arguments, the command is the first token of a text or a callback_data. Wrong dates are answered with date_bad_format
+router = CommandRouter()
+router.register('/start', register_user)
+router.register('start', register_user)
+router.register('/log', lambda update, user, chat_id, group_id, n_registries:
+                display_log(user, chat_id, group_id, n_registries),
+                Arg('n_registries', parse_int, 5))
+# the buttons of the log carry the cursor of the page that was shown
+router.register('/log older', lambda update, user, chat_id, group_id, cursor, n_registries:
+                display_log(user, chat_id, group_id, n_registries, cursor, message_id=callback_message_id(update)),
+                Arg('cursor', decode_log_cursor), Arg('n_registries', parse_int, 5))
+router.register('/log newer', lambda update, user, chat_id, group_id, cursor, n_registries:
+                display_log(user, chat_id, group_id, n_registries, cursor, newer=True,
+                            message_id=callback_message_id(update)),
+                Arg('cursor', decode_log_cursor), Arg('n_registries', parse_int, 5))
+# /ranking 2023 only counts the payments of that year
+router.register('/ranking', lambda update, user, chat_id, group_id, year:
+                display_ranking(user, chat_id, group_id, year),
+                Arg('year', parse_year))
+router.register('/whopays', lambda update, user, chat_id, group_id, n_events:
+                display_who_pays(user, chat_id, group_id, n_events),
+                Arg('n_events', parse_int, 1))
+# the turns balanced by the money paid instead of by the last payment
+router.register('/whopays fair', lambda update, user, chat_id, group_id, n_events:
+                display_who_pays(user, chat_id, group_id, n_events, fair=True),
+                Arg('n_events', parse_int, 1))
+router.register('/balance', lambda update, user, chat_id, group_id: display_balance(user, chat_id, group_id))
+router.register('/event', lambda update, user, chat_id, group_id, participant, date, amount:
+                add_event(user, chat_id, group_id, participant, date, amount),
+                Arg('participant'), Arg('date', parse_date, error='date_bad_format'),
+                Arg('amount', parse_amount, error='amount_bad_format'))
+router.register('/participant', lambda update, user, chat_id, group_id, display_name, date:
+                add_participant(user, chat_id, group_id, display_name, date),
+                Arg('display_name'), Arg('date', parse_date, error='date_bad_format'))
+router.register('/holiday', lambda update, user, chat_id, group_id, date:
+                add_holidays(user, chat_id, group_id, date),
+                Arg('date', parse_date, error='date_bad_format'))
+# TODO - los deletes
+router.register('load_backup', lambda update, user, chat_id, group_id: load_backup(user, chat_id, group_id))
+
+
+def command_label(update: dict) -> str:
+    # the registered commands are timed on their own, anything else is counted as other
+    text, _ = filter_update(update)
+    if text is None:
+        return 'no_text'
+    command, _ = router.resolve(text.lower())
+    return command.name.split(' ')[0] if command is not None else 'other'
+
+
+def handle_update(update: dict) -> None:
+    # every update is one transaction, the changes of a failed update are discarded
+    label = command_label(update) if metrics.ENABLED else None
+    dbmanager = DBManager()
+    update_id = int(update['update_id'])
+    with metrics.HANDLER_SECONDS.time(label), dbmanager.unit_of_work():
+        # telegram sends again the updates the bot did not acknowledge before stopping
+        if dbmanager.is_update_processed(update_id):
+            logger.info(f'Update {update_id} already processed')
+            return
+        process_update(update)
+        # committed with the changes of the update, it is never applied twice
+        dbmanager.mark_update_processed(update_id)
+
+
+def process_update(update: dict) -> None:
+    dbmanager = DBManager()
+    text, msg_id = filter_update(update)
+    if text is None:
+        return
+    text = text.lower()
+    # the user is who wrote or pressed the button, the answers go to the chat where it happened
+    telegram_id = get_user_field_data(update, "id")
+    active_user = dbmanager.get_user_by_telegram_id(telegram_id)
+    # every chat has its own rotation
+    chat = get_chat(update)
+    group_id = dbmanager.get_group_id(chat['id'], chat.get('title') or chat.get('first_name'))
+    if group_id is None:
+        return
+
+    # casos de uso
+    logger.debug(text)
+    command, tokens = router.resolve(text)
+    is_password = text == environ.get('CREMAET_ADMIN_PASSWORD')
+    if command is None and not is_password:
+        not_command_response(active_user)
+        return
+    if active_user is None and (is_password or command.handler is not register_user):
+        # in a group the buttons are pressed by people who never sent /start
+        send_message(dialogs.get('not_registered'), chat['id'])
+        return
+    if is_password:
+        dbmanager.promote_to_admin(active_user)
+        send_message(dialogs.get('promoted_admin'), chat['id'])
+        main_menu(active_user, chat['id'])
+        return
+    try:
+        arguments = router.parse_args(command, tokens)
+    except BadArgument as e:
+        send_message(dialogs.get(e.arg.error), chat['id'])
+        return
+    command.handler(update, active_user, chat['id'], group_id, **arguments)
+
+
+def run_webhook(engine: UpdateEngine) -> None:
+    # The webhook is registered with a secret token, the server rejects the requests without it
+    secret_token = environ.get('CREMAET_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+    server = WebhookServer(engine.dispatch, secret_token)
+    response = telegram.set_webhook(environ['CREMAET_WEBHOOK_URL'], secret_token,
+                                    int(environ.get('CREMAET_WEBHOOK_MAX_CONNECTIONS', 40)))
+    if not response.get('ok'):
+        raise RuntimeError(f"Telegram rejected the webhook: {response.get('description')}")
+    try:
+        asyncio.run(engine.run_webhook(server))
+    finally:
+        # back to a state where polling works
+        telegram.delete_webhook()
+
+
 if __name__ == '__main__':
     logger.warning('Starting bot')
     # TODO - load the dialogs
-    last_update_id = None
-    dbmanager = DBManager()
+    # the turn state could be outdated if the events were edited by hand
+    DBManager().check_turn_state()
+    # /metrics endpoint, only when CREMAET_METRICS_PORT is set
+    metrics.serve()
     logger.warning('Entering main loop')
-    # Main loop
-    while True:
-        try:
-            updates = get_updates(offset=last_update_id)
-            if 'result' not in updates or len(updates['result']) == 0:
-                time.sleep(float(environ.get('CREMAET_NO_MESSAGE_TIME', 0.8)))
-                continue
-            # Ignores the messages that causes errors
-            last_update_id = get_last_update_id(updates) + 1
-
-            for update in updates['result']:
-                text, msg_id = filter_update(update)
-                text = text.lower()
-                telegram_id = get_user_field_data(update, "id")
-                active_user = dbmanager.get_user_by_telegram_id(telegram_id)
-
-                # casos de uso
-                ic(text)
-                if text == 'start' or '/start' in text:
-                    # Register the user if they are not in the database
-                    if active_user is None:
-                        # Checkme - is this the appropiate function?
-                        first_name = get_user_field_data(update, 'first_name')
-                        last_name = get_user_field_data(update, 'last_name')
-                        active_user = dbmanager.add_user(telegram_id, first_name, last_name)
-
-                    main_menu(active_user)
-                elif text == environ.get('CREMAET_ADMIN_PASSWORD'):
-                    dbmanager.promote_to_admin(active_user)
-                    send_message(dialogs.get('promoted_admin'), active_user.telegram_id)
-                    main_menu(active_user)
-                elif text.startswith('/log'):
-                    tokens = text.split(' ')
-                    display_log(user=active_user, tokens_command=tokens)
-
-                elif text.startswith('/ranking'):
-                    display_ranking(user=active_user)
-
-                elif text.startswith('/whopays'):
-                    tokens = text.split(' ')
-                    argument = 1
-                    if len(tokens) > 1 and tokens[1].isnumeric():
-                        argument = int(tokens[1])
-                    display_who_pays(user=active_user, n_events=argument)
-
-                elif text.startswith('/event'):
-                    tokens = text.split(' ')
-                    add_event(user=active_user, tokens_command=tokens)
-
-                elif text.startswith('/participant'):
-                    # create one participant
-                    tokens = text.split(' ')
-                    # Advanced participant creation
-                    if len(tokens) >= 2:
-                        participant_display_name = tokens[1].strip()
-                        date_join = datetime.today()
-                        # In case the date is provided
-                        if len(tokens) == 3:
-                            try:
-                                date_join = datetime.strptime(tokens[2], '%d/%m/%Y')
-                            except ValueError:
-                                send_message(dialogs.get('date_bad_format'), active_user.telegram_id)
-                                continue
-                        # create the participant
-                        dbmanager.add_participant(participant_display_name, date_join)
-                        # TODO - send okay message
-                        main_menu(active_user)
-                    # TODO - Manual way
-                    else:
-                        pass
-                elif text.startswith('/holiday'):
-                    tokens = text.split(' ')
-
-
-                # TODO - los deletes
-
-                elif text == 'load_backup':
-                    populate_database_from_file()
-                else:
-                    not_command_response(active_user)
-
-                time.sleep(float(environ.get('CONSULTING_TIME', 0.4)))
-        except Exception as e:
-            logger.error(e)
-            time.sleep(float(environ.get('CREMAET_API_ERROR_SLEEP', 0.8)))
-            continue
+    # One worker per chat, the updates come from long polling or from the webhook.
+    # The polling resumes from the saved offset, the updates handled after it are skipped by handle_update
+    offset = DBManager().get_update_offset()
+    engine = UpdateEngine(fetch_updates=get_updates, handle_update=handle_update, chat_key=chat_key,
+                          offset=offset, save_offset=DBManager().save_update_offset)
+    if environ.get('CREMAET_UPDATE_MODE', 'polling') == 'webhook':
+        run_webhook(engine)
+    elif int(environ.get('CREMAET_WORKER_PROCESSES', 1)) > 1:
+        # this process only polls, the updates are handled by worker processes sharded by chat
+        ShardedIngestion(get_updates, chat_key, handler_path='main:handle_update',
+                         offset=offset, save_offset=DBManager().save_update_offset).run()
+    else:
+        asyncio.run(engine.run())
@@ -0,0 +1,65 @@
+import hashlib
+import os
+from threading import Lock
+from typing import Dict, Optional, Tuple
+
+from db_manager import DBManager
+
+
+class MediaCache:
+    """
+    Remembers the telegram file_id of every uploaded image, so each file is uploaded only once.
+    The ids are persisted in the database together with the hash of the uploaded content,
+    a file whose content changed is uploaded again.
+    """
+
+    def __init__(self):
+        # path -> (mtime, size, hash), avoids reading and hashing the file on every send
+        self._hashes: Dict[str, Tuple[int, int, str]] = dict()
+        # path -> (hash, file_id)
+        self._file_ids: Dict[str, Tuple[str, str]] = dict()
+        self._lock = Lock()
+
+    def content_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._hashes.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        with open(path, 'rb') as file_reader:
+            digest = hashlib.sha256(file_reader.read()).hexdigest()
+        with self._lock:
+            self._hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def get_file_id(self, path: str) -> Optional[str]:
+        # Returns the file_id of the current content of the file, None if it must be uploaded
+        digest = self.content_hash(path)
+        with self._lock:
+            cached = self._file_ids.get(path)
+        if cached is None:
+            media = DBManager().get_media_file(path)
+            if media is None:
+                return None
+            cached = (media.content_hash, media.file_id)
+            with self._lock:
+                self._file_ids[path] = cached
+        return cached[1] if cached[0] == digest else None
+
+    def store(self, path: str, content: bytes, response: dict) -> None:
+        # Saves the file_id telegram returns after uploading the content of the file
+        if not response.get('ok'):
+            return
+        photos = response.get('result', {}).get('photo')
+        if not photos:
+            return
+        # The last size is the original one
+        file_id = photos[-1]['file_id']
+        digest = hashlib.sha256(content).hexdigest()
+        with self._lock:
+            self._file_ids[path] = (digest, file_id)
+        DBManager().save_media_file(path, digest, file_id)
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            self._file_ids.pop(path, None)
@@ -0,0 +1,166 @@
+"""
+Latency histograms and counters of the hot paths, exposed in the prometheus text format
+by a local HTTP endpoint. Everything is disabled unless CREMAET_METRICS_PORT is set,
+then the timers are a shared no-op context and the counters return right away.
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Sequence, Tuple
+
+ENABLED = bool(environ.get('CREMAET_METRICS_PORT'))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_NO_TIMER = nullcontext()
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, label: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        # label value -> (count per bucket, sum, count)
+        self._series: Dict[str, Tuple[List[int], float, int]] = dict()
+        self._lock = Lock()
+        _REGISTRY.append(self)
+
+    def observe(self, label_value: str, seconds: float) -> None:
+        if not ENABLED:
+            return
+        with self._lock:
+            bucket_counts, total, count = self._series.get(label_value) or ([0] * len(self.buckets), 0.0, 0)
+            index = bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                bucket_counts[index] += 1
+            self._series[label_value] = (bucket_counts, total + seconds, count + 1)
+
+    def time(self, label_value: str):
+        # with histogram.time('label'): ... observes the duration of the block
+        if not ENABLED:
+            return _NO_TIMER
+        return self._timer(label_value)
+
+    @contextmanager
+    def _timer(self, label_value: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label_value, time.perf_counter() - started)
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {label: (list(buckets), total, count) for label, (buckets, total, count) in self._series.items()}
+        for label_value, (bucket_counts, total, count) in sorted(series.items()):
+            labels = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{labels},le="{upper_bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{labels}}} {total}')
+            lines.append(f'{self.name}_count{{{labels}}} {count}')
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str, label: str):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values: Dict[str, int] = dict()
+        self._lock = Lock()
+        _REGISTRY.append(self)
+
+    def inc(self, label_value: str, amount: int = 1) -> None:
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = dict(self._values)
+        for label_value, value in sorted(values.items()):
+            lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {value}')
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_REGISTRY: list = []
+
+HANDLER_SECONDS = Histogram('cremaet_handler_seconds', 'Time to handle an update, by command', 'command')
+TELEGRAM_SECONDS = Histogram('cremaet_telegram_request_seconds', 'Duration of the telegram API calls', 'method')
+SQL_SECONDS = Histogram('cremaet_sql_seconds', 'Duration of the SQL statements, by statement type', 'statement')
+RETRIES = Counter('cremaet_retries_total', 'Repeated calls after a failure', 'operation')
+RECONNECTS = Counter('cremaet_db_reconnects_total', 'Sessions discarded after a database error', 'reason')
+CIRCUITS_OPENED = Counter('cremaet_circuits_opened_total', 'Circuit breakers opened after repeated failures',
+                          'dependency')
+
+
+def render() -> str:
+    return '\n'.join(line for metric in _REGISTRY for line in metric.render()) + '\n'
+
+
+def instrument_engine(engine) -> None:
+    # Times every SQL statement with the engine events, only when the metrics are enabled
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('cremaet_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['cremaet_started'].pop()
+        # the first word keeps the number of series small: SELECT, INSERT, UPDATE...
+        SQL_SECONDS.observe(statement.lstrip().split(None, 1)[0].upper(), time.perf_counter() - started)
+
+    @event.listens_for(engine, 'handle_error')
+    def _handle_error(context):
+        started = context.connection.info.get('cremaet_started') if context.connection is not None else None
+        if started:
+            started.pop()
+
+
+def serve(port: Optional[int] = None, host: Optional[str] = None) -> Optional[ThreadingHTTPServer]:
+    # Starts the /metrics endpoint in a daemon thread, nothing when the metrics are disabled
+    if not ENABLED:
+        return None
+    port = port if port is not None else int(environ['CREMAET_METRICS_PORT'])
+    host = host or environ.get('CREMAET_METRICS_HOST', '127.0.0.1')
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='cremaet-metrics', daemon=True).start()
+    return server
@@ -0,0 +1,124 @@
+import random
+import time
+from os import environ
+from threading import Lock
+from typing import Callable, Optional
+
+import metrics
+from utils import create_logger
+
+logger = create_logger(__file__)
+
+
+class Backoff:
+    """
+    Bounded exponential backoff with full jitter: the wait before the attempt n is random between 0 and
+    base * 2^n, never more than cap. The clients of a dependency that failed at the same time do not
+    come back at the same time
+    """
+
+    def __init__(self, base: Optional[float] = None, cap: Optional[float] = None):
+        self.base = base if base is not None else float(environ.get('CREMAET_API_ERROR_SLEEP', 0.8))
+        self.cap = cap if cap is not None else float(environ.get('CREMAET_BACKOFF_CAP', 30))
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.cap, self.base * 2 ** min(attempt, 32)))
+
+
+class RetryBudget:
+    """
+    Retries allowed as a fraction of the calls: every call deposits ratio tokens and every retry takes one.
+    min_per_second tokens are added anyway so a quiet bot can still retry. During an outage the retries
+    stop at that fraction of the traffic instead of multiplying it
+    """
+
+    def __init__(self, ratio: Optional[float] = None, min_per_second: float = 1, max_tokens: float = 10):
+        self.ratio = ratio if ratio is not None else float(environ.get('CREMAET_RETRY_BUDGET_RATIO', 0.2))
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Stops calling a dependency after failure_threshold consecutive failures. While open every call is refused
+    at once, after the backoff delay of the times it opened in a row one probe goes through (half open):
+    a success closes it, a failure opens it again for longer
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: Optional[int] = None, backoff: Optional[Backoff] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold or int(environ.get('CREMAET_BREAKER_FAILURES', 5))
+        self.backoff = backoff or Backoff(base=float(environ.get('CREMAET_BREAKER_RESET', 1)))
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.times_opened = 0
+        self.retry_at = 0.0
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        # False while open, in half open only the first caller gets the probe
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() >= self.retry_at:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def retry_after(self) -> float:
+        # seconds until the next probe, 0 if calls go through
+        with self._lock:
+            return max(0.0, self.retry_at - self.clock()) if self.state != self.CLOSED else 0.0
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.warning(f'{self.name} is back, closing its circuit')
+            self.state = self.CLOSED
+            self.failures = 0
+            self.times_opened = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                # at least the base delay, the jitter only spreads the probes of the processes
+                self.retry_at = self.clock() + self.backoff.base + self.backoff.delay(self.times_opened)
+                self.times_opened += 1
+                self.state = self.OPEN
+                metrics.CIRCUITS_OPENED.inc(self.name)
+                logger.error(f'{self.name} failed {self.failures} times, circuit open for '
+                             f'{self.retry_at - self.clock():.1f}s')
+
+
+class CircuitOpenError(RuntimeError):
+
+    def __init__(self, breaker: CircuitBreaker):
+        super().__init__(f'{breaker.name} unavailable, retry in {breaker.retry_after():.1f}s')
+        self.breaker = breaker
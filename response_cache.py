@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from os import environ
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+class ResponseCache:
+    """
+    Answers of the read only commands by command and arguments, tagged with the data version
+    they were computed from. An answer of an older version is computed again, and the callers
+    asking for the same answer meanwhile wait for that computation instead of repeating it.
+    The least recently used answers are evicted when the cache is full, size 0 disables it
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self.max_size = max_size if max_size is not None else int(environ.get('CREMAET_RESPONSE_CACHE_SIZE', 256))
+        # key -> (data version, future of the answer)
+        self._responses: 'OrderedDict[Hashable, Tuple[int, Future]]' = OrderedDict()
+        self._lock = Lock()
+
+    def get_or_compute(self, key: Hashable, version: int, compute: Callable[[], Any]) -> Any:
+        # version must be read before computing, a change committed meanwhile makes the answer stale
+        if self.max_size <= 0:
+            return compute()
+        with self._lock:
+            entry = self._responses.get(key)
+            if entry is not None and entry[0] == version:
+                self._responses.move_to_end(key)
+                computing = entry[1]
+            else:
+                computing = None
+                future = Future()
+                # an answer of a newer version is kept, this one is only returned
+                if entry is None or entry[0] < version:
+                    self._responses[key] = (version, future)
+                    self._responses.move_to_end(key)
+                    while len(self._responses) > self.max_size:
+                        self._responses.popitem(last=False)
+        if computing is not None:
+            return computing.result()
+        try:
+            future.set_result(compute())
+        except Exception as e:
+            future.set_exception(e)
+            # a failure is not cached
+            with self._lock:
+                if self._responses.get(key) == (version, future):
+                    self._responses.pop(key)
+        return future.result()
+
+    def __len__(self) -> int:
+        return len(self._responses)
@@ -0,0 +1,58 @@
+from datetime import date, timedelta
+from os import environ
+from typing import Iterable, List, Optional, Sequence
+
+
+class EventSchedule:
+    """
+    Recurrence of the events: some weekdays (monday is 0) every n weeks.
+    The weeks are counted from the week of the anchor date, so with every_n_weeks=2
+    the events happen the weeks of the anchor, anchor + 2, anchor + 4...
+    The dates are computed in bulk as numpy arrays instead of walking day by day
+    """
+
+    def __init__(self, weekdays: Optional[Sequence[int]] = None, every_n_weeks: Optional[int] = None):
+        if weekdays is None:
+            weekdays = [int(day) for day in environ.get('CREMAET_EVENT_WEEKDAYS', '4').split(',')]
+        if not weekdays or any(day < 0 or day > 6 for day in weekdays):
+            raise ValueError(f'Invalid weekdays {weekdays}, they must be between 0 (monday) and 6 (sunday)')
+        self.weekdays = sorted(set(weekdays))
+        self.every_n_weeks = every_n_weeks or int(environ.get('CREMAET_EVENT_EVERY_N_WEEKS', 1))
+        if self.every_n_weeks < 1:
+            raise ValueError(f'Invalid every_n_weeks {self.every_n_weeks}')
+
+    def is_event_day(self, day: date, anchor: Optional[date] = None) -> bool:
+        if day.weekday() not in self.weekdays:
+            return False
+        anchor = anchor or day
+        weeks = (_monday(day) - _monday(anchor)).days // 7
+        return weeks % self.every_n_weeks == 0
+
+    def next_dates(self, after: date, k: int, skip: Iterable[date] = (), anchor: Optional[date] = None) -> List[date]:
+        """
+        The first k event dates strictly after the given date, skipping the dates in skip (holidays).
+        The anchor fixes the weeks with events, by default the week of after
+        """
+        if k <= 0:
+            return []
+        # numpy is only needed here, importing it lazily keeps it out of the startup
+        import numpy as np
+        after_day = np.datetime64(after, 'D')
+        skip_days = np.array([np.datetime64(day, 'D') for day in skip], dtype='datetime64[D]')
+        # one row per week with events, one column per weekday
+        period = np.timedelta64(7 * self.every_n_weeks, 'D')
+        offsets = np.array(self.weekdays, dtype='timedelta64[D]')
+        first_week = np.datetime64(_monday(anchor or after), 'D')
+        if first_week < after_day:
+            # jump to the period that contains after, the ones before it only have past dates
+            first_week += (after_day - first_week) // period * period
+        # enough weeks for k dates even if every holiday falls in them
+        n_weeks = -(-(k + len(skip_days)) // len(self.weekdays)) + 1
+        weeks = first_week + np.arange(n_weeks) * period
+        candidates = (weeks[:, np.newaxis] + offsets[np.newaxis, :]).ravel()
+        candidates = candidates[(candidates > after_day) & ~np.isin(candidates, skip_days)]
+        return [day.item() for day in candidates[:k]]
+
+
+def _monday(day: date) -> date:
+    return day - timedelta(days=day.weekday())
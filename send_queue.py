@@ -0,0 +1,223 @@
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from os import environ
+from threading import Condition, Thread
+from typing import Deque, Dict, List, Optional, Set, Tuple, Union
+
+import metrics
+from telegram_client import TelegramClient, message_payload, photo_request
+from utils import create_logger
+
+logger = create_logger(__file__)
+
+# Telegram does not accept longer messages, merged messages must fit in one
+MAX_MESSAGE_LENGTH = 4096
+
+
+def split_text(text: str, limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    # Splits a long text in pieces telegram accepts, cutting between lines whenever possible
+    chunks = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ''
+        current += line
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        # rate is the number of tokens per second
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        # seconds to wait until one token is available, 0 if there is one already
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutgoingMessage:
+    __slots__ = ('method', 'payload', 'files', 'futures')
+
+    def __init__(self, method: str, payload: dict, files: Optional[dict] = None):
+        self.method = method
+        self.payload = payload
+        self.files = files
+        self.futures: List[Future] = [Future()]
+
+    def merge(self, other: 'OutgoingMessage') -> bool:
+        # Joins a text message sent right after this one to the same chat, if telegram allows it
+        if self.method != 'sendMessage' or other.method != 'sendMessage':
+            return False
+        # the keyboard belongs to the end of the message, only the last one can have it
+        if self.payload.get('reply_markup') or self.payload.get('parse_mode') != other.payload.get('parse_mode'):
+            return False
+        text = f"{self.payload['text']}\n\n{other.payload['text']}"
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return False
+        self.payload['text'] = text
+        if other.payload.get('reply_markup'):
+            self.payload['reply_markup'] = other.payload['reply_markup']
+        self.futures.extend(other.futures)
+        return True
+
+
+class SendQueue:
+    """
+    Outbound scheduler for the telegram API. The messages of every chat are sent in order,
+    as fast as the global and per chat limits of telegram allow (token buckets).
+    Consecutive text messages to the same chat are merged, and a 429 answer pauses the chat
+    for the retry_after seconds telegram asks for. The client answers the same way while telegram is down.
+    """
+
+    def __init__(self, client: TelegramClient, global_rate: Optional[float] = None,
+                 chat_rate: Optional[float] = None, group_rate: Optional[float] = None,
+                 chat_burst: Optional[float] = None, senders: Optional[int] = None):
+        self.client = client
+        # https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+        self.global_rate = global_rate or float(environ.get('CREMAET_GLOBAL_RATE', 30))
+        self.chat_rate = chat_rate or float(environ.get('CREMAET_CHAT_RATE', 1))
+        self.group_rate = group_rate or float(environ.get('CREMAET_GROUP_RATE_PER_MIN', 20)) / 60
+        self.chat_burst = chat_burst or float(environ.get('CREMAET_CHAT_BURST', 3))
+        self.n_senders = senders or int(environ.get('CREMAET_SENDER_THREADS', 4))
+        self.global_bucket = TokenBucket(self.global_rate, self.global_rate)
+        self.chat_buckets: Dict[int, TokenBucket] = dict()
+        # chat -> pending messages, the order of the keys is the round robin order
+        self.pending: 'OrderedDict[int, Deque[OutgoingMessage]]' = OrderedDict()
+        self.in_flight: Set[int] = set()
+        self.blocked_until: Dict[int, float] = dict()
+        self.condition = Condition()
+        self.senders: List[Thread] = []
+
+    def _start(self) -> None:
+        for it in range(self.n_senders):
+            sender = Thread(target=self._sender_loop, name=f'cremaet-sender-{it}', daemon=True)
+            sender.start()
+            self.senders.append(sender)
+
+    def submit(self, chat_id: int, method: str, payload: dict, files: Optional[dict] = None) -> Future:
+        message = OutgoingMessage(method, payload, files)
+        with self.condition:
+            if not self.senders:
+                self._start()
+            queue = self.pending.setdefault(chat_id, deque())
+            # the head of the queue may be merged too, it is not sent until it leaves the queue
+            if not (queue and queue[-1].merge(message)):
+                queue.append(message)
+            self.condition.notify()
+        return message.futures[0]
+
+    def send_message(self, chat_id: int, text: str, reply_markup: Optional[Union[dict, str]] = None,
+                     parse_mode: Optional[str] = 'Markdown') -> Future:
+        # Long texts go in several messages, the keyboard is attached to the last one
+        chunks = split_text(text)
+        for chunk in chunks[:-1]:
+            self.submit(chat_id, 'sendMessage', message_payload(chat_id, chunk, None, parse_mode))
+        return self.submit(chat_id, 'sendMessage', message_payload(chat_id, chunks[-1], reply_markup, parse_mode))
+
+    def send_photo(self, chat_id: int, photo: Union[bytes, str], caption: Optional[str] = None) -> Future:
+        payload, files = photo_request(chat_id, photo, caption)
+        return self.submit(chat_id, 'sendPhoto', payload, files)
+
+    def edit_message(self, chat_id: int, message_id: int, text: str,
+                     reply_markup: Optional[Union[dict, str]] = None, parse_mode: Optional[str] = 'Markdown') -> Future:
+        # Replaces the text and the keyboard of a message already sent, it counts as one message for the limits
+        payload = message_payload(chat_id, split_text(text)[0], reply_markup, parse_mode)
+        payload['message_id'] = message_id
+        return self.submit(chat_id, 'editMessageText', payload)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # group chats have negative ids and a much lower limit
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = TokenBucket(rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _pick(self, now: float) -> Tuple[Optional[int], Optional[float]]:
+        # Returns the next chat allowed to send, or the time to wait until one is
+        wait = None
+        global_delay = self.global_bucket.delay(now)
+        for chat_id in self.pending:
+            if chat_id in self.in_flight:
+                continue
+            chat_delay = max(self.blocked_until.get(chat_id, 0) - now, self._chat_bucket(chat_id).delay(now))
+            if chat_delay <= 0 and global_delay <= 0:
+                self.global_bucket.consume(now)
+                self.chat_buckets[chat_id].consume(now)
+                # served chats go to the end of the round
+                self.pending.move_to_end(chat_id)
+                return chat_id, None
+            chat_delay = max(chat_delay, global_delay)
+            wait = chat_delay if wait is None else min(wait, chat_delay)
+        return None, wait
+
+    def _forget_idle_chats(self, now: float) -> None:
+        for chat_id in [k for k, bucket in self.chat_buckets.items()
+                        if k not in self.pending and bucket.is_full(now)]:
+            self.chat_buckets.pop(chat_id)
+            self.blocked_until.pop(chat_id, None)
+
+    def _sender_loop(self) -> None:
+        while True:
+            with self.condition:
+                while True:
+                    chat_id, wait = self._pick(time.monotonic())
+                    if chat_id is not None:
+                        break
+                    self.condition.wait(timeout=wait)
+                message = self.pending[chat_id].popleft()
+                self.in_flight.add(chat_id)
+            try:
+                response = self.client.call(message.method, message.payload, message.files)
+            except Exception as e:
+                response = {'ok': False, 'description': str(e)}
+                logger.error(e)
+            with self.condition:
+                self.in_flight.discard(chat_id)
+                retry_after = (response.get('parameters') or {}).get('retry_after')
+                retry = retry_after is not None
+                if retry:
+                    rate_limited = response.get('error_code') == 429
+                    logger.warning(f'{"Rate limited" if rate_limited else "Telegram unavailable"} on chat {chat_id}, '
+                                   f'retrying after {retry_after}s')
+                    metrics.RETRIES.inc('telegram_rate_limited' if rate_limited else 'telegram_unavailable')
+                    self.blocked_until[chat_id] = time.monotonic() + float(retry_after)
+                    self.pending[chat_id].appendleft(message)
+                else:
+                    if not self.pending[chat_id]:
+                        self.pending.pop(chat_id)
+                    if len(self.chat_buckets) > 1024:
+                        self._forget_idle_chats(time.monotonic())
+                self.condition.notify_all()
+            if not retry:
+                for future in message.futures:
+                    future.set_result(response)
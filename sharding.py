@@ -0,0 +1,191 @@
+import asyncio
+import importlib
+import multiprocessing
+import queue
+import zlib
+from os import environ
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from resilience import Backoff
+from utils import create_logger
+
+logger = create_logger(__file__)
+
+
+def shard_for(chat_key: Hashable, n_shards: int) -> int:
+    # Stable across processes and restarts, unlike hash() of a str
+    if isinstance(chat_key, int):
+        return chat_key % n_shards
+    return zlib.crc32(str(chat_key).encode()) % n_shards
+
+
+def run_worker(handler_path: str, inbox: multiprocessing.Queue, done: multiprocessing.Queue,
+               global_rate: Optional[float] = None) -> None:
+    """
+    Entry point of a worker process. handler_path is 'module:function', the module is imported here
+    so the worker builds its own DB pool and telegram session. The updates of the inbox are handled
+    with the per chat ordering of UpdateEngine, and their update_id is sent to done once handled
+    """
+    if global_rate is not None:
+        # the telegram global limit is shared by all the workers
+        environ['CREMAET_GLOBAL_RATE'] = str(global_rate)
+    module_name, function_name = handler_path.split(':')
+    module = importlib.import_module(module_name)
+    from update_engine import UpdateEngine
+    engine = UpdateEngine(fetch_updates=None, handle_update=getattr(module, function_name),
+                          chat_key=getattr(module, 'chat_key'),
+                          on_handled=lambda update: done.put(update['update_id']))
+    # ready, the polling starts once every worker imported the handlers
+    done.put(None)
+    asyncio.run(engine.run_consumer(inbox.get))
+
+
+class ShardedIngestion:
+    """
+    Single ingestion loop for several worker processes. Every update goes to the worker of its chat,
+    so the updates of a chat keep their order. The offset given to telegram only moves past an update
+    once its worker handled it: after a crash telegram sends again the unfinished updates.
+    A worker that dies is started again with its unfinished updates, after max_restarts deaths
+    in a row without handling any update the ingestion stops
+    """
+
+    def __init__(self, fetch_updates: Callable[[Optional[int], int], dict], chat_key: Callable[[dict], Hashable],
+                 handler_path: str, n_workers: Optional[int] = None, poll_timeout: Optional[int] = None,
+                 offset: Optional[int] = None, save_offset: Optional[Callable[[int], None]] = None,
+                 max_restarts: Optional[int] = None, repoll_interval: Optional[float] = None):
+        self.fetch_updates = fetch_updates
+        self.chat_key = chat_key
+        self.handler_path = handler_path
+        self.n_workers = n_workers or int(environ.get('CREMAET_WORKER_PROCESSES', 2))
+        self.poll_timeout = poll_timeout if poll_timeout is not None \
+            else int(environ.get('CREMAET_POLL_TIMEOUT', 30))
+        # seconds between polls while updates are in flight, the other chats do not wait for the slowest one
+        self.repoll_interval = repoll_interval if repoll_interval is not None \
+            else float(environ.get('CREMAET_REPOLL_INTERVAL', 0.2))
+        # spawn, the workers must not share the connections of this process
+        self.context = multiprocessing.get_context('spawn')
+        self.inboxes: List[multiprocessing.Queue] = []
+        self.done: multiprocessing.Queue = self.context.Queue()
+        self.workers: List[multiprocessing.Process] = []
+        # update_id -> (shard, update) of the updates sent to a worker and not handled yet
+        self.in_flight: Dict[int, Tuple[int, dict]] = dict()
+        self.max_restarts = max_restarts if max_restarts is not None \
+            else int(environ.get('CREMAET_WORKER_RESTARTS', 5))
+        # deaths of the worker of every shard since it last handled an update
+        self.restarts: List[int] = [0] * self.n_workers
+        self.global_rate = float(environ.get('CREMAET_GLOBAL_RATE', 30)) / self.n_workers
+        # highest update_id sent to a worker, telegram repeats the ones not acknowledged yet
+        self.last_dispatched: Optional[int] = offset - 1 if offset is not None else None
+        # the offset is saved before every poll that moved it, a restart resumes from there
+        self.save_offset = save_offset
+        self._saved_offset = offset
+
+    @property
+    def offset(self) -> Optional[int]:
+        if self.in_flight:
+            return min(self.in_flight)
+        return self.last_dispatched + 1 if self.last_dispatched is not None else None
+
+    def _start_worker(self, shard: int) -> Tuple[multiprocessing.Queue, multiprocessing.Process]:
+        inbox = self.context.Queue()
+        worker = self.context.Process(target=run_worker, name=f'cremaet-worker-{shard}', daemon=True,
+                                      args=(self.handler_path, inbox, self.done, self.global_rate))
+        worker.start()
+        return inbox, worker
+
+    def start(self) -> None:
+        for shard in range(self.n_workers):
+            inbox, worker = self._start_worker(shard)
+            self.inboxes.append(inbox)
+            self.workers.append(worker)
+        for _ in self.workers:
+            self.done.get(timeout=float(environ.get('CREMAET_WORKER_START_TIMEOUT', 60)))
+
+    def check_workers(self) -> None:
+        # Starts again the dead workers and sends them their unfinished updates, in order
+        for shard, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            self.restarts[shard] += 1
+            if self.restarts[shard] > self.max_restarts:
+                raise RuntimeError(f'{worker.name} died {self.restarts[shard]} times in a row '
+                                   f'(exit code {worker.exitcode}), stopping')
+            unfinished = sorted(update_id for update_id, (it, _) in self.in_flight.items() if it == shard)
+            logger.error(f'{worker.name} died (exit code {worker.exitcode}), starting it again with '
+                         f'{len(unfinished)} unfinished updates')
+            # the updates it handled without reporting them are skipped by the processed updates
+            self.inboxes[shard], self.workers[shard] = self._start_worker(shard)
+            for update_id in unfinished:
+                self.inboxes[shard].put(self.in_flight[update_id][1])
+
+    def stop(self) -> None:
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+
+    def dispatch(self, updates: List[dict]) -> int:
+        # Sends the new updates to their workers, returns how many were new
+        n_new = 0
+        for update in sorted(updates, key=lambda it: int(it['update_id'])):
+            update_id = int(update['update_id'])
+            if self.last_dispatched is not None and update_id <= self.last_dispatched:
+                continue
+            self.last_dispatched = update_id
+            n_new += 1
+            try:
+                shard = shard_for(self.chat_key(update), self.n_workers)
+            except Exception as e:
+                logger.error(f'Update {update_id} discarded, no chat found: {e}')
+                continue
+            self.in_flight[update_id] = (shard, update)
+            self.inboxes[shard].put(update)
+        return n_new
+
+    def collect(self, timeout: Optional[float] = None) -> None:
+        # Forgets the handled updates, waits up to timeout for the first one if given
+        try:
+            update_id = self.done.get(timeout=timeout) if timeout else self.done.get_nowait()
+            while True:
+                # None is the ready signal of a restarted worker
+                shard, _ = self.in_flight.pop(update_id, (None, None))
+                if shard is not None:
+                    self.restarts[shard] = 0
+                update_id = self.done.get_nowait()
+        except queue.Empty:
+            pass
+
+    def checkpoint(self) -> None:
+        offset = self.offset
+        if self.save_offset is None or offset is None or offset == self._saved_offset:
+            return
+        try:
+            self.save_offset(offset)
+            self._saved_offset = offset
+        except Exception as e:
+            logger.error(f'Offset {offset} not saved: {e}')
+
+    def run(self) -> None:
+        self.start()
+        backoff = Backoff()
+        errors = 0
+        try:
+            while True:
+                self.collect()
+                self.check_workers()
+                self.checkpoint()
+                try:
+                    updates = self.fetch_updates(self.offset, self.poll_timeout)
+                    if not updates.get('ok', True):
+                        raise RuntimeError(f"getUpdates failed: {updates.get('description')}")
+                except Exception as e:
+                    logger.error(e)
+                    errors += 1
+                    self.collect(timeout=backoff.delay(errors))
+                    continue
+                errors = 0
+                if not self.dispatch(updates.get('result') or []) and self.in_flight:
+                    # telegram answers at once with the unacknowledged updates, wait a little or for a worker
+                    self.collect(timeout=self.repoll_interval)
+        finally:
+            self.stop()
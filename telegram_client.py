@@ -0,0 +1,132 @@
+import time
+from os import environ
+from typing import Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from resilience import Backoff, CircuitBreaker, RetryBudget
+from utils import create_logger
+
+logger = create_logger(__file__)
+
+
+class TelegramClient:
+    """
+    Thin client for the telegram bot API. All the calls share a pooled keep-alive session,
+    so the replies reuse warm connections instead of paying a new TCP + TLS handshake each time.
+    The failed calls are retried with backoff within a retry budget, and a circuit breaker refuses them
+    at once while telegram is down
+    """
+
+    def __init__(self, base_url: str, pool_size: Optional[int] = None,
+                 connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None):
+        self.base_url = base_url
+        pool_size = pool_size or int(environ.get('CREMAET_HTTP_POOL_SIZE', 10))
+        self.connect_timeout = connect_timeout or float(environ.get('CREMAET_HTTP_CONNECT_TIMEOUT', 5))
+        self.read_timeout = read_timeout or float(environ.get('CREMAET_HTTP_READ_TIMEOUT', 10))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.max_attempts = int(environ.get('CREMAET_TELEGRAM_MAX_ATTEMPTS', 5))
+        self.backoff = Backoff()
+        self.retry_budget = RetryBudget()
+        self.breaker = CircuitBreaker('telegram')
+
+    def request(self, method: str, payload: Optional[dict] = None, files: Optional[dict] = None,
+                read_timeout: Optional[float] = None) -> Optional[dict]:
+        # Performs a single call, returns None when telegram could not be reached
+        url = f'{self.base_url}/{method}'
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        with metrics.TELEGRAM_SECONDS.time(method):
+            return self._post(url, payload, files, timeout)
+
+    def _post(self, url: str, payload: Optional[dict], files: Optional[dict], timeout: tuple) -> Optional[dict]:
+        try:
+            if files:
+                # multipart uploads can not carry a json body, the fields go as form data
+                response = self.session.post(url, data=payload, files=files, timeout=timeout)
+            else:
+                response = self.session.post(url, json=payload or {}, timeout=timeout)
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(e)
+            return None
+
+    def call(self, method: str, payload: Optional[dict] = None, files: Optional[dict] = None,
+             read_timeout: Optional[float] = None) -> dict:
+        # Same as request, but retries the unanswered calls and the server errors. When it gives up the answer
+        # is an error with the retry_after seconds until telegram is tried again, like a 429
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                return self.unavailable(self.breaker.retry_after())
+            response = self.request(method, payload, files, read_timeout)
+            if response is not None and (response.get('error_code') or 0) < 500:
+                self.breaker.record_success()
+                return response
+            self.breaker.record_failure()
+            attempt += 1
+            if attempt >= self.max_attempts or not self.retry_budget.withdraw():
+                return response or self.unavailable(self.backoff.delay(attempt))
+            metrics.RETRIES.inc(f'telegram_{method}')
+            time.sleep(self.backoff.delay(attempt))
+
+    def unavailable(self, retry_after: float) -> dict:
+        # never less than the base delay, the probe of a half open circuit can take a while
+        return {'ok': False, 'description': 'Telegram unavailable',
+                'parameters': {'retry_after': max(retry_after, self.backoff.base)}}
+
+    def get_updates(self, offset: Optional[int] = None, timeout: int = 0) -> dict:
+        payload = {'timeout': timeout}
+        if offset:
+            payload['offset'] = offset
+        # the server holds the request up to timeout seconds, do not cut it before
+        return self.call('getUpdates', payload, read_timeout=timeout + self.read_timeout)
+
+    def send_message(self, chat_id: int, text: str, reply_markup: Optional[Union[dict, str]] = None,
+                     parse_mode: Optional[str] = 'Markdown') -> dict:
+        return self.call('sendMessage', message_payload(chat_id, text, reply_markup, parse_mode))
+
+    def send_photo(self, chat_id: int, photo: Union[bytes, str], caption: Optional[str] = None) -> dict:
+        payload, files = photo_request(chat_id, photo, caption)
+        return self.call('sendPhoto', payload, files)
+
+    def set_webhook(self, url: str, secret_token: str, max_connections: Optional[int] = None) -> dict:
+        # telegram sends the secret in the X-Telegram-Bot-Api-Secret-Token header of every update
+        payload = {'url': url, 'secret_token': secret_token}
+        if max_connections:
+            payload['max_connections'] = max_connections
+        return self.call('setWebhook', payload)
+
+    def delete_webhook(self) -> dict:
+        return self.call('deleteWebhook')
+
+    def close(self) -> None:
+        self.session.close()
+
+
+def message_payload(chat_id: int, text: str, reply_markup: Optional[Union[dict, str]] = None,
+                    parse_mode: Optional[str] = 'Markdown') -> dict:
+    payload = {'chat_id': chat_id, 'text': text}
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    # reply_markup is for a special keyboard
+    if reply_markup:
+        payload['reply_markup'] = reply_markup
+    return payload
+
+
+def photo_request(chat_id: int, photo: Union[bytes, str],
+                  caption: Optional[str] = None) -> Tuple[dict, Optional[dict]]:
+    # photo is either the content of the image or the file_id of an image already uploaded
+    payload = {'chat_id': chat_id}
+    if caption:
+        payload['caption'] = caption
+    if isinstance(photo, str):
+        payload['photo'] = photo
+        return payload, None
+    return payload, {'photo': photo}
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# the logs written by the tests do not end up in the working tree
+os.environ['CREMAET_LOG_DIR'] = tempfile.mkdtemp(prefix='cremaet-test-logs-')
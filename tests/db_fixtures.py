@@ -0,0 +1,27 @@
+import csv
+import os
+from datetime import datetime
+from unittest import mock
+
+from db_manager import DBManager, Singleton
+
+
+def new_memory_db() -> DBManager:
+    # A fresh DBManager over an in-memory sqlite database
+    Singleton._instances.pop(DBManager, None)
+    with mock.patch.dict(os.environ, {'CREMAET_DB_BACKEND': 'memory'}):
+        return DBManager()
+
+
+# telegram chat of the group the tests use
+CHAT_ID = -1001
+
+
+def load_backup(db: DBManager, group_id: int, path: str = 'backup.csv') -> None:
+    participants = dict()
+    with open(path) as backup:
+        for row in csv.DictReader(backup, delimiter=';'):
+            name = row['participant'].strip()
+            if name not in participants:
+                participants[name] = db.add_participant(group_id, name, datetime(2022, 11, 18))
+            db.add_event(group_id, participants[name], datetime.strptime(row['date'], '%d/%m/%Y'))
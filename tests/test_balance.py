@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+from db_manager import DBManager, Singleton
+from db_tables import Balance
+from importer import import_events
+from tests.db_fixtures import CHAT_ID, new_memory_db
+
+
+class BalanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+        self.andrea = self.db.add_participant(self.group_id, 'Andrea', datetime(2022, 11, 18))
+        self.vicent = self.db.add_participant(self.group_id, 'Vicent', datetime(2022, 11, 18))
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_kept_with_every_event(self):
+        self.db.add_event(self.group_id, self.andrea, datetime(2023, 1, 6), amount_cents=1250)
+        self.db.add_event(self.group_id, self.andrea, datetime(2023, 1, 13), amount_cents=800)
+        self.db.add_event(self.group_id, self.vicent, datetime(2023, 1, 20))
+        # holidays are not payments
+        self.db.add_event(self.group_id, None, datetime(2023, 1, 27), True)
+        self.assertEqual(self.db.get_balances(self.group_id), [('Vicent', 0, 1), ('Andrea', 2050, 2)])
+        event = [it for it in self.db.get_all_events(self.group_id) if it.amount_cents == 800][0]
+        self.db.delete_event(event)
+        self.assertEqual(self.db.get_balances(self.group_id), [('Vicent', 0, 1), ('Andrea', 1250, 1)])
+        self.assertEqual(self.db.check_turn_state(repair=False), [])
+
+    def test_discarded_with_the_unit_of_work(self):
+        with self.assertRaises(RuntimeError):
+            with self.db.unit_of_work():
+                self.db.add_event(self.group_id, self.andrea, datetime(2023, 1, 6), amount_cents=1250)
+                raise RuntimeError('handler failed')
+        self.assertEqual(self.db.get_balances(self.group_id), [('Andrea', 0, 0), ('Vicent', 0, 0)])
+
+    def test_rebuilt_after_an_import(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'history.csv')
+            with open(path, 'w') as history:
+                history.write('participant;date;amount\nAndrea;06/01/2023;12,50\nVicent;13/01/2023;\n'
+                              'Andrea;20/01/2023;7\n')
+            import_events(path, self.group_id, db=self.db)
+        self.assertEqual(self.db.get_balances(self.group_id), [('Vicent', 0, 1), ('Andrea', 1950, 2)])
+        # a wrong ledger is found and repaired from the events
+        self.db.session.query(Balance).delete()
+        self.db.session.commit()
+        self.assertEqual(self.db.check_turn_state(), [self.andrea.participant_id, self.vicent.participant_id])
+        self.assertEqual(self.db.get_balances(self.group_id), [('Vicent', 0, 1), ('Andrea', 1950, 2)])
+
+
+if __name__ == '__main__':
+    unittest.main()
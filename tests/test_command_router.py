@@ -0,0 +1,61 @@
+import unittest
+from datetime import datetime
+
+from command_router import Arg, BadArgument, CommandRouter, parse_amount, parse_date, parse_int, parse_timestamp
+
+
+class ParsersTest(unittest.TestCase):
+
+    def test_parse_date_like_strptime(self):
+        for token in ('28/03/1993', '1/3/2023', '29/02/2024', '31/12/0999'):
+            self.assertEqual(parse_date(token), datetime.strptime(token, '%d/%m/%Y'))
+        for token in ('29/02/2023', '28-03-1993', '28/03/93', '28/03', 'a/b/cdef', '', '123/01/2023'):
+            with self.assertRaises(ValueError):
+                parse_date(token)
+
+    def test_parse_amount(self):
+        for token, cents in (('12', 1200), ('12,5', 1250), ('12.50', 1250), ('0,05', 5)):
+            self.assertEqual(parse_amount(token), cents)
+        for token in ('12,505', '-3', '1e3', 'doce', '', ',50'):
+            with self.assertRaises(ValueError):
+                parse_amount(token)
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp('20231229153000'), datetime(2023, 12, 29, 15, 30))
+        with self.assertRaises(ValueError):
+            parse_timestamp('2023122915300')
+
+
+class CommandRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = CommandRouter()
+        self.router.register('/log', lambda: None, Arg('size', parse_int, 5))
+        self.router.register('/log older', lambda: None, Arg('cursor'), Arg('size', parse_int, 5))
+        self.router.register('/holiday', lambda: None, Arg('date', parse_date, error='date_bad_format'))
+
+    def test_resolve(self):
+        command, tokens = self.router.resolve('/log  10')
+        self.assertEqual((command.name, tokens), ('/log', ['10']))
+        # the callback_data go through the same lookup
+        command, tokens = self.router.resolve('/log older 20231229153000.4 10')
+        self.assertEqual((command.name, tokens), ('/log older', ['20231229153000.4', '10']))
+        self.assertEqual(self.router.resolve('/log@cremaet_bot')[0].name, '/log')
+        self.assertIsNone(self.router.resolve('/logs')[0])
+        self.assertIsNone(self.router.resolve('')[0])
+
+    def test_parse_args(self):
+        log = self.router.commands['/log']
+        self.assertEqual(self.router.parse_args(log, []), {'size': 5})
+        self.assertEqual(self.router.parse_args(log, ['10', 'extra']), {'size': 10})
+        # a wrong token without an error dialog falls back to the default
+        self.assertEqual(self.router.parse_args(log, ['-3']), {'size': 5})
+        holiday = self.router.commands['/holiday']
+        self.assertEqual(self.router.parse_args(holiday, []), {'date': None})
+        with self.assertRaises(BadArgument) as raised:
+            self.router.parse_args(holiday, ['2023-12-29'])
+        self.assertEqual(raised.exception.arg.error, 'date_bad_format')
+
+
+if __name__ == '__main__':
+    unittest.main()
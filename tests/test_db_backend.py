@@ -0,0 +1,74 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import db_backend
+from db_manager import DBManager, Singleton
+from tests.db_fixtures import CHAT_ID, load_backup, new_memory_db
+
+
+class DBBackendTest(unittest.TestCase):
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            db_backend.create_engine('postgres')
+
+    def test_sqlite_file_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cremaet.sqlite')
+            with mock.patch.dict(os.environ, {'CREMAET_DB_BACKEND': 'sqlite', 'CREMAET_SQLITE_PATH': path}):
+                Singleton._instances.pop(DBManager, None)
+                db = DBManager()
+                group_id = db.get_group_id(CHAT_ID)
+                load_backup(db, group_id)
+                with db.engine.connect() as connection:
+                    journal_mode = connection.exec_driver_sql('PRAGMA journal_mode').scalar()
+                self.assertEqual(journal_mode, 'wal')
+                self.assertEqual(len(db.get_turn_order(group_id)), 6)
+                # the foreign keys are enforced like in mariadb
+                self.assertFalse(db.delete_participant_by_id(db.get_participant_by_display_name(group_id, 'Andrea')))
+                # a second start finds the schema and the data
+                Singleton._instances.pop(DBManager, None)
+                self.assertEqual(len(DBManager().get_all_events(group_id)), 20)
+                DBManager().engine.dispose()
+                db.engine.dispose()
+
+    def test_memory_units_of_work_are_isolated(self):
+        db = new_memory_db()
+        group_id = db.get_group_id(CHAT_ID)
+        added = threading.Event()
+
+        def first():
+            with db.unit_of_work():
+                db.add_participant(group_id, 'Andrea', datetime(2022, 11, 18))
+                added.set()
+                time.sleep(0.3)
+
+        def second():
+            added.wait(5)
+            # rolled back while the first one is still open
+            try:
+                with db.unit_of_work():
+                    db.add_participant(group_id, 'Vicent', datetime(2022, 11, 18))
+                    raise RuntimeError('handler failed')
+            except RuntimeError:
+                pass
+
+        threads = [threading.Thread(target=first), threading.Thread(target=second)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual([participant.display_name for participant in db.get_all_participants(group_id)],
+                         ['Andrea'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from datetime import datetime
+
+from db_manager import DBManager, Singleton
+from tests.db_fixtures import CHAT_ID, new_memory_db, load_backup
+
+
+class EventLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+        load_backup(self.db, self.group_id)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_same_rows_as_event_by_event_lookup(self):
+        self.db.add_event(self.group_id, None, datetime(2023, 12, 29), not_available=True)
+        expected = []
+        for event in self.db.get_last_n_events(self.group_id, 8):
+            participant = self.db.get_participant_by_id(self.group_id, event.participant)
+            expected.append((event.event_id, event.date, participant.display_name if participant else None))
+        log = self.db.get_event_log(self.group_id, 8)
+        self.assertEqual([row[:3] for row in log], expected)
+        self.assertTrue(log[0].not_available)
+
+    def test_keyset_pages(self):
+        everything = self.db.get_event_log(self.group_id, 100)
+        pages = []
+        cursor = None
+        while True:
+            page = self.db.get_event_log(self.group_id, 4, cursor)
+            if not page:
+                break
+            pages.append(page)
+            cursor = (page[-1].date, page[-1].event_id)
+        self.assertEqual([row for page in pages for row in page], everything)
+        # going back from the last page returns the previous one
+        last = pages[-1][0]
+        self.assertEqual(self.db.get_event_log(self.group_id, 4, (last.date, last.event_id), newer=True), pages[-2])
+
+
+if __name__ == '__main__':
+    unittest.main()
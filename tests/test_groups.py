@@ -0,0 +1,65 @@
+import unittest
+from datetime import datetime
+
+from db_manager import DBManager, Singleton
+from importer import import_events
+from tests.db_fixtures import CHAT_ID, new_memory_db, load_backup
+
+
+class GroupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+        self.other_group_id = self.db.get_group_id(-2002, 'Otra oficina')
+        load_backup(self.db, self.group_id)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_one_group_per_chat(self):
+        self.assertNotEqual(self.group_id, self.other_group_id)
+        self.db._group_ids.clear()
+        self.assertEqual(self.db.get_group_id(CHAT_ID), self.group_id)
+
+    def test_group_of_a_failed_first_update_is_forgotten(self):
+        with self.assertRaises(AttributeError):
+            with self.db.unit_of_work():
+                self.db.get_group_id(-100)
+                self.db.get_group_id(-100)
+                raise AttributeError('handler failed')
+        self.assertNotIn(-100, self.db._group_ids)
+        # the id of the rolled back group can be given to another chat
+        other = self.db.get_group_id(-200)
+        self.db.add_participant(other, 'Secret', datetime(2022, 11, 18))
+        with self.db.unit_of_work():
+            group_id = self.db.get_group_id(-100)
+        self.assertNotEqual(group_id, other)
+        self.assertEqual(self.db.get_all_participants(group_id), [])
+        self.assertEqual(self.db._group_ids[-100], group_id)
+
+    def test_groups_do_not_see_each_other(self):
+        self.assertEqual(self.db.get_turn_order(self.other_group_id), [])
+        self.assertEqual(self.db.get_ranking(self.other_group_id), [])
+        self.assertEqual(self.db.get_event_log(self.other_group_id, 10), [])
+        self.assertIsNone(self.db.get_last_payment_date(self.other_group_id))
+        self.assertIsNone(self.db.get_participant_by_display_name(self.other_group_id, 'Andrea'))
+
+    def test_same_names_and_dates_in_another_group(self):
+        before = (self.db.get_turn_order(self.group_id), self.db.get_ranking(self.group_id))
+        self.assertEqual(import_events('backup.csv', self.other_group_id, db=self.db).rows, 20)
+        self.assertEqual((self.db.get_turn_order(self.other_group_id), self.db.get_ranking(self.other_group_id)),
+                         before)
+        self.db.add_event(self.other_group_id, None, datetime(2023, 5, 5), not_available=True)
+        self.assertEqual(self.db.get_holidays(self.group_id), [])
+        self.assertEqual((self.db.get_turn_order(self.group_id), self.db.get_ranking(self.group_id)), before)
+
+    def test_data_version_by_group(self):
+        version, other_version = self.db.data_version(self.group_id), self.db.data_version(self.other_group_id)
+        self.db.add_participant(self.other_group_id, 'Nuevo', datetime(2023, 5, 6))
+        self.assertEqual(self.db.data_version(self.group_id), version)
+        self.assertGreater(self.db.data_version(self.other_group_id), other_version)
+
+
+if __name__ == '__main__':
+    unittest.main()
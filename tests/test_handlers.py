@@ -0,0 +1,118 @@
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import main
+from db_manager import DBManager, Singleton
+from response_cache import ResponseCache
+from tests.db_fixtures import load_backup, new_memory_db
+
+USER_ID = 77
+
+
+def callback(update_id: int, data: str, chat: dict, message_id: int = 500) -> dict:
+    return {'update_id': update_id,
+            'callback_query': {'id': str(update_id), 'data': data,
+                               'from': {'id': USER_ID, 'first_name': 'Andrea'},
+                               'message': {'message_id': message_id, 'chat': chat}}}
+
+
+def text_message(update_id: int, text: str, chat: dict) -> dict:
+    return {'update_id': update_id,
+            'message': {'message_id': update_id, 'text': text, 'chat': chat,
+                        'from': {'id': USER_ID, 'first_name': 'Andrea'}}}
+
+
+class HandlerTest(unittest.TestCase):
+    # the updates go through handle_update, what the bot sends is recorded by a mock outbox
+
+    chat = {'id': USER_ID, 'type': 'private', 'first_name': 'Andrea'}
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(self.chat['id'])
+        self.outbox = mock.Mock()
+        # the images go through the outbox too, by the file_id of an earlier upload
+        sent = Future()
+        sent.set_result({'ok': True})
+        self.outbox.send_photo.return_value = sent
+        for patch in (mock.patch.object(main, 'outbox', self.outbox),
+                      mock.patch.object(main, 'responses', ResponseCache()),
+                      mock.patch.object(main.media_cache, 'get_file_id', return_value='cremaetin')):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def sent_texts(self) -> list:
+        return [call.args[1] for call in self.outbox.send_message.call_args_list]
+
+
+class LogPagingTest(HandlerTest):
+
+    def setUp(self):
+        super().setUp()
+        load_backup(self.db, self.group_id)
+        self.db.add_user(USER_ID, 'Andrea')
+
+    def test_buttons_edit_the_page_in_place(self):
+        main.handle_update(text_message(1, '/log 4', self.chat))
+        keyboard = self.outbox.send_message.call_args_list[0].args[2]
+        older = main.json.loads(keyboard)['inline_keyboard'][0][-1]['callback_data']
+        self.outbox.reset_mock()
+        main.handle_update(callback(2, older, self.chat, message_id=500))
+        # no new messages and no main menu, the page of message 500 is replaced
+        self.outbox.send_message.assert_not_called()
+        self.outbox.send_photo.assert_not_called()
+        self.outbox.edit_message.assert_called_once()
+        chat_id, message_id, page, keyboard = self.outbox.edit_message.call_args.args
+        self.assertEqual((chat_id, message_id), (USER_ID, 500))
+        self.assertIn('newer', keyboard)
+
+
+class GroupChatTest(HandlerTest):
+
+    chat = {'id': -500, 'type': 'group', 'title': 'Cremaet'}
+
+    def test_the_person_is_the_user_and_the_group_gets_the_answers(self):
+        main.handle_update(text_message(1, '/start@cremaet_bot', self.chat))
+        self.assertIsNotNone(self.db.get_user_by_telegram_id(USER_ID))
+        self.assertIsNone(self.db.get_user_by_telegram_id(self.chat['id']))
+        self.outbox.reset_mock()
+        main.handle_update(callback(2, '/log', self.chat))
+        self.assertEqual(self.sent_texts()[0], main.dialogs['no_log'])
+        self.assertEqual({call.args[0] for call in self.outbox.send_message.call_args_list}, {self.chat['id']})
+
+    def test_unregistered_user_is_asked_to_start(self):
+        main.handle_update(callback(1, '/log', self.chat))
+        self.assertEqual(self.sent_texts(), [main.dialogs['not_registered']])
+        self.assertEqual(self.outbox.send_message.call_args.args[0], self.chat['id'])
+        # the talk of the group is not answered
+        main.handle_update(text_message(2, 'hola', self.chat))
+        self.assertEqual(self.outbox.send_message.call_count, 1)
+
+
+class LoadBackupTest(HandlerTest):
+
+    def wait_for_imports(self) -> None:
+        main.imports.submit(lambda: None).result(timeout=10)
+
+    def test_admins_import_and_get_the_stats(self):
+        user = self.db.add_user(USER_ID, 'Andrea')
+        self.db.promote_to_admin(user)
+        main.handle_update(text_message(1, 'load_backup', self.chat))
+        self.wait_for_imports()
+        self.assertEqual(len(self.db.get_all_events(self.group_id)), 20)
+        self.assertTrue(self.sent_texts()[-1].startswith('Importados 20 registros'))
+
+    def test_other_users_cannot_import(self):
+        self.db.add_user(USER_ID, 'Andrea')
+        main.handle_update(text_message(1, 'load_backup', self.chat))
+        self.wait_for_imports()
+        self.assertEqual(self.db.get_all_events(self.group_id), [])
+        self.assertEqual(self.sent_texts(), [main.dialogs['admin_only']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+from unittest import mock
+
+from db_manager import DBManager, Singleton
+from importer import import_events
+from tests.db_fixtures import CHAT_ID, new_memory_db, load_backup
+
+
+class ImporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    @staticmethod
+    def snapshot(db: DBManager, group_id: int) -> tuple:
+        events = [(row.date, row.display_name, row.not_available) for row in db.get_event_log(group_id, 1000)]
+        return events, db.get_turn_order(group_id), db.get_ranking(group_id)
+
+    def test_same_result_as_row_by_row_load(self):
+        stats = import_events('backup.csv', self.group_id, chunk_size=7, db=self.db)
+        self.assertEqual(stats.rows, 20)
+        imported = self.snapshot(self.db, self.group_id)
+        reference = new_memory_db()
+        reference_group_id = reference.get_group_id(CHAT_ID)
+        load_backup(reference, reference_group_id)
+        self.assertEqual(imported, self.snapshot(reference, reference_group_id))
+
+    def test_reimport_changes_nothing(self):
+        import_events('backup.csv', self.group_id, chunk_size=7, db=self.db)
+        before = self.snapshot(self.db, self.group_id)
+        self.assertIsNotNone(import_events('backup.csv', self.group_id, chunk_size=3, db=self.db))
+        self.assertEqual(self.snapshot(self.db, self.group_id), before)
+        self.assertEqual(self.db.check_turn_state(), [])
+
+    def test_failed_chunk_keeps_the_previous_ones(self):
+        upsert_events = self.db.upsert_events
+        calls = []
+
+        def fail_second_chunk(events):
+            calls.append(events)
+            return upsert_events(events) if len(calls) == 1 else False
+
+        with mock.patch.object(self.db, 'upsert_events', side_effect=fail_second_chunk):
+            self.assertIsNone(import_events('backup.csv', self.group_id, chunk_size=7, db=self.db))
+        self.assertEqual(len(self.db.get_all_events(self.group_id)), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import unittest
+from logging.handlers import QueueHandler
+from types import SimpleNamespace
+from unittest import mock
+
+import utils
+from utils import create_logger, start_logging, stop_logging
+
+
+class QueuedLoggingTest(unittest.TestCase):
+
+    def setUp(self):
+        stop_logging()
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.environ = mock.patch.dict(os.environ, {'CREMAET_LOG_DIR': self.log_dir.name})
+        self.environ.start()
+
+    def tearDown(self):
+        stop_logging()
+        self.environ.stop()
+        self.log_dir.cleanup()
+        start_logging()
+
+    def read_records(self) -> list:
+        stop_logging()
+        with open(os.path.join(self.log_dir.name, 'cremaet.log'), encoding='utf-8') as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def test_json_records_written_by_the_listener(self):
+        logger = create_logger('/somewhere/test_logging_json.py')
+        logger.warning('Payment of %s', 'Andrea', extra={'chat_id': 10})
+        records = [record for record in self.read_records() if record['logger'] == 'test_logging_json']
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['message'], 'Payment of Andrea')
+        self.assertEqual(records[0]['chat_id'], 10)
+        self.assertEqual(records[0]['level'], 'WARNING')
+
+    def test_handlers_installed_once(self):
+        logger = create_logger('/somewhere/test_logging_once.py')
+        self.assertIs(create_logger('/elsewhere/test_logging_once.py'), logger)
+        self.assertEqual(len(logger.handlers), 1)
+        self.assertIsInstance(logger.handlers[0], QueueHandler)
+
+    def test_the_caller_never_waits_for_the_file(self):
+        logger = create_logger('/somewhere/test_logging_blocked.py')
+        # the listener is stuck, the records are queued or dropped
+        blocked = threading.Event()
+        with mock.patch.object(utils._listener.handlers[0], 'emit', side_effect=lambda record: blocked.wait(5)):
+            with mock.patch.object(utils._log_queue, 'maxsize', 10):
+                for it in range(100):
+                    logger.warning(f'record {it}')
+            self.assertGreater(utils.DroppingQueueHandler.dropped, 0)
+            blocked.set()
+
+    def test_debug_below_the_level(self):
+        logger = create_logger('/somewhere/test_logging_level.py')
+        self.assertFalse(logger.isEnabledFor(10))
+        logger.debug('not written')
+        self.assertEqual([record for record in self.read_records() if record['logger'] == 'test_logging_level'], [])
+
+    def test_worker_processes_write_their_own_file(self):
+        stop_logging()
+        worker = SimpleNamespace(name='cremaet-worker-1')
+        with mock.patch.object(multiprocessing, 'current_process', return_value=worker):
+            start_logging()
+        create_logger('/somewhere/test_logging_worker.py').warning('from a worker')
+        stop_logging()
+        with open(os.path.join(self.log_dir.name, 'cremaet-worker-1.log'), encoding='utf-8') as log_file:
+            self.assertEqual([json.loads(line)['message'] for line in log_file], ['from a worker'])
+        self.assertFalse(os.path.exists(os.path.join(self.log_dir.name, 'cremaet.log')))
+
+
+if __name__ == '__main__':
+    unittest.main()
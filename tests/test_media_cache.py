@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from concurrent.futures import Future
+from unittest import mock
+
+import main
+from db_manager import DBManager, Singleton
+from media_cache import MediaCache
+from tests.db_fixtures import new_memory_db
+
+
+def photo_sent(file_id: str) -> dict:
+    return {'ok': True, 'result': {'photo': [{'file_id': f'{file_id}-small'}, {'file_id': file_id}]}}
+
+
+def sent(response: dict) -> Future:
+    future = Future()
+    future.set_result(response)
+    return future
+
+
+class MediaCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cremaetin.jpg')
+        self.write(b'first image')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        Singleton._instances.pop(DBManager, None)
+
+    def write(self, content: bytes) -> None:
+        with open(self.path, 'wb') as img_writer:
+            img_writer.write(content)
+
+    def test_file_id_persisted_with_the_hash(self):
+        cache = MediaCache()
+        self.assertIsNone(cache.get_file_id(self.path))
+        cache.store(self.path, b'first image', photo_sent('first'))
+        self.assertEqual(cache.get_file_id(self.path), 'first')
+        # a new process reads it from the database
+        self.assertEqual(MediaCache().get_file_id(self.path), 'first')
+
+    def test_changed_content_is_uploaded_again(self):
+        cache = MediaCache()
+        cache.store(self.path, b'first image', photo_sent('first'))
+        self.write(b'second image, longer')
+        self.assertIsNone(cache.get_file_id(self.path))
+        self.assertIsNone(MediaCache().get_file_id(self.path))
+
+    def test_failed_upload_not_stored(self):
+        cache = MediaCache()
+        cache.store(self.path, b'first image', {'ok': False, 'error_code': 400})
+        self.assertIsNone(cache.get_file_id(self.path))
+        self.assertIsNone(self.db.get_media_file(self.path))
+
+    def test_rejected_file_id_is_uploaded_again(self):
+        cache = MediaCache()
+        cache.store(self.path, b'first image', photo_sent('first'))
+        outbox = mock.Mock()
+        # telegram forgot the file_id, the upload gets a new one
+        rejected = {'ok': False, 'error_code': 400,
+                    'description': 'Bad Request: wrong file identifier/HTTP URL specified'}
+        outbox.send_photo.side_effect = [sent(rejected), sent(photo_sent('second'))]
+        with mock.patch.object(main, 'media_cache', cache), mock.patch.object(main, 'outbox', outbox):
+            main.send_image(self.path, 10)
+        self.assertEqual([call.args[1] for call in outbox.send_photo.call_args_list], ['first', b'first image'])
+        self.assertEqual(cache.get_file_id(self.path), 'second')
+        self.assertEqual(self.db.get_media_file(self.path).file_id, 'second')
+
+    def test_other_errors_keep_the_file_id(self):
+        cache = MediaCache()
+        cache.store(self.path, b'first image', photo_sent('first'))
+        outbox = mock.Mock()
+        for response in ({'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'},
+                         {'ok': False, 'error_code': 400, 'description': 'Bad Request: chat not found'},
+                         {'ok': False, 'description': 'Telegram unavailable', 'parameters': {'retry_after': 5}}):
+            outbox.send_photo.return_value = sent(response)
+            with mock.patch.object(main, 'media_cache', cache), mock.patch.object(main, 'outbox', outbox):
+                main.send_image(self.path, 10)
+        # no upload, the file_id is still good
+        self.assertEqual([call.args[1] for call in outbox.send_photo.call_args_list], ['first'] * 3)
+        self.assertEqual(cache.get_file_id(self.path), 'first')
+
+
+if __name__ == '__main__':
+    unittest.main()
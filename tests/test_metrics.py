@@ -0,0 +1,56 @@
+import unittest
+import urllib.request
+from unittest import mock
+
+import sqlalchemy
+
+import metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_disabled_is_a_no_op(self):
+        histogram = metrics.Histogram('test_disabled_seconds', 'Test', 'kind')
+        with mock.patch.object(metrics, 'ENABLED', False):
+            with histogram.time('a'):
+                pass
+            self.assertIs(histogram.time('a'), metrics._NO_TIMER)
+            self.assertIsNone(metrics.serve(0))
+        self.assertEqual(histogram.render()[2:], [])
+
+    def test_histogram_render(self):
+        histogram = metrics.Histogram('test_seconds', 'Test', 'kind', buckets=(0.1, 1))
+        counter = metrics.Counter('test_total', 'Test', 'kind')
+        with mock.patch.object(metrics, 'ENABLED', True):
+            histogram.observe('a', 0.05)
+            histogram.observe('a', 0.5)
+            histogram.observe('a', 5)
+            counter.inc('b')
+            counter.inc('b')
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{kind="a",le="0.1"} 1',
+            'test_seconds_bucket{kind="a",le="1"} 2',
+            'test_seconds_bucket{kind="a",le="+Inf"} 3',
+            'test_seconds_sum{kind="a"} 5.55',
+            'test_seconds_count{kind="a"} 3',
+        ])
+        self.assertEqual(counter.render()[2:], ['test_total{kind="b"} 2'])
+
+    def test_sql_timings_and_endpoint(self):
+        with mock.patch.object(metrics, 'ENABLED', True):
+            engine = sqlalchemy.create_engine('sqlite://')
+            metrics.instrument_engine(engine)
+            with engine.connect() as connection:
+                connection.exec_driver_sql('SELECT 1')
+            server = metrics.serve(0)
+        try:
+            url = f'http://127.0.0.1:{server.server_port}/metrics'
+            body = urllib.request.urlopen(url).read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('cremaet_sql_seconds_count{statement="SELECT"}', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from db_manager import DBManager, Singleton
+from db_tables import ProcessedUpdate
+from tests.db_fixtures import CHAT_ID, new_memory_db
+from update_engine import UpdateEngine
+
+
+def message(update_id: int, chat: int) -> dict:
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'text': '/log', 'chat': {'id': chat}}}
+
+
+class ProcessedUpdatesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_mark_commits_with_the_changes(self):
+        with self.db.unit_of_work():
+            self.assertFalse(self.db.is_update_processed(7))
+            self.db.add_participant(self.group_id, 'Andrea', datetime(2022, 11, 18))
+            self.db.mark_update_processed(7)
+        self.assertTrue(self.db.is_update_processed(7))
+        # a failed update is not marked, telegram can send it again
+        with self.assertRaises(RuntimeError):
+            with self.db.unit_of_work():
+                self.db.mark_update_processed(8)
+                raise RuntimeError('handler failed')
+        self.assertFalse(self.db.is_update_processed(8))
+
+    def test_old_marks_are_pruned(self):
+        self.db.session.add(ProcessedUpdate(update_id=1, processed=datetime.now() - timedelta(days=2)))
+        self.db.session.commit()
+        self.db.mark_update_processed(2)
+        self.assertFalse(self.db.is_update_processed(1))
+        self.assertTrue(self.db.is_update_processed(2))
+
+    def test_offset_checkpoint(self):
+        self.assertIsNone(self.db.get_update_offset())
+        self.db.save_update_offset(10)
+        self.db.save_update_offset(12)
+        self.assertEqual(self.db.get_update_offset(), 12)
+
+
+class UpdateEngineOffsetTest(unittest.TestCase):
+
+    def test_offset_waits_for_the_handlers(self):
+        release = threading.Event()
+        saved = []
+
+        def handle(update):
+            if update['update_id'] == 5:
+                release.wait(5)
+
+        async def scenario():
+            engine = UpdateEngine(fetch_updates=None, handle_update=handle,
+                                  chat_key=lambda update: update['message']['chat']['id'],
+                                  offset=5, save_offset=saved.append, worker_idle_time=0.1)
+            self.assertEqual(engine.offset, 5)
+            self.assertEqual(engine.dispatch_polled([message(4, 10), message(5, 10), message(6, 11)]), 2)
+            # telegram sends the unacknowledged updates again, they are not dispatched twice
+            self.assertEqual(engine.dispatch_polled([message(5, 10), message(6, 11)]), 0)
+            while 6 in engine.in_flight:
+                await asyncio.sleep(0.01)
+            self.assertEqual(engine.offset, 5)
+            release.set()
+            while engine.in_flight:
+                await asyncio.sleep(0.01)
+            self.assertEqual(engine.offset, 7)
+            await engine._checkpoint()
+            engine.executor.shutdown()
+            engine.poll_executor.shutdown()
+
+        asyncio.run(scenario())
+        self.assertEqual(saved, [7])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from datetime import datetime
+
+from db_manager import DBManager, Singleton
+from tests.db_fixtures import CHAT_ID, new_memory_db, load_backup
+
+
+class RankingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+        load_backup(self.db, self.group_id)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_same_counts_as_events_by_participant(self):
+        expected = {p.display_name: len(self.db.get_events_by_participant(p))
+                    for p in self.db.get_all_participants(self.group_id)}
+        ranking = self.db.get_ranking(self.group_id)
+        self.assertEqual({name: count for name, count, _ in ranking}, expected)
+        counts = [count for _, count, _ in ranking]
+        self.assertEqual(counts, sorted(counts))
+
+    def test_holidays_and_participants_without_payments(self):
+        self.db.add_event(self.group_id, None, datetime(2023, 5, 5), not_available=True)
+        self.db.add_participant(self.group_id, 'Nuevo', datetime(2023, 5, 6))
+        self.assertEqual(self.db.get_ranking(self.group_id)[0], ('Nuevo', 0, None))
+
+    def test_date_range(self):
+        ranking = self.db.get_ranking(self.group_id, datetime(2023, 1, 1), datetime(2023, 12, 31))
+        expected = len([e for e in self.db.get_all_events(self.group_id) if e.date.year == 2023])
+        self.assertEqual(sum(count for _, count, _ in ranking), expected)
+        self.assertEqual(len(ranking), len(self.db.get_all_participants(self.group_id)))
+        for _, count, last_date in ranking:
+            self.assertTrue(last_date is None or last_date.year == 2023)
+
+
+if __name__ == '__main__':
+    unittest.main()
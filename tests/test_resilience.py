@@ -0,0 +1,126 @@
+import unittest
+from datetime import datetime
+from unittest import mock
+
+from sqlalchemy.exc import OperationalError
+
+from db_manager import DBManager, Singleton
+from resilience import Backoff, CircuitBreaker, CircuitOpenError, RetryBudget
+from telegram_client import TelegramClient
+from tests.db_fixtures import CHAT_ID, new_memory_db
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class BackoffTest(unittest.TestCase):
+
+    def test_bounded_and_growing(self):
+        backoff = Backoff(base=1, cap=10)
+        for attempt in range(50):
+            self.assertLessEqual(backoff.delay(attempt), min(10, 2 ** attempt))
+        self.assertGreater(max(backoff.delay(6) for _ in range(100)), 1)
+
+
+class RetryBudgetTest(unittest.TestCase):
+
+    def test_retries_are_a_fraction_of_the_calls(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_probes_and_closes(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('test', failure_threshold=2, backoff=Backoff(base=1, cap=4), clock=clock)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.assertGreaterEqual(breaker.retry_after(), 1)
+        clock.now += 5
+        # only one probe in half open
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        clock.now += 10
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+
+class TelegramClientRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = TelegramClient('http://telegram.invalid')
+        self.client.backoff = Backoff(base=0, cap=0)
+
+    def test_retries_until_it_answers(self):
+        with mock.patch.object(self.client, 'request', side_effect=[None, {'ok': False, 'error_code': 502},
+                                                                    {'ok': True}]) as request:
+            self.assertEqual(self.client.call('sendMessage'), {'ok': True})
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(self.client.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_gives_up_and_opens(self):
+        with mock.patch.object(self.client, 'request', return_value=None) as request:
+            response = self.client.call('sendMessage')
+            self.assertFalse(response['ok'])
+            self.assertIn('retry_after', response['parameters'])
+            self.assertEqual(request.call_count, self.client.max_attempts)
+            # the circuit is open, the next call does not reach telegram
+            self.client.call('sendMessage')
+            self.assertEqual(request.call_count, self.client.max_attempts)
+
+
+class DatabaseBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.db.breaker = CircuitBreaker('database', failure_threshold=2, backoff=Backoff(base=60))
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_units_of_work_are_refused_while_open(self):
+        lost = OperationalError('SELECT 1', {}, Exception('Lost connection to server'))
+        with self.db.unit_of_work():
+            self.db.reconnect(lost)
+            self.db.reconnect(lost)
+        with self.assertRaises(CircuitOpenError):
+            with self.db.unit_of_work():
+                pass
+        self.db.breaker.retry_at = 0
+        # the probe succeeds, the database is back
+        with self.db.unit_of_work():
+            self.assertIsNotNone(self.db.get_group_id(CHAT_ID))
+        self.assertEqual(self.db.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_bad_input_does_not_open_it(self):
+        group_id = self.db.get_group_id(CHAT_ID)
+        andrea = self.db.add_participant(group_id, 'Andrea', datetime(2022, 11, 18))
+        self.db.add_event(group_id, andrea, datetime(2022, 11, 18))
+        for _ in range(5):
+            # the date is already taken
+            with self.db.unit_of_work():
+                self.assertIsNone(self.db.add_event(group_id, andrea, datetime(2022, 11, 18)))
+        self.assertEqual(self.db.breaker.state, CircuitBreaker.CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
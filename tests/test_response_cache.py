@@ -0,0 +1,94 @@
+import threading
+import unittest
+from datetime import datetime
+
+from db_manager import DBManager, Singleton
+from response_cache import ResponseCache
+from tests.db_fixtures import CHAT_ID, new_memory_db
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def test_computed_once_per_version(self):
+        cache = ResponseCache(8)
+        calls = []
+        compute = lambda: calls.append(1) or len(calls)
+        self.assertEqual(cache.get_or_compute(('/ranking', None), 0, compute), 1)
+        self.assertEqual(cache.get_or_compute(('/ranking', None), 0, compute), 1)
+        self.assertEqual(cache.get_or_compute(('/ranking', None), 1, compute), 2)
+        # an older version does not replace the newer answer
+        self.assertEqual(cache.get_or_compute(('/ranking', None), 0, compute), 3)
+        self.assertEqual(cache.get_or_compute(('/ranking', None), 1, compute), 2)
+
+    def test_least_recently_used_evicted(self):
+        cache = ResponseCache(2)
+        for key in ('a', 'b', 'a', 'c'):
+            cache.get_or_compute(key, 0, lambda: key)
+        self.assertEqual(cache.get_or_compute('a', 0, lambda: 'again'), 'a')
+        self.assertEqual(cache.get_or_compute('b', 0, lambda: 'again'), 'again')
+
+    def test_failures_are_not_cached(self):
+        cache = ResponseCache(2)
+        with self.assertRaises(ZeroDivisionError):
+            cache.get_or_compute('a', 0, lambda: 1 / 0)
+        self.assertEqual(cache.get_or_compute('a', 0, lambda: 'ok'), 'ok')
+
+    def test_concurrent_callers_share_the_computation(self):
+        cache = ResponseCache(8)
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'ranking'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('r', 0, slow)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual((len(calls), results), (1, ['ranking'] * 5))
+
+
+class DataVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_writes_bump_the_version(self):
+        version = self.db.data_version(self.group_id)
+        participant = self.db.add_participant(self.group_id, 'Andrea', datetime(2022, 11, 18))
+        self.assertGreater(self.db.data_version(self.group_id), version)
+        version = self.db.data_version(self.group_id)
+        event = self.db.add_event(self.group_id, participant, datetime(2022, 11, 18))
+        self.assertGreater(self.db.data_version(self.group_id), version)
+        version = self.db.data_version(self.group_id)
+        self.db.get_ranking(self.group_id)
+        self.db.get_event_log(self.group_id, 5)
+        self.assertEqual(self.db.data_version(self.group_id), version)
+        self.db.delete_event(event)
+        self.assertGreater(self.db.data_version(self.group_id), version)
+
+    def test_rollback_bumps_the_version(self):
+        with self.assertRaises(RuntimeError):
+            with self.db.unit_of_work():
+                self.db.add_participant(self.group_id, 'Andrea', datetime(2022, 11, 18))
+                # an answer computed now sees the uncommitted participant
+                version = self.db.data_version(self.group_id)
+                raise RuntimeError('handler failed')
+        self.assertGreater(self.db.data_version(self.group_id), version)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from datetime import date, timedelta
+
+from schedule import EventSchedule
+
+
+def walk_days(schedule: EventSchedule, after: date, k: int, skip=(), anchor=None) -> list:
+    # Reference implementation, day by day
+    days = []
+    day = after
+    while len(days) < k:
+        day += timedelta(days=1)
+        if schedule.is_event_day(day, anchor or after) and day not in skip:
+            days.append(day)
+    return days
+
+
+class EventScheduleTest(unittest.TestCase):
+
+    def test_next_friday(self):
+        schedule = EventSchedule([4], 1)
+        # thursday, friday and saturday
+        self.assertEqual(schedule.next_dates(date(2023, 3, 30), 1), [date(2023, 3, 31)])
+        self.assertEqual(schedule.next_dates(date(2023, 3, 31), 1), [date(2023, 4, 7)])
+        self.assertEqual(schedule.next_dates(date(2023, 4, 1), 1), [date(2023, 4, 7)])
+
+    def test_holidays_are_skipped(self):
+        schedule = EventSchedule([4], 1)
+        holidays = [date(2023, 4, 7), date(2023, 4, 21)]
+        self.assertEqual(schedule.next_dates(date(2023, 3, 31), 3, holidays),
+                         [date(2023, 4, 14), date(2023, 4, 28), date(2023, 5, 5)])
+
+    def test_same_as_walking_day_by_day(self):
+        start = date(2023, 1, 1)
+        holidays = [start + timedelta(days=it) for it in range(0, 120, 9)]
+        for weekdays in ([4], [0, 2], [1, 3, 5, 6]):
+            for every_n_weeks in (1, 2, 3):
+                schedule = EventSchedule(weekdays, every_n_weeks)
+                for offset in range(0, 30, 4):
+                    after = start + timedelta(days=offset)
+                    self.assertEqual(schedule.next_dates(after, 12, holidays, anchor=start),
+                                     walk_days(schedule, after, 12, holidays, anchor=start))
+
+    def test_invalid_recurrence(self):
+        with self.assertRaises(ValueError):
+            EventSchedule([7])
+        with self.assertRaises(ValueError):
+            EventSchedule([4], -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest import mock
+
+import sqlalchemy
+from sqlalchemy import Column, ForeignKey
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.sql import func
+
+from db_manager import DBManager, Singleton
+from db_tables import SCHEMA_VERSION
+
+# The tables of the first version of the bot, before the version table existed
+BaselineBase = declarative_base()
+
+
+class BaselineParticipant(BaselineBase):
+    __tablename__ = 'Participant'
+    participant_id = Column(sqlalchemy.Integer, autoincrement=True, primary_key=True)
+    display_name = Column(sqlalchemy.String(length=64), unique=True)
+    join_date = Column(sqlalchemy.DateTime, server_default=func.now())
+
+
+class BaselineEvent(BaselineBase):
+    __tablename__ = 'Event'
+    event_id = Column(sqlalchemy.Integer, autoincrement=True, primary_key=True)
+    participant = Column(sqlalchemy.Integer, ForeignKey(BaselineParticipant.participant_id))
+    date = Column(sqlalchemy.DateTime, server_default=func.now(), unique=True)
+    not_available = Column(sqlalchemy.Boolean, default=False)
+
+
+class BaselineMigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'baseline.sqlite')
+        engine = sqlalchemy.create_engine(f'sqlite:///{path}')
+        BaselineBase.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(sqlalchemy.insert(BaselineParticipant.__table__),
+                               [{'display_name': 'Andrea', 'join_date': datetime(2022, 11, 18)},
+                                {'display_name': 'Vicent', 'join_date': datetime(2022, 11, 18)}])
+            connection.execute(sqlalchemy.insert(BaselineEvent.__table__),
+                               [{'participant': 1, 'date': datetime(2022, 11, 18), 'not_available': False},
+                                {'participant': 2, 'date': datetime(2022, 11, 25), 'not_available': False},
+                                {'participant': None, 'date': datetime(2022, 12, 2), 'not_available': True}])
+        engine.dispose()
+        self.environ = mock.patch.dict(os.environ, {'CREMAET_DB_BACKEND': 'sqlite', 'CREMAET_SQLITE_PATH': path,
+                                                    'CREMAET_LEGACY_CHAT_ID': '-1001'})
+        self.environ.start()
+        Singleton._instances.pop(DBManager, None)
+
+    def tearDown(self):
+        db = Singleton._instances.pop(DBManager, None)
+        if db is not None:
+            db.session.remove()
+            db.engine.dispose()
+        self.environ.stop()
+        self.tmp.cleanup()
+
+    def test_baseline_tables_move_to_the_legacy_group(self):
+        db = DBManager()
+        self.assertEqual(db.get_schema_version(), SCHEMA_VERSION)
+        group_id = db.get_group_id(-1001)
+        db.check_turn_state()
+        self.assertEqual(db.get_turn_order(group_id), ['Andrea', 'Vicent'])
+        self.assertEqual(len(db.get_all_events(group_id)), 3)
+        self.assertEqual(db.get_balances(group_id), [('Andrea', 0, 1), ('Vicent', 0, 1)])
+        # the unique indexes are per group now, and the foreign keys are checked again
+        other_group_id = db.get_group_id(-2002)
+        other_andrea = db.add_participant(other_group_id, 'Andrea', datetime(2023, 1, 1))
+        self.assertIsNotNone(other_andrea)
+        self.assertIsNotNone(db.add_event(other_group_id, other_andrea, datetime(2022, 11, 18), amount_cents=500))
+        andrea = db.get_participant_by_display_name(group_id, 'Andrea')
+        self.assertIsNone(db.add_event(group_id, andrea, datetime(2022, 11, 18)))
+        self.assertFalse(db.delete_participant_by_id(andrea))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import threading
+import time
+import unittest
+
+from send_queue import MAX_MESSAGE_LENGTH, OutgoingMessage, SendQueue, TokenBucket, split_text
+from telegram_client import message_payload
+
+
+class SplitTextTest(unittest.TestCase):
+
+    def test_short_text_is_not_split(self):
+        self.assertEqual(split_text('hola\nadios'), ['hola\nadios'])
+        self.assertEqual(split_text(''), [''])
+
+    def test_splits_between_lines(self):
+        lines = [f'{it} \t Andrea \t\t\t 2023-01-01 \n' for it in range(500)]
+        chunks = split_text(''.join(lines))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), ''.join(lines))
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), MAX_MESSAGE_LENGTH)
+            self.assertTrue(chunk.endswith('\n'))
+
+    def test_long_line(self):
+        chunks = split_text('x' * (MAX_MESSAGE_LENGTH * 2 + 1))
+        self.assertEqual([len(chunk) for chunk in chunks], [MAX_MESSAGE_LENGTH, MAX_MESSAGE_LENGTH, 1])
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_delay_until_the_next_token(self):
+        bucket = TokenBucket(rate=2, capacity=2)
+        now = bucket.updated
+        for _ in range(2):
+            self.assertEqual(bucket.delay(now), 0)
+            bucket.consume(now)
+        self.assertAlmostEqual(bucket.delay(now), 0.5)
+        self.assertAlmostEqual(bucket.delay(now + 0.25), 0.25)
+        self.assertEqual(bucket.delay(now + 0.5), 0)
+        self.assertFalse(bucket.is_full(now + 0.5))
+        self.assertTrue(bucket.is_full(now + 10))
+
+
+def text(chat_id: int, body: str, reply_markup=None) -> OutgoingMessage:
+    return OutgoingMessage('sendMessage', message_payload(chat_id, body, reply_markup))
+
+
+class MergeTest(unittest.TestCase):
+
+    def test_consecutive_texts_are_joined(self):
+        first = text(10, 'hola')
+        second = text(10, 'adios', '{"inline_keyboard": []}')
+        self.assertTrue(first.merge(second))
+        self.assertEqual(first.payload['text'], 'hola\n\nadios')
+        # the keyboard of the last one is kept, both callers get the answer
+        self.assertEqual(first.payload['reply_markup'], '{"inline_keyboard": []}')
+        self.assertEqual(len(first.futures), 2)
+
+    def test_nothing_after_a_keyboard(self):
+        first = text(10, 'hola', '{"inline_keyboard": []}')
+        self.assertFalse(first.merge(text(10, 'adios')))
+        self.assertEqual(first.payload['text'], 'hola')
+
+    def test_length_limit(self):
+        first = text(10, 'x' * (MAX_MESSAGE_LENGTH - 10))
+        self.assertFalse(first.merge(text(10, 'y' * 9)))
+        self.assertTrue(first.merge(text(10, 'y' * 8)))
+        self.assertEqual(len(first.payload['text']), MAX_MESSAGE_LENGTH)
+
+    def test_only_texts(self):
+        photo = OutgoingMessage('sendPhoto', {'chat_id': 10, 'photo': 'file_id'})
+        self.assertFalse(photo.merge(text(10, 'hola')))
+        self.assertFalse(text(10, 'hola').merge(photo))
+
+
+class StubClient:
+    # Answers ok unless a response is queued for the chat, records the calls in order
+
+    def __init__(self):
+        self.calls = []
+        self.responses = {}
+        self.lock = threading.Lock()
+
+    def call(self, method: str, payload: dict, files=None) -> dict:
+        with self.lock:
+            self.calls.append((time.monotonic(), payload['chat_id'], payload.get('photo') or payload.get('text')))
+            queued = self.responses.get(payload['chat_id'])
+            return queued.pop(0) if queued else {'ok': True}
+
+
+class SendQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StubClient()
+        self.outbox = SendQueue(self.client, global_rate=1000, chat_rate=1000, group_rate=1000, chat_burst=1000,
+                                senders=4)
+
+    def test_order_of_every_chat(self):
+        futures = [self.outbox.send_photo(chat_id, f'{chat_id}-{it}') for it in range(20) for chat_id in (1, 2, -3)]
+        for future in futures:
+            self.assertTrue(future.result(timeout=5)['ok'])
+        for chat_id in (1, 2, -3):
+            sent = [body for _, chat, body in self.client.calls if chat == chat_id]
+            self.assertEqual(sent, [f'{chat_id}-{it}' for it in range(20)])
+
+    def test_rate_limited_message_goes_first_after_retry_after(self):
+        self.client.responses[1] = [{'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0.3}}]
+        first = self.outbox.send_photo(1, 'first')
+        second = self.outbox.send_photo(1, 'second')
+        other = self.outbox.send_photo(2, 'other')
+        # the caller only sees the answer of the retry
+        self.assertTrue(first.result(timeout=5)['ok'])
+        self.assertTrue(second.result(timeout=5)['ok'])
+        self.assertTrue(other.result(timeout=5)['ok'])
+        calls = [(at, body) for at, chat, body in self.client.calls if chat == 1]
+        self.assertEqual([body for _, body in calls], ['first', 'first', 'second'])
+        self.assertGreaterEqual(calls[1][0] - calls[0][0], 0.3)
+        # the other chats are not held
+        other_at = next(at for at, chat, _ in self.client.calls if chat == 2)
+        self.assertLess(other_at, calls[1][0])
+
+    def test_edit_is_not_merged(self):
+        self.outbox.send_message(1, 'page')
+        future = self.outbox.edit_message(1, 500, 'older page')
+        self.assertTrue(future.result(timeout=5)['ok'])
+        self.assertEqual([body for _, _, body in self.client.calls], ['page', 'older page'])
+
+    def test_chat_limit(self):
+        outbox = SendQueue(self.client, global_rate=1000, chat_rate=10, chat_burst=1, senders=2)
+        futures = [outbox.send_photo(1, f'{it}') for it in range(3)]
+        for future in futures:
+            future.result(timeout=5)
+        sent_at = [at for at, _, _ in self.client.calls]
+        # one token every 0.1s after the first one
+        self.assertGreaterEqual(sent_at[-1] - sent_at[0], 0.19)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import queue
+import unittest
+
+from sharding import ShardedIngestion, shard_for
+
+
+def message(update_id: int, chat: int) -> dict:
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'text': '/log', 'chat': {'id': chat}}}
+
+
+class ShardedIngestionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ingestion = ShardedIngestion(fetch_updates=None, chat_key=lambda update: update['message']['chat']['id'],
+                                          handler_path='main:handle_update', n_workers=3, poll_timeout=0)
+        # plain queues instead of worker processes
+        self.ingestion.inboxes = [queue.Queue() for _ in range(3)]
+        self.ingestion.done = queue.Queue()
+
+    def test_same_chat_same_shard(self):
+        self.assertEqual(shard_for(1234, 3), shard_for(1234, 3))
+        self.assertEqual(shard_for('group', 5), shard_for('group', 5))
+        self.ingestion.dispatch([message(1, 10), message(2, 11), message(3, 10)])
+        shard = self.ingestion.inboxes[shard_for(10, 3)]
+        self.assertEqual([shard.get_nowait()['update_id'] for _ in range(shard.qsize())][-2:], [1, 3])
+
+    def test_offset_waits_for_the_workers(self):
+        self.assertIsNone(self.ingestion.offset)
+        self.assertEqual(self.ingestion.dispatch([message(5, 10), message(6, 11), message(7, 12)]), 3)
+        self.assertEqual(self.ingestion.offset, 5)
+        # telegram sends the unacknowledged updates again, they are not dispatched twice
+        self.assertEqual(self.ingestion.dispatch([message(5, 10), message(6, 11), message(7, 12)]), 0)
+        self.ingestion.done.put(6)
+        self.ingestion.collect()
+        self.assertEqual(self.ingestion.offset, 5)
+        self.ingestion.done.put(5)
+        self.ingestion.done.put(7)
+        self.ingestion.collect()
+        self.assertEqual(self.ingestion.offset, 8)
+
+
+class FakeWorker:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.exitcode = None
+        self.alive = True
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+
+class WorkerRestartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ingestion = ShardedIngestion(fetch_updates=None, chat_key=lambda update: update['message']['chat']['id'],
+                                          handler_path='main:handle_update', n_workers=2, poll_timeout=0,
+                                          max_restarts=1)
+        self.ingestion.done = queue.Queue()
+        self.ingestion._start_worker = lambda shard: (queue.Queue(), FakeWorker(f'cremaet-worker-{shard}'))
+        for shard in range(2):
+            inbox, worker = self.ingestion._start_worker(shard)
+            self.ingestion.inboxes.append(inbox)
+            self.ingestion.workers.append(worker)
+
+    def test_dead_worker_gets_its_unfinished_updates(self):
+        self.ingestion.dispatch([message(1, 10), message(2, 11), message(3, 10), message(4, 12)])
+        self.ingestion.done.put(1)
+        self.ingestion.collect()
+        dead = self.ingestion.workers[0]
+        dead.alive = False
+        dead.exitcode = -9
+        self.ingestion.check_workers()
+        self.assertIsNot(self.ingestion.workers[0], dead)
+        inbox = self.ingestion.inboxes[0]
+        self.assertEqual([inbox.get_nowait()['update_id'] for _ in range(inbox.qsize())], [3, 4])
+        # the other worker keeps its inbox
+        self.assertEqual(self.ingestion.inboxes[1].qsize(), 1)
+        self.assertEqual(self.ingestion.offset, 2)
+
+    def test_fails_after_max_restarts(self):
+        self.ingestion.dispatch([message(1, 10)])
+        self.ingestion.workers[0].alive = False
+        self.ingestion.check_workers()
+        # handling an update resets the count
+        self.ingestion.done.put(None)
+        self.ingestion.done.put(1)
+        self.ingestion.collect()
+        self.ingestion.dispatch([message(2, 10)])
+        self.ingestion.workers[0].alive = False
+        self.ingestion.check_workers()
+        self.ingestion.workers[0].alive = False
+        with self.assertRaises(RuntimeError):
+            self.ingestion.check_workers()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from datetime import datetime
+
+import sqlalchemy
+
+from db_manager import DBManager, Singleton
+from tests.db_fixtures import CHAT_ID, new_memory_db, load_backup
+
+
+def legacy_rotatory_algorithm(db: DBManager, group_id: int) -> list:
+    # The original algorithm, walks the whole history
+    stack = []
+    participants_dict = {p.participant_id: p.display_name for p in db.get_all_participants(group_id)}
+    for event in db.get_all_events(group_id):
+        if event.not_available:
+            continue
+        if event.participant in participants_dict:
+            stack.insert(0, participants_dict.pop(event.participant))
+    for name in participants_dict.values():
+        stack.insert(0, name)
+    return stack
+
+
+class TurnOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+        load_backup(self.db, self.group_id)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_same_order_as_legacy_algorithm(self):
+        self.assertEqual(self.db.get_turn_order(self.group_id), legacy_rotatory_algorithm(self.db, self.group_id))
+
+    def test_holidays_and_new_participants(self):
+        self.db.add_event(self.group_id, None, datetime(2023, 5, 5), not_available=True)
+        self.db.add_participant(self.group_id, 'Nuevo', datetime(2023, 5, 6))
+        self.db.add_participant(self.group_id, 'Otro', datetime(2023, 5, 6))
+        order = self.db.get_turn_order(self.group_id)
+        self.assertEqual(order[:2], ['Otro', 'Nuevo'])
+        self.assertEqual(order, legacy_rotatory_algorithm(self.db, self.group_id))
+
+    def test_delete_last_payment(self):
+        last_event = self.db.get_last_n_events(self.group_id, 1)[0]
+        self.assertTrue(self.db.delete_event(last_event))
+        self.assertEqual(self.db.get_turn_order(self.group_id), legacy_rotatory_algorithm(self.db, self.group_id))
+        self.assertEqual(self.db.check_turn_state(), [])
+
+    def test_check_turn_state_repairs(self):
+        self.db.session.execute(sqlalchemy.text('DELETE FROM LastPayment'))
+        self.db.session.commit()
+        self.assertEqual(len(self.db.check_turn_state()), len(self.db.get_all_participants(self.group_id)))
+        self.assertEqual(self.db.check_turn_state(), [])
+        self.assertEqual(self.db.get_turn_order(self.group_id), legacy_rotatory_algorithm(self.db, self.group_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from datetime import datetime
+
+from db_manager import DBManager, Singleton
+from tests.db_fixtures import CHAT_ID, new_memory_db
+
+
+class UnitOfWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.group_id = self.db.get_group_id(CHAT_ID)
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def test_commits_at_the_end(self):
+        with self.db.unit_of_work():
+            participant = self.db.add_participant(self.group_id, 'Andrea', datetime(2022, 11, 18))
+            self.db.add_event(self.group_id, participant, datetime(2022, 11, 18))
+        self.assertEqual(self.db.get_turn_order(self.group_id), ['Andrea'])
+        self.assertEqual(len(self.db.get_all_events(self.group_id)), 1)
+        participant = self.db.get_participant_by_id(self.group_id, participant.participant_id)
+        self.assertEqual(participant.display_name, 'Andrea')
+
+    def test_rolls_back_everything_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.db.unit_of_work():
+                participant = self.db.add_participant(self.group_id, 'Andrea', datetime(2022, 11, 18))
+                self.db.add_event(self.group_id, participant, datetime(2022, 11, 18))
+                raise RuntimeError('handler failed')
+        self.assertEqual(self.db.get_all_participants(self.group_id), [])
+        self.assertEqual(self.db.get_all_events(self.group_id), [])
+        self.assertEqual(self.db.check_turn_state(repair=False), [])
+
+    def test_a_failed_method_rolls_back_the_whole_unit(self):
+        andrea = self.db.add_participant(self.group_id, 'Andrea', datetime(2022, 11, 18))
+        self.db.add_event(self.group_id, andrea, datetime(2022, 11, 18))
+        with self.db.unit_of_work():
+            self.db.add_participant(self.group_id, 'Vicent', datetime(2022, 11, 18))
+            # the date is already taken
+            self.assertIsNone(self.db.add_event(self.group_id, andrea, datetime(2022, 11, 18)))
+            self.db.add_participant(self.group_id, 'Pau', datetime(2022, 11, 18))
+            self.db.mark_update_processed(7)
+        self.assertEqual(self.db.get_turn_order(self.group_id), ['Andrea'])
+        self.assertFalse(self.db.is_update_processed(7))
+        self.assertEqual(self.db.check_turn_state(repair=False), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from update_engine import UpdateEngine
+
+
+def message(update_id: int, chat: int) -> dict:
+    return {'update_id': update_id, 'message': {'message_id': update_id, 'text': '/log', 'chat': {'id': chat}}}
+
+
+class PerChatOrderTest(unittest.TestCase):
+
+    def run_engine(self, handle, updates: list) -> None:
+        async def scenario():
+            engine = UpdateEngine(fetch_updates=None, handle_update=handle,
+                                  chat_key=lambda update: update['message']['chat']['id'],
+                                  max_workers=8, worker_idle_time=0.1)
+            engine.dispatch_polled(updates)
+            while engine.in_flight:
+                await asyncio.sleep(0.01)
+            engine.executor.shutdown()
+            engine.poll_executor.shutdown()
+
+        asyncio.run(scenario())
+
+    def test_chats_in_order_and_one_update_at_a_time(self):
+        lock = threading.Lock()
+        handled = []
+        running = set()
+        overlapped = []
+
+        def handle(update):
+            chat = update['message']['chat']['id']
+            with lock:
+                overlapped.append(chat in running)
+                running.add(chat)
+            # the later updates are the fastest ones, they would overtake the earlier ones if allowed
+            time.sleep(0.02 / (update['update_id'] % 4 + 1))
+            with lock:
+                running.discard(chat)
+                handled.append((chat, update['update_id']))
+
+        updates = [message(update_id, chat=update_id % 3) for update_id in range(1, 25)]
+        self.run_engine(handle, updates)
+        self.assertFalse(any(overlapped))
+        for chat in range(3):
+            self.assertEqual([update_id for it, update_id in handled if it == chat],
+                             [update_id for update_id in range(1, 25) if update_id % 3 == chat])
+
+    def test_a_slow_chat_does_not_hold_the_others(self):
+        release = threading.Event()
+        handled = []
+
+        def handle(update):
+            if update['message']['chat']['id'] == 10:
+                release.wait(5)
+            handled.append(update['update_id'])
+            if update['update_id'] == 3:
+                release.set()
+
+        self.run_engine(handle, [message(1, 10), message(2, 11), message(3, 11)])
+        self.assertEqual(handled, [2, 3, 1])
+
+    def test_a_failed_update_does_not_stop_its_chat(self):
+        handled = []
+
+        def handle(update):
+            if update['update_id'] == 1:
+                raise RuntimeError('handler failed')
+            handled.append(update['update_id'])
+
+        self.run_engine(handle, [message(1, 10), message(2, 10)])
+        self.assertEqual(handled, [2])
+
+
+class FakeTelegram:
+    # getUpdates as telegram answers it: every update from the offset on, held up to timeout when there are none
+
+    def __init__(self):
+        self.updates = []
+        self.arrived = threading.Condition()
+
+    def add(self, update: dict) -> None:
+        with self.arrived:
+            self.updates.append((time.monotonic(), update))
+            self.arrived.notify_all()
+
+    def pending(self, offset) -> list:
+        return [update for _, update in self.updates if offset is None or update['update_id'] >= offset][:100]
+
+    def get_updates(self, offset, timeout: int) -> dict:
+        with self.arrived:
+            self.arrived.wait_for(lambda: self.pending(offset), timeout=timeout)
+            return {'ok': True, 'result': self.pending(offset)}
+
+
+class PollTest(unittest.TestCase):
+
+    def test_a_slow_update_does_not_hold_the_polling(self):
+        telegram = FakeTelegram()
+        release = threading.Event()
+        handled_at = {}
+
+        def handle(update):
+            if update['message']['chat']['id'] == 10:
+                release.wait(5)
+            handled_at[update['update_id']] = time.monotonic()
+
+        async def scenario():
+            engine = UpdateEngine(fetch_updates=telegram.get_updates, handle_update=handle,
+                                  chat_key=lambda update: update['message']['chat']['id'],
+                                  poll_timeout=5, worker_idle_time=1)
+            poller = asyncio.create_task(engine.poll())
+            telegram.add(message(1, 10))
+            for update_id, chat in ((2, 11), (3, 12)):
+                await asyncio.sleep(0.3)
+                telegram.add(message(update_id, chat))
+            while len(handled_at) < 2 and time.monotonic() - telegram.updates[0][0] < 4:
+                await asyncio.sleep(0.05)
+            release.set()
+            while engine.in_flight:
+                await asyncio.sleep(0.01)
+            poller.cancel()
+            # wakes the getUpdates still waiting in the poller thread
+            telegram.add(message(4, 13))
+            engine.executor.shutdown()
+            engine.poll_executor.shutdown(wait=False)
+
+        asyncio.run(scenario())
+        # the updates of the other chats are handled while the first one is still running
+        for arrived_at, update in telegram.updates[1:3]:
+            self.assertLess(handled_at[update['update_id']] - arrived_at, 1)
+        self.assertGreater(handled_at[1], handled_at[3])
+
+
+if __name__ == '__main__':
+    unittest.main()
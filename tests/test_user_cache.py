@@ -0,0 +1,76 @@
+import time
+import unittest
+
+from sqlalchemy import event
+
+from db_manager import DBManager, Singleton
+from db_tables import StatusEnum, User
+from tests.db_fixtures import new_memory_db
+from user_cache import CachedUser, UserCache
+
+
+class UserCacheTest(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = UserCache(max_size=2, ttl=60)
+        for telegram_id in (1, 2):
+            cache.put(CachedUser(telegram_id, telegram_id, False, StatusEnum.MAIN_MENU))
+        cache.get(1)
+        cache.put(CachedUser(3, 3, False, StatusEnum.MAIN_MENU))
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(3))
+
+    def test_ttl(self):
+        cache = UserCache(max_size=2, ttl=0.01)
+        cache.put(CachedUser(1, 1, False, StatusEnum.MAIN_MENU))
+        time.sleep(0.02)
+        self.assertIsNone(cache.get(1))
+
+    def test_size_zero_disables_it(self):
+        cache = UserCache(max_size=0, ttl=60)
+        cache.put(CachedUser(1, 1, False, StatusEnum.MAIN_MENU))
+        self.assertIsNone(cache.get(1))
+
+
+class WriteThroughTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = new_memory_db()
+        self.queries = []
+        event.listen(self.db.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: self.queries.append(statement))
+
+    def tearDown(self):
+        Singleton._instances.pop(DBManager, None)
+
+    def stored_user(self, telegram_id: int) -> User:
+        return self.db.session.query(User).filter_by(telegram_id=telegram_id).one()
+
+    def test_lookups_and_redundant_status_skip_the_database(self):
+        user = self.db.add_user(42, 'Andrea')
+        self.queries.clear()
+        self.assertEqual(self.db.get_user_by_telegram_id(42), user)
+        self.assertTrue(self.db.change_user_status(user, StatusEnum.MAIN_MENU))
+        self.assertEqual(self.queries, [])
+
+    def test_changes_are_written_through(self):
+        user = self.db.add_user(42, 'Andrea')
+        self.db.change_user_status(user, StatusEnum.ADDING_EVENT)
+        self.db.promote_to_admin(self.db.get_user_by_telegram_id(42))
+        cached = self.db.get_user_by_telegram_id(42)
+        self.assertEqual((cached.status, cached.is_admin), (StatusEnum.ADDING_EVENT, True))
+        stored = self.stored_user(42)
+        self.assertEqual((stored.status, stored.is_admin), (StatusEnum.ADDING_EVENT, True))
+
+    def test_rolled_back_changes_leave_the_cache(self):
+        user = self.db.add_user(42, 'Andrea')
+        with self.assertRaises(RuntimeError):
+            with self.db.unit_of_work():
+                self.db.change_user_status(user, StatusEnum.ADDING_EVENT)
+                raise RuntimeError('handler failed')
+        self.assertEqual(self.db.get_user_by_telegram_id(42).status, StatusEnum.MAIN_MENU)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import asyncio
+import json
+import unittest
+
+from webhook import WebhookServer
+
+
+async def post(port: int, path: str, body: bytes, secret: str = None) -> int:
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    headers = f'POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\nConnection: close\r\n'
+    if secret is not None:
+        headers += f'X-Telegram-Bot-Api-Secret-Token: {secret}\r\n'
+    writer.write(headers.encode() + b'\r\n' + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+class WebhookServerTest(unittest.TestCase):
+
+    def run_requests(self, *requests) -> tuple:
+        received = []
+
+        async def scenario():
+            server = WebhookServer(received.append, 'secret', path='/telegram', host='127.0.0.1', port=0)
+            await server.start()
+            try:
+                return [await post(server.port, *request) for request in requests]
+            finally:
+                server.server.close()
+                await server.server.wait_closed()
+
+        return asyncio.run(scenario()), received
+
+    def test_dispatches_valid_updates(self):
+        update = {'update_id': 7, 'message': {'message_id': 1, 'text': '/log', 'chat': {'id': 1}}}
+        statuses, received = self.run_requests(('/telegram', json.dumps(update).encode(), 'secret'))
+        self.assertEqual(statuses, [200])
+        self.assertEqual(received, [update])
+
+    def test_rejects_invalid_requests(self):
+        update = json.dumps({'update_id': 7}).encode()
+        statuses, received = self.run_requests(('/telegram', update, 'wrong'), ('/telegram', update),
+                                               ('/other', update, 'secret'), ('/telegram', b'{not json', 'secret'))
+        self.assertEqual(statuses, [401, 401, 404, 400])
+        self.assertEqual(received, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
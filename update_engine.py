@@ -0,0 +1,205 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+from typing import Callable, Dict, Hashable, Optional, Set
+
+from resilience import Backoff, CircuitOpenError
+from utils import create_logger
+from webhook import WebhookServer
+
+logger = create_logger(__file__)
+
+
+class UpdateEngine:
+    """
+    Asyncio update engine. A single poller asks telegram for updates using server side long polling
+    and routes every update to the worker of its chat. Different chats are served concurrently,
+    the updates of the same chat are handled one after the other, in the order telegram sent them.
+    The offset given to telegram only moves past an update once it was handled, and it is saved with
+    save_offset so a restart resumes from the first unfinished update
+    """
+
+    def __init__(self, fetch_updates: Callable[[Optional[int], int], dict],
+                 handle_update: Callable[[dict], None],
+                 chat_key: Callable[[dict], Hashable],
+                 poll_timeout: Optional[int] = None,
+                 max_workers: Optional[int] = None,
+                 worker_idle_time: Optional[float] = None,
+                 on_handled: Optional[Callable[[dict], None]] = None,
+                 offset: Optional[int] = None,
+                 save_offset: Optional[Callable[[int], None]] = None,
+                 repoll_interval: Optional[float] = None):
+        self.fetch_updates = fetch_updates
+        self.handle_update = handle_update
+        # called after every update, handled or failed
+        self.on_handled = on_handled
+        self.chat_key = chat_key
+        self.poll_timeout = poll_timeout if poll_timeout is not None \
+            else int(environ.get('CREMAET_POLL_TIMEOUT', 30))
+        # seconds between polls while updates are in flight, telegram answers at once with the unfinished ones.
+        # The updates of the other chats arrive in the meantime, they must not wait for the slowest handler
+        self.repoll_interval = repoll_interval if repoll_interval is not None \
+            else float(environ.get('CREMAET_REPOLL_INTERVAL', 0.2))
+        max_workers = max_workers or int(environ.get('CREMAET_WORKER_THREADS', 8))
+        # seconds a chat worker waits for new updates before finishing
+        self.worker_idle_time = worker_idle_time if worker_idle_time is not None \
+            else float(environ.get('CREMAET_WORKER_IDLE_TIME', 60))
+        # handlers are blocking code (db + http), they run in this pool
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='cremaet-handler')
+        # the poller has its own thread so a busy handler pool never delays the next getUpdates
+        self.poll_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cremaet-poller')
+        self.queues: Dict[Hashable, asyncio.Queue] = dict()
+        self.workers: Dict[Hashable, asyncio.Task] = dict()
+        self.save_offset = save_offset
+        self._saved_offset = offset
+        # polled updates not handled yet, and the highest one dispatched: telegram repeats the ones not acknowledged
+        self.in_flight: Set[int] = set()
+        self.last_dispatched: Optional[int] = offset - 1 if offset is not None else None
+        self._handled: Optional[asyncio.Event] = None
+        # waits between failed polls
+        self.backoff = Backoff()
+
+    @property
+    def offset(self) -> Optional[int]:
+        if self.in_flight:
+            return min(self.in_flight)
+        return self.last_dispatched + 1 if self.last_dispatched is not None else None
+
+    def dispatch(self, update: dict) -> bool:
+        # Send the update to the worker of its chat, creating the worker if needed. False if it was discarded
+        try:
+            key = self.chat_key(update)
+        except Exception as e:
+            logger.error(f'Update {update.get("update_id")} discarded, no chat found: {e}')
+            return False
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = asyncio.Queue()
+            self.queues[key] = queue
+            self.workers[key] = asyncio.create_task(self._chat_worker(key, queue))
+        queue.put_nowait(update)
+        return True
+
+    async def _chat_worker(self, key: Hashable, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                update = await asyncio.wait_for(queue.get(), timeout=self.worker_idle_time)
+            except asyncio.TimeoutError:
+                # dispatch runs in the same loop, so nothing can be added between these lines
+                if queue.empty():
+                    self.queues.pop(key, None)
+                    self.workers.pop(key, None)
+                    return
+                continue
+            if update is None:
+                # stop signal, everything queued before it was already handled
+                self.queues.pop(key, None)
+                self.workers.pop(key, None)
+                return
+            while True:
+                try:
+                    await loop.run_in_executor(self.executor, self.handle_update, update)
+                except CircuitOpenError as e:
+                    # the database is down, the update waits for it instead of being lost
+                    await asyncio.sleep(max(e.breaker.retry_after(), self.backoff.base))
+                    continue
+                except Exception as e:
+                    # Ignores the messages that causes errors
+                    logger.error(f'Error handling update {update.get("update_id")}: {e}')
+                break
+            self.in_flight.discard(update.get('update_id'))
+            if self._handled is not None:
+                self._handled.set()
+            if self.on_handled is not None:
+                self.on_handled(update)
+
+    async def _checkpoint(self) -> None:
+        # Saves the offset when it moved, in the poller thread: it is a blocking database write
+        offset = self.offset
+        if self.save_offset is None or offset is None or offset == self._saved_offset:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.poll_executor, self.save_offset, offset)
+            self._saved_offset = offset
+        except Exception as e:
+            logger.error(f'Offset {offset} not saved: {e}')
+
+    def dispatch_polled(self, results: list) -> int:
+        # Dispatches the updates not seen before, returns how many
+        n_new = 0
+        for update in sorted(results, key=lambda it: int(it['update_id'])):
+            update_id = int(update['update_id'])
+            if self.last_dispatched is not None and update_id <= self.last_dispatched:
+                continue
+            self.last_dispatched = update_id
+            n_new += 1
+            # the worker runs in this loop, it cannot finish the update before it is added
+            if self.dispatch(update):
+                self.in_flight.add(update_id)
+        return n_new
+
+    async def poll(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._handled = asyncio.Event()
+        errors = 0
+        while True:
+            await self._checkpoint()
+            offset = self.offset
+            self._handled.clear()
+            try:
+                updates = await loop.run_in_executor(self.poll_executor, self.fetch_updates,
+                                                     offset, self.poll_timeout)
+                if not updates.get('ok', True):
+                    raise RuntimeError(f"getUpdates failed: {updates.get('description')}")
+            except Exception as e:
+                logger.error(e)
+                errors += 1
+                await asyncio.sleep(self.backoff.delay(errors))
+                continue
+            errors = 0
+            # an empty answer is the long polling timeout expiring without messages, ask again right away
+            if not self.dispatch_polled(updates.get('result') or []) and self.in_flight \
+                    and not self._handled.is_set():
+                # telegram answers at once with the unacknowledged updates, wait a little or for a worker
+                try:
+                    await asyncio.wait_for(self._handled.wait(), timeout=self.repoll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def consume(self, get_update: Callable[[], Optional[dict]]) -> None:
+        # Dispatches the updates another process fetched, get_update blocks and returns None to stop
+        loop = asyncio.get_running_loop()
+        while True:
+            update = await loop.run_in_executor(self.poll_executor, get_update)
+            if update is None:
+                break
+            self.dispatch(update)
+        # let the chat workers finish what they already have
+        workers = list(self.workers.values())
+        for queue in self.queues.values():
+            queue.put_nowait(None)
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def run_consumer(self, get_update: Callable[[], Optional[dict]]) -> None:
+        try:
+            await self.consume(get_update)
+        finally:
+            self.poll_executor.shutdown(wait=False)
+            self.executor.shutdown(wait=False)
+
+    async def run(self) -> None:
+        try:
+            await self.poll()
+        finally:
+            self.poll_executor.shutdown(wait=False)
+            self.executor.shutdown(wait=False)
+
+    async def run_webhook(self, server: 'WebhookServer') -> None:
+        # Telegram pushes the updates, the server dispatches them to the same chat workers as the poller
+        server.dispatch = self.dispatch
+        try:
+            await server.serve()
+        finally:
+            self.poll_executor.shutdown(wait=False)
+            self.executor.shutdown(wait=False)
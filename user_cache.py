@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+from os import environ
+from threading import Lock
+from typing import NamedTuple, Optional, Tuple
+
+from db_tables import StatusEnum, User
+
+
+class CachedUser(NamedTuple):
+    # The fields of a user the handlers need, detached from any session
+    user_id: int
+    telegram_id: int
+    is_admin: bool
+    status: StatusEnum
+
+    @classmethod
+    def from_user(cls, user: User) -> 'CachedUser':
+        return cls(user.user_id, user.telegram_id, bool(user.is_admin), user.status or StatusEnum.MAIN_MENU)
+
+
+class UserCache:
+    """
+    Users by telegram_id, the least recently used ones are evicted when the cache is full
+    and the entries expire after ttl seconds. DBManager writes every change of a user through it.
+    Size 0 disables it
+    """
+
+    def __init__(self, max_size: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_size = max_size if max_size is not None else int(environ.get('CREMAET_USER_CACHE_SIZE', 1024))
+        self.ttl = ttl or float(environ.get('CREMAET_USER_CACHE_TTL', 300))
+        # telegram_id -> (expiration, user)
+        self._users: 'OrderedDict[int, Tuple[float, CachedUser]]' = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, telegram_id: int) -> Optional[CachedUser]:
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            entry = self._users.get(telegram_id)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._users.pop(telegram_id)
+                return None
+            self._users.move_to_end(telegram_id)
+            return entry[1]
+
+    def put(self, user: CachedUser) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._users[user.telegram_id] = (time.monotonic() + self.ttl, user)
+            self._users.move_to_end(user.telegram_id)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def invalidate(self, telegram_id: int) -> None:
+        with self._lock:
+            self._users.pop(telegram_id, None)
@@ -1,67 +1,133 @@
+import atexit
+import csv
+import json
+import marshal
 import os
 import logging
-from logging.handlers import RotatingFileHandler
+import multiprocessing
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from threading import Lock
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy_utils import database_exists, create_database
-from typing import Tuple
-import pandas as pd
-from datetime import datetime
+from sqlalchemy.orm import sessionmaker, scoped_session, Session
+from typing import Optional, Tuple
+
+import db_backend
+
+# attributes of every LogRecord, the rest came in extra and go to the json record as they are
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    # One json object per line, with the fields given in extra
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name,
+                 'function': record.funcName, 'line': record.lineno, 'process': record.process,
+                 'thread': record.threadName, 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    # The handler threads never wait for the log file, the records are dropped when the queue is full
+    dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+_log_queue: 'queue.Queue[logging.LogRecord]' = queue.Queue(maxsize=int(os.environ.get('CREMAET_LOG_QUEUE_SIZE', 10000)))
+_listener: Optional[QueueListener] = None
+_listener_lock = Lock()
+
+
+def start_logging() -> None:
+    """
+    Starts the thread that writes the queued records, once per process: json lines to logs/cremaet.log
+    and plain text to stderr. Every worker process writes its own file, named after the process, two
+    processes rotating the same file would lose records
+    """
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            return
+        log_path = os.environ.get('CREMAET_LOG_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+        os.makedirs(log_path, exist_ok=True)
+        process_name = multiprocessing.current_process().name
+        file_name = 'cremaet.log' if process_name == 'MainProcess' else f'{process_name}.log'
+        rotating_handler = RotatingFileHandler(filename=os.path.join(log_path, file_name), mode='a',
+                                               maxBytes=5 * 1024 * 1024, backupCount=10, encoding='utf-8')
+        rotating_handler.setFormatter(JsonFormatter())
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+        _listener = QueueListener(_log_queue, rotating_handler, stream_handler, respect_handler_level=True)
+        _listener.start()
+
+
+def stop_logging() -> None:
+    # Writes what is still queued, at exit
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
 
 
 def create_logger(file_name: str) -> logging.Logger:
-    log_path = os.path.join(os.path.dirname(file_name), "logs")
-    log_name = os.path.basename(file_name[:-3])
-    log_filename = os.path.join(log_path, log_name + ".log")
-
-    log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s')
-    if not os.path.exists(log_path):
-        os.makedirs(log_path)
-    rotating_handler = RotatingFileHandler(filename=log_filename, mode='a',
-                                           maxBytes=5 * 1024 * 1024, backupCount=10, encoding=None, delay=False)
-    rotating_handler.setFormatter(log_formatter)
-    rotating_handler.setLevel(level=logging.INFO)
-
-    logger = logging.getLogger(log_name)
-    logger.setLevel(level=logging.INFO)
-    logger.addHandler(rotating_handler)
-    logger.addHandler(logging.StreamHandler())
-
-    logger.info("-- LOGGER LOADED --")
+    # The logger of a module, it only queues its records. Below CREMAET_LOG_LEVEL the calls return at once
+    start_logging()
+    logger = logging.getLogger(os.path.basename(file_name[:-3]))
+    if not any(isinstance(handler, QueueHandler) for handler in logger.handlers):
+        logger.setLevel(os.environ.get('CREMAET_LOG_LEVEL', 'INFO').upper())
+        logger.addHandler(DroppingQueueHandler(_log_queue))
+        logger.propagate = False
+        logger.debug("-- LOGGER LOADED --")
     return logger
 
 
-def create_database_session() -> Tuple[Session,  sqlalchemy.engine.Engine]:
-    db_name = os.environ.get('CREMAET_DATABASE')
-    if os.environ.get('CREMAET_DEBUG', 'true').lower() == 'true':
-        db_name = os.environ['CREMAET_TEST_DATABASE']
-
-    connection_str = (f"mysql+pymysql://{os.environ['CREMAET_DB_USER']}:"
-                      f"{os.environ['CREMAET_DB_PASSWORD']}@{os.environ['CREMAET_DB_HOST']}:"
-                      f"{os.environ['CREMAET_DB_PORT']}/{db_name}")
-
-    # Define the MariaDB engine using MariaDB Connector/Python
-    engine = sqlalchemy.create_engine(connection_str)
-
-    if not database_exists(engine.url):
-        create_database(engine.url)
+def create_database_session(backend: Optional[str] = None) -> Tuple[Session,  sqlalchemy.engine.Engine]:
+    # The backend (mariadb, sqlite or memory) comes from CREMAET_DB_BACKEND unless given
+    engine = db_backend.create_engine(backend)
 
     session_maker = sessionmaker(expire_on_commit=False)
     session_maker.configure(bind=engine)
-    session = session_maker()
+    # Updates are handled by several threads, each one gets its own session
+    session = scoped_session(session_maker)
     session.commit()
     return session, engine
 
 
-def load_dialogs() -> dict:
-    dialogs = dict()
-    # An optimization - don't require pandas
-    df = pd.read_csv('dialogs.csv', sep=';')
-    for row in df.itertuples():
-        dialogs[row.key] = row.value
+def load_dialogs(path: str = 'dialogs.csv') -> dict:
+    # The parsed dialogs are cached next to the bytecode, the csv is only read again when it changes
+    stat = os.stat(path)
+    cache_path = os.path.join(os.path.dirname(os.path.abspath(path)), '__pycache__',
+                              os.path.basename(path) + '.marshal')
+    try:
+        with open(cache_path, 'rb') as cache_reader:
+            mtime, size, dialogs = marshal.load(cache_reader)
+        if (mtime, size) == (stat.st_mtime_ns, stat.st_size):
+            return dialogs
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    with open(path, newline='', encoding='utf-8') as dialogs_reader:
+        dialogs = {row['key']: row['value'] for row in csv.DictReader(dialogs_reader, delimiter=';')}
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(f'{cache_path}.{os.getpid()}', 'wb') as cache_writer:
+            marshal.dump((stat.st_mtime_ns, stat.st_size, dialogs), cache_writer)
+        os.replace(f'{cache_path}.{os.getpid()}', cache_path)
+    except OSError:
+        # read only filesystem, the csv is parsed on every start
+        pass
     return dialogs
-
-
-
-
-
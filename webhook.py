@@ -0,0 +1,103 @@
+import asyncio
+import hmac
+import json
+from os import environ
+from typing import Callable, Optional
+
+from utils import create_logger
+
+logger = create_logger(__file__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large'}
+
+
+class WebhookServer:
+    """
+    Minimal asyncio HTTP server for the telegram webhook. Every POST to the path with the right
+    secret token header is parsed and dispatched, the answer is sent right away:
+    the handlers run in the workers of the update engine, never in the request
+    """
+
+    def __init__(self, dispatch: Callable[[dict], None], secret_token: str, path: Optional[str] = None,
+                 host: Optional[str] = None, port: Optional[int] = None, max_body: int = 1024 * 1024):
+        self.dispatch = dispatch
+        self.secret_token = secret_token
+        self.path = path or environ.get('CREMAET_WEBHOOK_PATH', '/telegram')
+        self.host = host or environ.get('CREMAET_WEBHOOK_HOST', '0.0.0.0')
+        self.port = port if port is not None else int(environ.get('CREMAET_WEBHOOK_PORT', 8443))
+        self.max_body = max_body
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.warning(f'Webhook listening on {self.host}:{self.port}{self.path}')
+
+    async def serve(self) -> None:
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            # telegram keeps the connections open, several requests can arrive through the same one
+            while True:
+                keep_alive = await self._handle_request(reader, writer)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        method, target, version = request_line.decode('latin-1').split()
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        length = int(headers.get('content-length', 0))
+        if length > self.max_body:
+            await self._respond(writer, 413, False)
+            return False
+        body = await reader.readexactly(length) if length else b''
+
+        if target.split('?')[0] != self.path:
+            status = 404
+        elif method != 'POST':
+            status = 405
+        elif not hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret_token):
+            logger.warning('Webhook request with a wrong secret token')
+            status = 401
+        else:
+            status = self._ingest(body)
+        await self._respond(writer, status, keep_alive)
+        return keep_alive
+
+    def _ingest(self, body: bytes) -> int:
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(update, dict) or 'update_id' not in update:
+            return 400
+        self.dispatch(update)
+        return 200
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, keep_alive: bool) -> None:
+        connection = 'keep-alive' if keep_alive else 'close'
+        writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n'
+                     f'Connection: {connection}\r\n\r\n'.encode('latin-1'))
+        await writer.drain()